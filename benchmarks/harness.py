@@ -0,0 +1,97 @@
+"""Flowlight workers started for the benchmarks and timing helpers.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import mean, median
+
+_WORKER_SCRIPT = '''
+import sys
+from flowlight import Manager
+from flowlight.core.setting import Setting
+Setting.PID_FILE = sys.argv[2]
+Setting.PORT = int(sys.argv[1])
+Setting.WORKER_BACKEND = sys.argv[3]
+manager = Manager(('127.0.0.1', Setting.PORT), log_path=sys.argv[4])
+manager.run(daemon=False)
+'''
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class Workers:
+    """A `Manager` and its `WorkerProxy` processes listening on a free local port.
+
+    :param backend: `Setting.WORKER_BACKEND` of the workers.
+    """
+    def __init__(self, backend='thread'):
+        self.port = free_port()
+        self.backend = backend
+        self._dir = tempfile.TemporaryDirectory()
+        self._process = None
+
+    def start(self, timeout=10):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+        self._process = subprocess.Popen(
+            [sys.executable, '-c', _WORKER_SCRIPT, str(self.port), os.path.join(self._dir.name, 'pid'),
+             self.backend, os.path.join(self._dir.name, 'log')],
+            env=env, start_new_session=True
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise Exception('Workers did not start in {} seconds'.format(timeout))
+
+    def stop(self):
+        if self._process is not None:
+            self._process.send_signal(signal.SIGINT)
+            try:
+                self._process.wait(5)
+            except subprocess.TimeoutExpired:
+                os.killpg(self._process.pid, signal.SIGKILL)
+                self._process.wait()
+            self._process = None
+        self._dir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def measure(func, repeat, warmup=1, items=1):
+    """Call `func` `warmup` then `repeat` times, return timing statistics in seconds.
+
+    :param items: operations done by one call, for the throughput.
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'repeat': repeat,
+        'mean': mean(timings),
+        'median': median(timings),
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'min': timings[0],
+        'ops_per_sec': items * repeat / sum(timings),
+    }
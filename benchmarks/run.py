@@ -0,0 +1,206 @@
+"""Benchmarks of flowlight against a local SSH server and local workers.
+
+Usage::
+
+    $ python benchmarks/run.py --output results.json
+    $ python benchmarks/run.py --only machine.run,remote.latency --repeat 50
+
+Results are written as JSON, one entry per benchmark and parameters, along
+with the commit and Python version so runs can be compared.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flowlight import Machine, Group  # noqa: E402
+from flowlight.api import API  # noqa: E402
+from flowlight.core.setting import Setting  # noqa: E402
+
+from benchmarks.harness import Workers, free_port, measure  # noqa: E402
+from benchmarks.server import SSHServer  # noqa: E402
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _echo(payload):
+    return payload
+
+
+class Context:
+    def __init__(self, ssh, repeat, workdir):
+        self.ssh = ssh
+        self.repeat = repeat
+        self.workdir = workdir
+
+    def machine(self):
+        machine = Machine(self.ssh.host, port=self.ssh.port)
+        machine.enable_connection(password='flowlight')
+        return machine
+
+
+@benchmark('machine.run')
+def machine_run(context):
+    machine = context.machine()
+    yield {}, measure(lambda: machine.run('true'), context.repeat)
+
+
+@benchmark('group.run')
+def group_run(context):
+    for fanout in (1, 8, 32):
+        group = Group([context.machine() for _ in range(fanout)])
+        yield {'fanout': fanout}, measure(lambda: group.run('true'), max(context.repeat // 4, 3), items=fanout)
+
+
+@benchmark('run_async')
+def run_async(context):
+    loop = asyncio.new_event_loop()
+    try:
+        for fanout in (1, 32):
+            machines = [context.machine() for _ in range(fanout)]
+
+            async def _gather():
+                await asyncio.gather(*[m.run_async('true') for m in machines])
+            yield {'fanout': fanout}, measure(lambda: loop.run_until_complete(_gather()),
+                                              max(context.repeat // 4, 3), items=fanout)
+    finally:
+        loop.close()
+
+
+@benchmark('sftp')
+def sftp(context):
+    machine = context.machine()
+    for size in (1024 * 1024, 16 * 1024 * 1024):
+        source = os.path.join(context.workdir, 'source')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(size))
+        remote = os.path.join(context.workdir, 'remote')
+        target = os.path.join(context.workdir, 'target')
+        for op, func in (('put', lambda: machine.put(source, remote)),
+                         ('get', lambda: machine.get(remote, target))):
+            stats = measure(func, max(context.repeat // 10, 3))
+            stats['mb_per_sec'] = size / stats['median'] / 1024 / 1024
+            yield {'op': op, 'size': size}, stats
+
+
+@benchmark('remote.latency')
+def remote_latency(context):
+    machine = Machine('127.0.0.1')
+    for size in (64, 4096, 65536, 1024 * 1024):
+        payload = os.urandom(size)
+        yield {'payload': size}, measure(lambda: machine.run_remote_callable(_echo, payload), context.repeat)
+
+
+@benchmark('remote.throughput')
+def remote_throughput(context):
+    machine = Machine('127.0.0.1')
+    calls = 1000
+    for size in (64, 65536):
+        payload = os.urandom(size)
+
+        def _submit():
+            futures = [machine.submit_remote_callable(_echo, payload) for _ in range(calls)]
+            for future in futures:
+                future.result()
+        yield {'payload': size, 'calls': calls}, measure(_submit, max(context.repeat // 10, 3), items=calls)
+
+
+def _serve_sync(port):
+    API.PORT = port
+    API.serve()
+
+
+def _serve_async(port):
+    API.serve_async('127.0.0.1', port)
+
+
+@benchmark('api')
+def api(context):
+    path = '/127.0.0.1/true'
+    for mode, serve in (('thread', _serve_sync), ('async', _serve_async)):
+        port = free_port()
+        threading.Thread(target=serve, args=(port,), daemon=True).start()
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        for _ in range(100):
+            try:
+                connection.connect()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+        def _request():
+            connection.request('GET', path)
+            connection.getresponse().read()
+        yield {'server': mode}, measure(_request, context.repeat)
+        connection.close()
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='flowlight benchmarks')
+    parser.add_argument('--only', help='comma separated benchmarks, one of {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls of each benchmark')
+    parser.add_argument('--ssh-host', default='127.0.0.2', help='loopback address of the SSH server, '
+                        'flowlight runs commands for 127.0.0.1 without SSH')
+    parser.add_argument('--backend', default='thread', help='WORKER_BACKEND of the workers')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args(argv)
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks {}'.format(', '.join(unknown)))
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, SSHServer(args.ssh_host) as ssh, \
+            Workers(args.backend) as workers:
+        Setting.PORT = workers.port
+        context = Context(ssh, args.repeat, workdir)
+        for name in names:
+            for params, stats in BENCHMARKS[name](context):
+                results.append({'name': name, 'params': params, 'stats': stats})
+                print('{:<20} {:<36} median {:.6f}s  {:.1f} ops/s'.format(
+                    name, json.dumps(params), stats['median'], stats['ops_per_sec']), file=sys.stderr)
+
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
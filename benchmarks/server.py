@@ -0,0 +1,151 @@
+"""A paramiko SSH server running in the benchmark process, commands run in a local shell
+and SFTP works on the local file system.
+"""
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+
+class _Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_RDWR:
+            mode = 'r+b'
+        elif flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _Interface(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        channel.transport.replied[channel.remote_chanid] = replied = threading.Event()
+        threading.Thread(target=self._exec, args=(channel, command, replied), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _exec(channel, command, replied):
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump(source, send):
+            for chunk in iter(lambda: source.read1(32768), b''):
+                send(chunk)
+
+        errors = threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))
+        errors.start()
+        pump(process.stdout, channel.sendall)
+        errors.join()
+        # closing before the exec request is answered fails it on the client
+        replied.wait()
+        channel.send_exit_status(process.wait())
+        channel.shutdown_write()
+        channel.close()
+
+
+class _Transport(paramiko.Transport):
+    """Tells when the exec request of a channel has been answered.
+    """
+    def __init__(self, sock):
+        paramiko.Transport.__init__(self, sock)
+        self.replied = {}
+
+    def _send_user_message(self, data):
+        paramiko.Transport._send_user_message(self, data)
+        packet = data.asbytes()
+        if packet[0] in (paramiko.common.MSG_CHANNEL_SUCCESS, paramiko.common.MSG_CHANNEL_FAILURE):
+            replied = self.replied.pop(int.from_bytes(packet[1:5], 'big'), None)
+            if replied is not None:
+                replied.set()
+
+
+class SSHServer:
+    """An SSH server on `host` and a free port, accepting any credentials.
+
+    Usage::
+
+        >>> with SSHServer() as server:
+        ...     m = Machine(server.host, port=server.port)
+    """
+    def __init__(self, host='127.0.0.2'):
+        self.host = host
+        self._key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, 0))
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+        self._thread = None
+
+    def start(self):
+        self._sock.listen(128)
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            transport = _Transport(sock)
+            transport.add_server_key(self._key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPInterface)
+            transport.start_server(server=_Interface())
+            self._transports.append(transport)
+
+    def stop(self):
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
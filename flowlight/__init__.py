@@ -1,41 +1,46 @@
-from .core import (
-    Connection,
-    Response,
-    Manager,
-    WorkerProxy,
-    Command,
-    Setting
-)
-from .model import (
-    Machine,
-    Group,
-    Cluster
-)
-from .tasks import (
-    TaskFuture,
-    TaskMeta,
-    TaskState,
-    task
-)
-from .utils import (
-    Signal,
-    Trigger
-)
-
-
 import os
-from flowlight.api import api_serve
+
+from flowlight.core.pidfile import get_pid as _get_pid
 from flowlight.core.setting import Setting
+from flowlight.utils.lazy import install_lazy
+
+
+_LAZY = {
+    'Connection': ('flowlight.core.connection', 'Connection'),
+    'ConnectionPool': ('flowlight.core.pool', 'ConnectionPool'),
+    'Response': ('flowlight.core.response', 'Response'),
+    'Manager': ('flowlight.core.manager', 'Manager'),
+    'WorkerProxy': ('flowlight.core.worker', 'WorkerProxy'),
+    'Command': ('flowlight.core.command', 'Command'),
+    'Machine': ('flowlight.model.machine', 'Machine'),
+    'Group': ('flowlight.model.group', 'Group'),
+    'Cluster': ('flowlight.model.group', 'Cluster'),
+    'Scheduler': ('flowlight.tasks.scheduler', 'Scheduler'),
+    'TaskFuture': ('flowlight.tasks.future', 'TaskFuture'),
+    'TaskMeta': ('flowlight.tasks.meta', 'TaskMeta'),
+    'TaskState': ('flowlight.tasks.state', 'TaskState'),
+    'task': ('flowlight.tasks', 'task'),
+    'Signal': ('flowlight.utils.signal', 'Signal'),
+    'Trigger': ('flowlight.utils.trigger', 'Trigger'),
+    'api_serve': ('flowlight.api', 'api_serve'),
+    'api_serve_async': ('flowlight.api', 'api_serve_async'),
+    'enable_metrics': ('flowlight.utils.metrics', 'enable'),
+}
+
+__all__ = ['Setting'] + list(_LAZY)
+
+install_lazy(globals(), _LAZY)
 
 
 def worker(args):
     def start():
+        from flowlight.core.manager import Manager
         manager = Manager(('127.0.0.1', Setting.PORT))
         manager.run(daemon=True)
 
     def stop():
         import signal
-        pid = Manager.get_pid()
+        pid = _get_pid()
         if pid is not None:
             try:
                 os.kill(int(pid), signal.SIGINT)
@@ -45,7 +50,7 @@ def worker(args):
     def status():
         if os.path.exists(Setting.PID_FILE):
             try:
-                os.kill(Manager.get_pid(), 0)
+                os.kill(_get_pid(), 0)
                 print('running')
             except OSError:
                 return False
@@ -63,7 +68,14 @@ def worker(args):
         status()
 
 def api(args):
-    api_serve()
+    from flowlight.api import api_serve, api_serve_async
+    from flowlight.utils.metrics import enable as enable_metrics
+    if args.metrics:
+        enable_metrics()
+    if args.use_async:
+        api_serve_async()
+    else:
+        api_serve()
 
 def enter():
     import argparse
@@ -75,6 +87,9 @@ def enter():
     worker_cmd.set_defaults(func=worker)
 
     api_cmd = subparsers.add_parser('api', help='api mode', description='api mode')
+    api_cmd.add_argument('--async', dest='use_async', action='store_true',
+                         help='stream results of each host as NDJSON from an event loop')
+    api_cmd.add_argument('--metrics', action='store_true', help='record metrics served on /metrics')
     api_cmd.set_defaults(func=api)
 
     try:
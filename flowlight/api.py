@@ -1,21 +1,30 @@
 #-*- coding:utf-8 -*-
 
+import asyncio
 import getpass
+import json
 import os
 from io import BytesIO
+from urllib.parse import urlparse, parse_qs, unquote
 
 from flowlight.model.group import Cluster
 from flowlight.core.setting import Setting
+from flowlight.utils.metrics import render as render_metrics
+
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
 
 
 class API:
     """ Simple HTTP API Server to run command on machines by url.
     """
     PORT = Setting.API_PORT
-    __doc__ = 'Usage:: http://0.0.0.0:{}/<machines>/<command>'.format(Setting.API_PORT)
+    USAGE = 'Usage:: http://{host}:{port}/<machines>/<command>[?ttl=<seconds>] or /metrics'
+    __doc__ = USAGE.format(host='0.0.0.0', port=Setting.API_PORT)
 
     @classmethod
     def serve(cls):
+        usage = cls.USAGE.format(host='127.0.0.1', port=cls.PORT)
         from http.server import SimpleHTTPRequestHandler, HTTPServer
         from socketserver import ThreadingMixIn
         from urllib.request import unquote
@@ -37,6 +46,14 @@ class API:
         def do_GET(self):
             try:
                 url = urlparse(self.path)
+                if url.path == '/metrics':
+                    body = render_metrics().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+                    self.send_header('Content-Length', len(body))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
                 qs = parse_qs(url.query)
                 paths = url.path.split('/', 2)
                 machines, cmd = paths[1], "".join(paths[2:]) if len(paths) >= 3 else None
@@ -45,7 +62,11 @@ class API:
                 hosts = machines.split(',')
                 cluster = Cluster(hosts)
                 cluster.enable_connection()
-                responses = cluster.run(unquote(cmd))
+                try:
+                    responses = cluster.run(unquote(cmd), ttl=_ttl(qs))
+                finally:
+                    # hand the transports back to the pool for the next request
+                    cluster.close_connection()
                 self.send_response(200)
                 res = _handle_json(self, responses)
                 self.end_headers()
@@ -53,11 +74,140 @@ class API:
             except Exception as e:
                 self.send_response(400)
                 self.end_headers()
-                self.copyfile(BytesIO(bytes(cls.__doc__, 'utf-8')), self.wfile)
+                self.copyfile(BytesIO(bytes(usage, 'utf-8')), self.wfile)
         Handler.do_GET = do_GET
         server = Server(('127.0.0.1', cls.PORT), Handler)
-        print('FlowLight API serve on {port}... \n {usage}'.format(port=cls.PORT, usage=cls.__doc__))
+        print('FlowLight API serve on {port}... \n {usage}'.format(port=cls.PORT, usage=usage))
         server.serve_forever()
 
+    @classmethod
+    def serve_async(cls, host='127.0.0.1', port=None):
+        """Serve on an event loop, hosts run concurrently over async connections
+        and each host's result is streamed back as one NDJSON line as soon as it is done.
+
+        Connections are kept alive between requests, SSH sessions in flight over
+        all requests are capped by `Setting.API_MAX_SESSIONS`.
+        """
+        port = port or cls.PORT
+        usage = cls.USAGE.format(host=host, port=port)
+        # a loop of its own, the server may run on any thread
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sessions = asyncio.Semaphore(Setting.API_MAX_SESSIONS)
+        server = loop.run_until_complete(asyncio.start_server(
+            lambda reader, writer: _AsyncHandler(usage, sessions).handle(reader, writer), host, port
+        ))
+        print('FlowLight API serve on {port}... \n {usage}'.format(port=port, usage=usage))
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+
+def _ttl(qs):
+    """Seconds results may be cached for, from the `ttl` query parameter.
+    """
+    ttl = qs.get('ttl')
+    return float(ttl[0]) if ttl else None
+
+
+class _AsyncHandler:
+    """One HTTP/1.1 client connection of the async API server.
+    """
+    def __init__(self, usage, sessions):
+        self.usage = usage
+        self.sessions = sessions
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), Setting.API_KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip().lower()
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)
+                connection = headers.get('connection', '')
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                await self.respond(writer, method, target, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _headers(self, status, headers, keep_alive):
+        lines = ['HTTP/1.1 {}'.format(status)] + ['{}: {}'.format(*header) for header in headers]
+        lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _bad_request(self, writer, keep_alive):
+        body = self.usage.encode()
+        writer.write(self._headers('400 Bad Request', [('Content-Length', len(body))], keep_alive) + body)
+        await writer.drain()
+
+    async def respond(self, writer, method, target, keep_alive):
+        url = urlparse(target)
+        if method == 'GET' and url.path == '/metrics':
+            body = render_metrics().encode()
+            writer.write(self._headers('200 OK', [('Content-Type', METRICS_CONTENT_TYPE),
+                                                  ('Content-Length', len(body))], keep_alive) + body)
+            return await writer.drain()
+        paths = url.path.split('/', 2)
+        if method != 'GET' or len(paths) < 3 or not paths[1] or not paths[2]:
+            return await self._bad_request(writer, keep_alive)
+        cmd = unquote(paths[2])
+        try:
+            ttl = _ttl(parse_qs(url.query))
+        except ValueError:
+            return await self._bad_request(writer, keep_alive)
+        loop = asyncio.get_event_loop()
+        cluster = Cluster(paths[1].split(','))
+        try:
+            # resolves hosts and loads keys
+            await loop.run_in_executor(None, cluster.enable_connection)
+        except Exception:
+            return await self._bad_request(writer, keep_alive)
+
+        async def _run(machine):
+            async with self.sessions:
+                try:
+                    response = await machine.run_async(cmd, ttl=ttl)
+                    return {'host': str(machine), 'result': response.result.decode(errors='replace')}
+                except Exception as e:
+                    return {'host': str(machine), 'error': repr(e)}
+
+        tasks = [asyncio.ensure_future(_run(machine)) for machine in cluster.machines()]
+        try:
+            writer.write(self._headers('200 OK', [('Content-Type', 'application/x-ndjson'),
+                                                  ('Transfer-Encoding', 'chunked')], keep_alive))
+            for task in asyncio.as_completed(tasks):
+                line = (json.dumps(await task) + '\n').encode()
+                writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # hand the transports back to the pool for the next request
+            await loop.run_in_executor(None, cluster.close_connection)
+
+
 api_serve = API.serve
+api_serve_async = API.serve_async
 
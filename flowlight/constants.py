@@ -2,4 +2,25 @@
 
 EVENT_CLOSE = -1
 EVENT_LOG = 0
+EVENT_CONNECTION = 1
+EVENT_BACKLOG = 2
+EVENT_IDLE = 3
+EVENT_STEAL = 4
+EVENT_TASKS = 5
+EVENT_DONE = 6
+EVENT_STATS = 7
+EVENT_DRAIN = 8
 PID_FILE = '/tmp/flowlight.pid'
+
+MSG_CALL = 1
+MSG_RESULT = 2
+MSG_ERROR = 3
+MSG_UNKNOWN_CALLABLE = 4
+MSG_CHUNK = 5
+MSG_END = 6
+MSG_CREDIT = 7
+MSG_CANCEL = 8
+MSG_GOAWAY = 9
+MSG_HELLO = 10
+# set on the kind of a message whose body is compressed
+MSG_COMPRESSED = 0x80
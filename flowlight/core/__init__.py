@@ -1,6 +1,17 @@
-from .connection import Connection
-from .response import Response
+from flowlight.utils.lazy import install_lazy
+
 from .setting import Setting
-from .command import Command
-from .manager import Manager
-from .worker import WorkerProxy
+
+
+_LAZY = {
+    'Connection': '.connection',
+    'ConnectionPool': '.pool',
+    'Response': '.response',
+    'Command': '.command',
+    'Manager': '.manager',
+    'WorkerProxy': '.worker',
+}
+
+__all__ = ['Setting'] + list(_LAZY)
+
+install_lazy(globals(), _LAZY)
@@ -0,0 +1,231 @@
+import asyncio
+import subprocess
+from time import monotonic
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['CommandSession', 'open_channel_session', 'open_process_session']
+
+
+class CommandSession:
+    """Output of one command running on the event loop, split into `stdout`/`stderr`
+    `asyncio.StreamReader` and an `exit_status` future.
+
+    The readers pause the source when their buffer grows past `Setting.ASYNC_BUFFER_LIMIT`,
+    so a slow consumer never makes the output pile up in memory.
+
+    :param timeout: seconds without any output before the command is aborted.
+    """
+    def __init__(self, timeout=None):
+        self.loop = asyncio.get_event_loop()
+        limit = Setting.ASYNC_BUFFER_LIMIT
+        self.stdout = asyncio.StreamReader(limit=limit)
+        self.stderr = asyncio.StreamReader(limit=limit)
+        self.stdout.set_transport(_ReaderControl(self, 'stdout'))
+        self.stderr.set_transport(_ReaderControl(self, 'stderr'))
+        self.exit_status = self.loop.create_future()
+        self.timeout = timeout
+        self._paused = set()
+        self._eof = False
+        self._last_active = monotonic()
+        self._watchdog = None
+        if timeout:
+            self._watchdog = self.loop.call_later(timeout, self._check_idle)
+
+    def feed(self, name, data):
+        self._last_active = monotonic()
+        getattr(self, name).feed_data(data)
+
+    def feed_eof(self):
+        if self._eof:
+            return
+        self._eof = True
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+
+    def set_exit_status(self, status):
+        if not self.exit_status.done():
+            self.exit_status.set_result(status)
+
+    def abort(self, exc):
+        self._close_source()
+        if not self._eof:
+            self._eof = True
+            self.stdout.set_exception(exc)
+            self.stderr.set_exception(exc)
+        if not self.exit_status.done():
+            self.exit_status.set_exception(exc)
+            # mark retrieved, the readers already report it
+            self.exit_status.exception()
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+
+    def cancel(self):
+        self.abort(asyncio.CancelledError())
+
+    def _check_idle(self):
+        idle = 0 if self._paused else monotonic() - self._last_active
+        if idle < self.timeout:
+            self._watchdog = self.loop.call_later(self.timeout - idle, self._check_idle)
+        else:
+            self.abort(asyncio.TimeoutError('No output in {} seconds'.format(self.timeout)))
+
+    def _pause(self, name):
+        if not self._paused:
+            self._pause_source()
+        self._paused.add(name)
+
+    def _resume(self, name):
+        self._paused.discard(name)
+        if not self._paused:
+            self._last_active = monotonic()
+            self._resume_source()
+
+    # flow control of what feeds the session, nothing to do for a session fed by hand
+    def _pause_source(self):
+        pass
+
+    def _resume_source(self):
+        pass
+
+    def _close_source(self):
+        pass
+
+    async def communicate(self):
+        """Wait for the command to finish and return (stdout, stderr, exit status).
+        """
+        try:
+            return await asyncio.gather(self.stdout.read(), self.stderr.read(), self.exit_status)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+
+class _ReaderControl:
+    """Transport-like hooks `asyncio.StreamReader` uses for flow control.
+    """
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+
+    def pause_reading(self):
+        self._session._pause(self._name)
+
+    def resume_reading(self):
+        self._session._resume(self._name)
+
+
+class _ChannelSession(CommandSession):
+    def __init__(self, chan, timeout=None):
+        CommandSession.__init__(self, timeout)
+        self.chan = chan
+        self._fd = chan.fileno()
+        self._reading = False
+        self._resume_source()
+
+    def _on_readable(self):
+        chan = self.chan
+        chunk_size = Setting.RESPONSE_CHUNK_SIZE
+        while chan.recv_ready():
+            self.feed('stdout', chan.recv(chunk_size))
+        while chan.recv_stderr_ready():
+            self.feed('stderr', chan.recv_stderr(chunk_size))
+        if (chan.eof_received or chan.closed) and not (chan.recv_ready() or chan.recv_stderr_ready()):
+            self._pause_source()
+            self.feed_eof()
+            if chan.exit_status_ready():
+                self.set_exit_status(chan.recv_exit_status())
+            else:
+                future = self.loop.run_in_executor(None, chan.recv_exit_status)
+                future.add_done_callback(self._on_exit_status)
+
+    def _on_exit_status(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.set_exit_status(future.result())
+
+    def _pause_source(self):
+        if self._reading:
+            self.loop.remove_reader(self._fd)
+            self._reading = False
+
+    def _resume_source(self):
+        if not self._reading and not self._eof:
+            self.loop.add_reader(self._fd, self._on_readable)
+            self._reading = True
+
+    def _close_source(self):
+        self._pause_source()
+        self.chan.close()
+
+
+class _ProcessProtocol(asyncio.SubprocessProtocol):
+    def __init__(self, session):
+        self.session = session
+        self._pipes_open = 2
+
+    def connection_made(self, transport):
+        self.session.transport = transport
+
+    def pipe_data_received(self, fd, data):
+        self.session.feed('stdout' if fd == 1 else 'stderr', data)
+
+    def pipe_connection_lost(self, fd, exc):
+        self._pipes_open -= 1
+        if not self._pipes_open:
+            self.session.feed_eof()
+
+    def process_exited(self):
+        self.session.set_exit_status(self.session.transport.get_returncode())
+
+
+class _ProcessSession(CommandSession):
+    transport = None
+
+    def _pipes(self):
+        pipes = (self.transport.get_pipe_transport(fd) for fd in (1, 2))
+        return [pipe for pipe in pipes if pipe is not None and not pipe.is_closing()]
+
+    def _pause_source(self):
+        for pipe in self._pipes():
+            pipe.pause_reading()
+
+    def _resume_source(self):
+        for pipe in self._pipes():
+            pipe.resume_reading()
+
+    def _close_source(self):
+        if self.transport.get_returncode() is None:
+            self.transport.kill()
+        self.transport.close()
+
+
+async def open_channel_session(transport, command):
+    """Run `command` on a new channel of a paramiko `transport`.
+    """
+    def _open():
+        chan = transport.open_session()
+        if command.env:
+            chan.update_environment(command.env)
+        chan.exec_command(command.cmd)
+        chan.setblocking(0)
+        return chan
+
+    loop = asyncio.get_event_loop()
+    chan = await loop.run_in_executor(None, _open)
+    return _ChannelSession(chan, command.timeout)
+
+
+async def open_process_session(command):
+    """Run `command` in a local shell.
+    """
+    loop = asyncio.get_event_loop()
+    session = _ProcessSession(command.timeout)
+    await loop.subprocess_shell(
+        lambda: _ProcessProtocol(session), command.cmd,
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=command.env
+    )
+    return session
@@ -0,0 +1,86 @@
+import os
+import socket
+import threading
+from contextlib import closing
+from time import monotonic
+
+from flowlight.core.setting import Setting
+from flowlight.utils.executor import fan_out
+from flowlight.utils.metrics import DNS_SECONDS
+from flowlight.utils.tracing import span
+
+
+__all__ = ['resolve', 'resolve_many', 'load_private_key', 'get_host_keys']
+
+
+_addresses = {}
+_addresses_lock = threading.Lock()
+
+
+def resolve(host):
+    """`socket.gethostbyname` cached for `Setting.DNS_CACHE_TTL` seconds.
+    """
+    now = monotonic()
+    with _addresses_lock:
+        entry = _addresses.get(host)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    with span('resolve', 'dns', host=host):
+        address = socket.gethostbyname(host)
+    DNS_SECONDS.observe(monotonic() - now)
+    with _addresses_lock:
+        _addresses[host] = (now + Setting.DNS_CACHE_TTL, address)
+    return address
+
+
+def resolve_many(hosts, max_workers=None):
+    """Resolve `hosts` at once to fill the cache, return a dict from host to address
+    or to the exception of its failure.
+    """
+    results = {}
+    with closing(fan_out(resolve, set(hosts), max_workers)) as completed:
+        for host, future in completed:
+            results[host] = future.exception() or future.result()
+    return results
+
+
+_private_keys = {}
+_private_keys_lock = threading.Lock()
+
+
+def load_private_key(path):
+    """The RSA key at `path` parsed once per process, reloaded when the file changes,
+    `None` when there is no such file.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _private_keys_lock:
+        entry = _private_keys.get(path)
+        if entry is None or entry[0] != mtime:
+            from paramiko import RSAKey
+            entry = _private_keys[path] = (mtime, RSAKey.from_private_key_file(path))
+        return entry[1]
+
+
+_host_keys = None
+_host_keys_lock = threading.Lock()
+
+
+def get_host_keys():
+    """`~/.ssh/known_hosts` parsed once per process and shared by every client.
+    """
+    global _host_keys
+    if _host_keys is None:
+        with _host_keys_lock:
+            if _host_keys is None:
+                from paramiko import HostKeys
+                host_keys = HostKeys()
+                try:
+                    host_keys.load(os.path.expanduser('~/.ssh/known_hosts'))
+                except IOError:
+                    pass
+                _host_keys = host_keys
+    return _host_keys
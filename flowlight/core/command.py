@@ -1,6 +1,9 @@
 class Command:
-    def __init__(self, cmd, bufsize=-1, timeout=5, env=None):
+    def __init__(self, cmd, bufsize=-1, timeout=5, env=None, stream=False, max_size=None, overflow='spill'):
         self.cmd = cmd
         self.bufsize = bufsize
         self.timeout = timeout
         self.env = env
+        self.stream = stream
+        self.max_size = max_size
+        self.overflow = overflow
@@ -1,14 +1,28 @@
 import getpass
-import os
 import socket
 import subprocess
-import paramiko
+import threading
 import asyncio
 from io import BytesIO
+from time import monotonic
 
 from flowlight.core.setting import Setting
 from flowlight.core.command import Command
 from flowlight.core.response import Response
+from flowlight.core.pool import ConnectionPool, get_pool
+from flowlight.core.aio import open_channel_session, open_process_session
+from flowlight.core.transfer import SFTPSessions
+from flowlight.core.bootstrap import resolve, load_private_key, get_host_keys
+from flowlight.utils.metrics import SSH_CONNECT_SECONDS, CHANNEL_OPEN_SECONDS, COMMAND_SECONDS, OUTPUT_BYTES
+from flowlight.utils.tracing import span, propagate
+
+
+def _abort(sock, expired):
+    expired.set()
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        sock.close()
 
 
 class Connection:
@@ -24,43 +38,93 @@ class Connection:
     :param auto_add_host_policy: auto add host key when no keys were found.
     :param lazy: whether to build the connection when initializing.
     :param sock: an open socket or socket-like objectto use for communication to the target host
+    :param pooled: share the SSH transport through the process-wide `ConnectionPool`,
+            connections over `sock` are never pooled.
+    :param compress: compress the SSH transport, which pays off for large outputs
+            over slow links, defaults to `Setting.SSH_COMPRESSION`.
+    :param deadline: seconds to connect, handshake and authenticate in all,
+            the transport is aborted past it.
     """
 
     def __init__(self, machine, host='127.0.0.1', port=None, username='root',
                  password=None, pkey='~/.ssh/id_rsa', timeout=5, auto_add_host_policy=True, connect=False,
-                 sock=None, **kwargs):
+                 sock=None, pooled=True, compress=None, deadline=None, **kwargs):
         self._machine = machine
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
+        self.client = None
+        self._pool_key = None
+        self._sftp_sessions = None
         self.hostname = host
-        self.host = socket.gethostbyname(host)
+        self.host = resolve(host)
         self.port = port or Setting.DEFAULT_SSH_PORT
         self.username = username
         self.password = password
         self.timeout = timeout
         self.is_local = False
         self.sock = sock
-        pkey = os.path.abspath(os.path.expanduser(pkey))
-        if os.path.exists(pkey):
-            self.pkey = paramiko.RSAKey.from_private_key_file(pkey)
-        else:
-            self.pkey = None
+        self.pkey = load_private_key(pkey)
+        self.compress = Setting.SSH_COMPRESSION if compress is None else compress
+        self.deadline = deadline
         self._connect_args = kwargs
+        self.auto_add_host_policy = auto_add_host_policy
+        self.pooled = pooled and sock is None
         self.is_connected = False
-        if auto_add_host_policy:
-            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         if connect:
             self.build_connect()
 
+    def _new_client(self):
+        import paramiko
+        client = paramiko.SSHClient()
+        # parsed once and shared, clients only read their system host keys
+        client._system_host_keys = get_host_keys()
+        if self.auto_add_host_policy:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        started = monotonic()
+        sock, watchdog, expired = self.sock, None, threading.Event()
+        try:
+            with span('connect', 'ssh', host=self.hostname, port=self.port):
+                if self.deadline is not None:
+                    if sock is None:
+                        sock = socket.create_connection((self.host, self.port), self.deadline)
+                    # paramiko times each phase on its own, one timer bounds them all
+                    watchdog = threading.Timer(max(started + self.deadline - monotonic(), 0), _abort, (sock, expired))
+                    watchdog.daemon = True
+                    watchdog.start()
+                client.connect(self.host, self.port, self.username, self.password,
+                               pkey=self.pkey, timeout=self.timeout, sock=sock, compress=self.compress,
+                               **self._connect_args)
+        except Exception as e:
+            client.close()
+            if sock is not None and self.sock is None:
+                sock.close()
+            if expired.is_set():
+                raise Exception('Connecting to {} took over {} seconds'.format(self.hostname, self.deadline)) from e
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+        if expired.is_set():
+            # fired right as the handshake finished
+            client.close()
+            raise Exception('Connecting to {} took over {} seconds'.format(self.hostname, self.deadline))
+        SSH_CONNECT_SECONDS.observe(monotonic() - started, host=self.hostname)
+        return client
+
     def build_connect(self):
         if self.host == '127.0.0.1' and self.sock is None:
             self._exec_command = self.exec_local_command
             self.is_local = True
         else:
+            # imported here, local connections and the CLI never need it
+            import paramiko
             use_pass = self.password is not None
             try:
-                self.client.connect(self.host, self.port, self.username, self.password,
-                                    pkey=self.pkey, timeout=self.timeout, sock=self.sock, **self._connect_args)
+                if self.pooled:
+                    key = ConnectionPool.make_key(self.host, self.port, self.username, self.password,
+                                                  self.pkey, compress=self.compress, **self._connect_args)
+                    self.client = get_pool().acquire(key, self._new_client)
+                    self._pool_key = key
+                else:
+                    self.client = self._new_client()
             except paramiko.ssh_exception.AuthenticationException as e:
                 if not use_pass:
                     passwd = getpass.getpass("{}@{}'s password: ".format(self.username, self.host))
@@ -71,10 +135,23 @@ class Connection:
         self.is_connected = True
 
     def close(self):
-        self.client.close()
+        if self._sftp_sessions is not None:
+            self._sftp_sessions.close()
+            self._sftp_sessions = None
+        if self._pool_key is not None:
+            get_pool().release(self._pool_key, self.client)
+            self._pool_key = None
+        elif self.client is not None:
+            self.client.close()
+        self.client = None
         self.is_connected = False
         self._machine.connection = None
 
+    def _make_response(self, command, stdout, stderr, exit_status=None, closer=None):
+        return Response(self._machine, stdout, stderr, stream=command.stream,
+                        max_size=command.max_size, overflow=command.overflow,
+                        exit_status=exit_status, closer=closer)
+
     def exec_local_command(self, command: Command):
         p = subprocess.Popen(command.cmd, shell=True,
                              stdout=subprocess.PIPE,
@@ -82,17 +159,19 @@ class Connection:
                              bufsize=command.bufsize,
                              env=command.env
                              )
-        response = Response(self._machine, p.stdout, p.stderr)
+        response = self._make_response(command, p.stdout, p.stderr, p.wait)
         return response
 
     def exec_remote_command(self, command: Command):
+        started = monotonic()
         stdin, stdout, stderr = self.client.exec_command(
             command.cmd,
             bufsize=command.bufsize,
             timeout=command.timeout,
             environment=command.env
         )
-        response = Response(self._machine, stdout, stderr)
+        CHANNEL_OPEN_SECONDS.observe(monotonic() - started, host=self.hostname)
+        response = self._make_response(command, stdout, stderr, stdout.channel.recv_exit_status)
         return response
 
     def ensure_connect(func):
@@ -105,66 +184,34 @@ class Connection:
 
     @ensure_connect
     def exec_command(self, command: Command):
-        return self._exec_command(command)
+        with span('run', 'command', host=self.hostname, cmd=command.cmd):
+            if not Setting.METRICS or command.stream:
+                return self._exec_command(command)
+            started = monotonic()
+            response = self._exec_command(command)
+            COMMAND_SECONDS.observe(monotonic() - started, host=self.hostname)
+            OUTPUT_BYTES.inc(response.output_size, host=self.hostname)
+            return response
 
-    @ensure_connect
     async def exec_async_command(self, command: Command):
-        status = True
-
-        async def _read(chan):
-            future = asyncio.Future()
-            loop = asyncio.get_event_loop()
-
+        loop = asyncio.get_event_loop()
+        with span('run_async', 'command', host=self.hostname, cmd=command.cmd):
+            if not self.is_connected:
+                await loop.run_in_executor(None, propagate(self.build_connect))
             if self.is_local:
-                def on_read():
-                    chunk = chan.read()
-                    future.set_result(chunk)
+                session = await open_process_session(command)
             else:
-                def on_read():
-                    if chan.recv_stderr_ready():
-                        status = False
-                        chunk = chan.recv_stderr(len(chan.in_stderr_buffer))
-                    else:
-                        chunk = chan.recv(len(chan.in_buffer))
-                    future.set_result(chunk)
-
-            loop.add_reader(chan.fileno(), on_read)
-
-            chunk = await future
-            loop.remove_reader(chan.fileno())
-            return chunk
-
-        async def _read_all(chan):
-            chunks = []
-            chunk = await _read(chan)
-            while chunk:
-                chunks.append(chunk)
-                chunk = await _read(chan)
-            return b''.join(chunks)
-
-        if self.is_local:
-            p = subprocess.Popen(command.cmd, shell=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT,
-                                 bufsize=command.bufsize,
-                                 env=command.env
-                                 )
-            chan = p.stdout
-        else:
-            transport = self.client.get_transport()
-            chan = transport.open_session()
-            chan.setblocking(0)
-            chan.exec_command(command.cmd)
-
-        data = await _read_all(chan)
-        if status is True:
-            response = Response(self._machine, BytesIO(data), BytesIO())
-        else:
-            response = Response(self._machine, BytesIO(), BytesIO(data))
-        return response
+                session = await open_channel_session(self.client.get_transport(), command)
+
+            if command.stream:
+                return self._make_response(command, session.stdout, session.stderr,
+                                           session.exit_status, session.cancel)
+            stdout, stderr, status = await session.communicate()
+            return self._make_response(command, BytesIO(stdout), BytesIO(stderr), status)
 
     @property
     def sftp(self):
+        import paramiko
         try:
             with self as ssh:
                 transport = ssh.get_transport()
@@ -173,6 +220,15 @@ class Connection:
         except:
             raise Exception('failed to establish sftp')
 
+    @property
+    def sftp_sessions(self):
+        """`SFTPSessions` kept on the transport of this connection for transfers.
+        """
+        if self._sftp_sessions is None:
+            with self as ssh:
+                self._sftp_sessions = SFTPSessions(ssh.get_transport)
+        return self._sftp_sessions
+
     @ensure_connect  # `with` statement for connection check
     def __enter__(self):
         return self.client
@@ -182,4 +238,9 @@ class Connection:
 
     _exec_command = exec_remote_command
 
-    __del__ = close
+    def __del__(self):
+        # pooled clients are given back by the pool itself, `close` them explicitly to return them at once
+        if getattr(self, '_pool_key', None) is not None:
+            get_pool().release_later(self._pool_key, self.client)
+        elif getattr(self, 'client', None) is not None:
+            self.client.close()
@@ -2,15 +2,26 @@ import atexit
 import logging
 import multiprocessing as mp
 import os
+import shutil
 import sys
 import selectors
 import signal
+import socket
+import struct
+import tempfile
 import weakref
-from time import sleep
+from array import array
+from collections import deque
+from multiprocessing.reduction import ForkingPickler
+from time import monotonic
 
+from flowlight.core.pidfile import get_pid
 from flowlight.core.setting import Setting
-from flowlight.constants import EVENT_CLOSE, EVENT_LOG
-from flowlight.core.worker import WorkerProxy
+from flowlight.constants import (
+    EVENT_CLOSE, EVENT_LOG, EVENT_CONNECTION, EVENT_BACKLOG, EVENT_IDLE, EVENT_STEAL, EVENT_TASKS, EVENT_DONE,
+    EVENT_STATS, EVENT_DRAIN,
+)
+from flowlight.core.worker import WorkerProxy, WorkerLoad, set_wakeup_fd
 
 
 __all__ = ['Manager']
@@ -33,12 +44,76 @@ class ManagerSetting:
         return self.__settings.get(key, None)
 
 
+def _frame(event, msg):
+    # framed the way `Connection.recv` reads it
+    data = bytes(ForkingPickler.dumps((event, msg)))
+    return struct.pack('!i', len(data)) + data
+
+
 class ChildManager:
-    def __init__(self, pid, parent_conn):
+    def __init__(self, pid, parent_conn, slot=0):
         self.pid = pid
         self.conn = parent_conn
+        self.slot = slot
+        self.started = monotonic()
+        # messages the pipe didn't take yet, each with the socket handed over after it
+        self.outbox = deque()
+        self.buffered = 0
+        self.writing = False
+        self._sock = socket.fromfd(parent_conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+        # last stats reported, since when the worker is idle and when its draining times out
+        self.stats = None
+        self.idle_since = None
+        self.drain_deadline = None
+
+    @property
+    def draining(self):
+        return self.drain_deadline is not None
+
+    def send(self, data, handle=None):
+        """Send what the pipe takes without blocking, the rest waits in the outbox
+        until the pipe is writable again. Returns whether the outbox is empty.
+        """
+        self.outbox.append([memoryview(data), handle])
+        self.buffered += len(data)
+        if len(self.outbox) == 1:
+            return self.flush()
+        return False
+
+    def flush(self):
+        outbox = self.outbox
+        try:
+            while outbox:
+                entry = outbox[0]
+                data, handle = entry
+                if data:
+                    sent = self._sock.send(data, socket.MSG_DONTWAIT)
+                    self.buffered -= sent
+                    entry[0] = data[sent:]
+                    continue
+                if handle is not None:
+                    # what `send_handle` does, `recv_handle` reads it
+                    fds = array('i', [handle.fileno()])
+                    self._sock.sendmsg([b'\x01'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)], socket.MSG_DONTWAIT)
+                    handle.close()
+                outbox.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # the worker is gone, its pipe reports it to the manager's loop
+            self._drop()
+        return not outbox
+
+    def _drop(self):
+        for _, handle in self.outbox:
+            if handle is not None:
+                handle.close()
+        self.outbox.clear()
+        self.buffered = 0
 
     def close(self):
+        self._drop()
+        self._sock.close()
         self.conn.close()
 
 
@@ -53,9 +128,21 @@ class Manager:
         self._workers = {}
         self.host = addr[0]
         self.port = addr[1]
-        self.selector = selectors.SelectSelector()
+        self.selector = selectors.DefaultSelector()
         self._stopped = False
+        self._signal_recv = self._signal_send = None
         self.settings = ManagerSetting()
+        # the listening socket is only used when `WORKER_BALANCE` is `manager`
+        self.server_socket = None
+        self.load = None
+        self._slots = {}
+        self._stealing = set()
+        self._relayed = {}
+        # stolen tasks and their results go through files there, the pipes only carry their ids
+        self.spool = None
+        # slots of crashed workers waiting to be forked again, and the next autoscaling round
+        self._respawn = set()
+        self._next_tick = None
 
         self.stdin = stdin
         self.stdout = stdout
@@ -78,17 +165,27 @@ class Manager:
         with open(Setting.PID_FILE, 'w') as pidfile:
             pidfile.write('{}'.format(os.getpid()))
     
-    def _new_worker(self):
+    def _new_worker(self, slot=0):
         parent_pipe, child_pipe = mp.Pipe()
         self.selector.register(parent_pipe, selectors.EVENT_READ, self._handle_event)
         pid = os.fork()
         if not pid:
             parent_pipe.close()
-            worker = WorkerProxy(weakref.proxy(self), child_pipe)
+            for sibling in self._workers.values():
+                sibling.close()
+            if self._signal_recv is not None:
+                self._signal_recv.close()
+                self._signal_send.close()
+            if self.server_socket is not None:
+                self.server_socket.close()
+            worker = WorkerProxy(weakref.proxy(self), child_pipe, slot)
             worker.run()
         else:
-            self._workers[parent_pipe.fileno()] = ChildManager(pid, parent_pipe)
+            child = ChildManager(pid, parent_pipe, slot)
+            self._workers[parent_pipe.fileno()] = child
+            self._slots[slot] = child
             child_pipe.close()
+            self._rebalance(thief=slot)
             return
 
     def _sighup_handler(self, frame, num):
@@ -104,10 +201,138 @@ class Manager:
         signal.signal(signal.SIGHUP, self._sighup_handler)
         signal.signal(signal.SIGINT, self._sigint_handler)
         signal.signal(signal.SIGTERM, self._sigterm_handler)
+        # the handlers only set flags, the wakeup fd gets the loop out of `select` to see them
+        self._signal_recv, self._signal_send = socket.socketpair()
+        self._signal_recv.setblocking(False)
+        self._signal_send.setblocking(False)
+        set_wakeup_fd(self._signal_send.fileno())
+        self.selector.register(self._signal_recv, selectors.EVENT_READ, self._handle_wakeup)
+
+    def _handle_wakeup(self, key, mask):
+        try:
+            while self._signal_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    @property
+    def _max_workers(self):
+        return max(self.settings['WORKER_MAX_NUM'] or 0, self.settings['WORKER_NUM'])
 
     def _create_workers(self):
+        self.load = WorkerLoad(self._max_workers)
+        if self.settings['WORKER_STEAL']:
+            self.spool = tempfile.mkdtemp(prefix='flowlight-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        if self.settings['WORKER_BALANCE'] == 'manager':
+            self._create_listener()
         for i in range(self.settings['WORKER_NUM']):
-            self._new_worker()
+            self._new_worker(i)
+        if self._max_workers > self.settings['WORKER_NUM']:
+            self._next_tick = monotonic() + self.settings['WORKER_SCALE_INTERVAL']
+            self._request_stats()
+
+    def _create_listener(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(socket.SOMAXCONN)
+        server_socket.setblocking(False)
+        self.server_socket = server_socket
+        self.selector.register(server_socket, selectors.EVENT_READ, self._handle_connection)
+
+    def _active(self):
+        return [child for child in self._slots.values() if not child.draining]
+
+    def _writable(self, child):
+        # a worker which doesn't read its pipe gets nothing new until it caught up
+        return child.buffered < self.settings['WORKER_PIPE_BUFFER']
+
+    def _pick_worker(self):
+        def _load(child):
+            queued, running, connections = self.load.get(child.slot)
+            return queued + running, connections
+        active = self._active()
+        return min([child for child in active if self._writable(child)] or active, key=_load)
+
+    def _handle_connection(self, key, mask):
+        while True:
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.error('accept failed: {}'.format(e))
+                return
+            if not self._active():
+                client_socket.close()
+                continue
+            child = self._pick_worker()
+            # the socket itself follows the message, it is closed here once sent
+            self._write(child, _frame(EVENT_CONNECTION, addr), client_socket)
+            self.load.handed(child.slot)
+
+    def _rebalance(self, owner=None, thief=None):
+        """Have an idle worker take over part of the backlog of a busy one.
+        """
+        if not self.settings['WORKER_STEAL']:
+            return
+        max_running = self.settings['MAX_EXECUTE_THREADS']
+
+        def _free(slot):
+            queued, running, _ = self.load.get(slot)
+            if queued or slot in self._stealing:
+                return 0
+            return max_running - running
+
+        slots = [child.slot for child in self._active() if self._writable(child)]
+        if thief not in slots and thief is not None:
+            return
+        if thief is None:
+            thief = max(slots, key=_free, default=None)
+        if owner is None:
+            owner = max(slots, key=lambda slot: self.load.get(slot)[0], default=None)
+        if thief is None or owner is None or thief == owner:
+            return
+        free, queued = _free(thief), self.load.get(owner)[0]
+        if free <= 0 or queued <= 0:
+            return
+        self._stealing.add(thief)
+        self._send(owner, EVENT_STEAL, (thief, min(free, (queued + 1) // 2)))
+
+    def _send(self, slot, event, msg):
+        child = self._slots.get(slot)
+        if child is None:
+            return False
+        self._write(child, _frame(event, msg))
+        return True
+
+    def _write(self, child, data, handle=None):
+        # the manager never blocks on a pipe, a worker may be busy sending to it
+        if not child.send(data, handle) and not child.writing:
+            self._set_writing(child, True)
+
+    def _set_writing(self, child, writing):
+        child.writing = writing
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        self.selector.modify(child.conn, events, self._handle_event)
+
+    def _relay_tasks(self, owner, thief, tasks):
+        self._stealing.discard(thief)
+        if not tasks:
+            return
+        if self._send(thief, EVENT_TASKS, (owner, tasks)):
+            self._relayed.setdefault(thief, set()).update((owner, task_id) for task_id in tasks)
+        else:
+            for task_id in tasks:
+                self._fail_task(owner, task_id)
+
+    def _relay_done(self, thief, owner, task_id, ok):
+        self._relayed.get(thief, set()).discard((owner, task_id))
+        self._send(owner, EVENT_DONE, (task_id, ok))
+
+    def _fail_task(self, owner, task_id):
+        # the owner fails the task, no result comes
+        self._send(owner, EVENT_DONE, (task_id, None))
 
     def _handle_log(self, log):
         level, msg = log
@@ -115,20 +340,123 @@ class Manager:
 
     def _handle_event(self, key, mask):
         conn = key.fileobj
-        event, msg = conn.recv()
-        if event == EVENT_LOG:
-            self._handle_log(msg)
+        child = self._workers.get(conn.fileno())
+        if mask & selectors.EVENT_WRITE and child is not None and child.flush():
+            self._set_writing(child, False)
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            while conn.poll():
+                event, msg = conn.recv()
+                if event == EVENT_LOG:
+                    self._handle_log(msg)
+                elif event == EVENT_BACKLOG:
+                    self._rebalance(owner=msg)
+                elif event == EVENT_IDLE:
+                    self._rebalance(thief=msg)
+                elif event == EVENT_TASKS:
+                    self._relay_tasks(*msg)
+                elif event == EVENT_DONE:
+                    self._relay_done(child.slot, *msg)
+                elif event == EVENT_STATS:
+                    child.stats = msg[1]
+        except (EOFError, OSError):
+            self._lost_worker(conn)
+
+    def _lost_worker(self, conn):
+        self.selector.unregister(conn)
+        child = self._workers.pop(conn.fileno(), None)
+        if child is None:
+            conn.close()
+            return
+        child.close()
+        self._slots.pop(child.slot, None)
+        self._stealing.discard(child.slot)
+        self.load.reset(child.slot)
+        for owner, task_id in self._relayed.pop(child.slot, ()):
+            self._fail_task(owner, task_id)
+        os.waitpid(child.pid, 0)
+        if child.draining:
+            self.logger.info('worker {} drained'.format(child.pid))
+            return
+        self.logger.error('worker {} exited'.format(child.pid))
+        if self._stopped:
+            return
+        if monotonic() - child.started > 1:
+            self._new_worker(child.slot)
+        else:
+            # crashed right after it started, don't fork it again in a tight loop
+            self._respawn.add(child.slot)
+            self._next_tick = min(self._next_tick or float('inf'),
+                                  monotonic() + self.settings['WORKER_SCALE_INTERVAL'])
+
+    def _free_slot(self):
+        return min(set(range(self._max_workers)) - set(self._slots))
+
+    def _request_stats(self):
+        for child in self._active():
+            if self._writable(child):
+                self._send(child.slot, EVENT_STATS, None)
+
+    def _autoscale(self, now):
+        """Fork a worker when tasks wait longer than `WORKER_SCALE_WAIT`,
+        drain one which stayed idle for `WORKER_IDLE_TIMEOUT`.
+        """
+        settings = self.settings
+        active = self._active()
+        stats = [child.stats for child in active if child.stats is not None]
+        if not stats:
+            return
+        queued = sum(s['queued'] for s in stats)
+        finished = sum(s['finished'] for s in stats)
+        execute = sum(s['execute'] * s['finished'] for s in stats) / finished if finished else 0.0
+        # how long the backlog takes to clear, and how long the tasks started lately waited
+        expected = queued * execute / (len(active) * settings['MAX_EXECUTE_THREADS'])
+        wait = max(max(s['wait'] for s in stats), expected)
+        for child in active:
+            busy = child.stats is None or any(child.stats[k] for k in ('queued', 'running', 'finished'))
+            child.idle_since = None if busy else (child.idle_since or now)
+        if wait > settings['WORKER_SCALE_WAIT'] and len(self._slots) < self._max_workers:
+            slot = self._free_slot()
+            self.logger.info('forking worker {}, tasks wait {:.3f}s'.format(slot, wait))
+            self._new_worker(slot)
+        elif len(active) > settings['WORKER_NUM'] and not queued:
+            idle = [child for child in active if child.idle_since is not None
+                    and now - child.idle_since > settings['WORKER_IDLE_TIMEOUT']]
+            if idle:
+                child = max(idle, key=lambda child: child.slot)
+                self.logger.info('draining idle worker {}'.format(child.pid))
+                child.drain_deadline = now + settings['WORKER_DRAIN_TIMEOUT']
+                self._send(child.slot, EVENT_DRAIN, None)
+
+    def _tick(self):
+        now = monotonic()
+        for slot in sorted(self._respawn):
+            if slot not in self._slots:
+                self._new_worker(slot)
+        self._respawn.clear()
+        for child in list(self._slots.values()):
+            if child.draining and now > child.drain_deadline:
+                # the clients didn't let go in time
+                self._send(child.slot, EVENT_CLOSE, '')
+        if self._max_workers > self.settings['WORKER_NUM']:
+            self._autoscale(now)
+            self._request_stats()
+            self._next_tick = now + self.settings['WORKER_SCALE_INTERVAL']
+        else:
+            self._next_tick = None
 
     def _loop(self):
         selector = self.selector
         while not self._stopped:
-            events = selector.select(0.5)
-            if events:
-                for key, mask in events:
-                    callback = key.data
-                    callback(key, mask)
-            else:
-                sleep(1)
+            timeout = None
+            if self._next_tick is not None:
+                timeout = max(self._next_tick - monotonic(), 0)
+            for key, mask in selector.select(timeout):
+                callback = key.data
+                callback(key, mask)
+            if self._next_tick is not None and monotonic() >= self._next_tick:
+                self._tick()
 
     def _daemonize(self):
         pid = os.fork()
@@ -151,11 +479,7 @@ class Manager:
 
     @classmethod
     def get_pid(cls):
-        if not os.path.exists(Setting.PID_FILE):
-            return None
-        with open(Setting.PID_FILE) as pidfile:
-            pid = pidfile.read()
-            return int(pid)
+        return get_pid()
 
     def run(self, daemon=False):
         if self.get_pid() is not None:
@@ -173,6 +497,9 @@ class Manager:
         self._stopped = True
 
     def _free_workers(self):
+        if self.server_socket is not None:
+            self.selector.unregister(self.server_socket)
+            self.server_socket.close()
         childs = list(self._workers.values())
         for child in childs:
             fd = child.conn.fileno()
@@ -180,11 +507,11 @@ class Manager:
                 self.selector.unregister(child.conn)
             except:
                 pass
-            try:
-                child.conn.send((EVENT_CLOSE, ''))
-                child.close()
-            except IOError:
-                pass
+            # a worker which can't take it sees the pipe closing
+            child.send(_frame(EVENT_CLOSE, ''))
+            child.close()
             if fd in self._workers:
                 del self._workers[fd]
             os.waitpid(child.pid, 0)
+        if self.spool is not None:
+            shutil.rmtree(self.spool, ignore_errors=True)
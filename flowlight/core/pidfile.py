@@ -0,0 +1,12 @@
+import os
+
+from flowlight.core.setting import Setting
+
+
+def get_pid():
+    """Pid of the running manager read from `Setting.PID_FILE`, `None` if there is none.
+    """
+    if not os.path.exists(Setting.PID_FILE):
+        return None
+    with open(Setting.PID_FILE) as pidfile:
+        return int(pidfile.read())
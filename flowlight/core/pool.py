@@ -0,0 +1,205 @@
+import atexit
+import hashlib
+import threading
+from collections import deque
+from time import time
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['ConnectionPool', 'get_pool']
+
+
+class _PooledClient:
+    __slots__ = ['client', 'refs', 'last_used', 'last_checked']
+
+    def __init__(self, client):
+        self.client = client
+        self.refs = 0
+        self.last_used = self.last_checked = time()
+
+
+class ConnectionPool:
+    """A process-wide pool of connected `paramiko.SSHClient`, shared by every `Connection`
+    with the same (host, port, username, auth) so SSH handshakes are paid only once.
+
+    Channels are multiplexed on the pooled transports, an idle client is handed out
+    first, then a new transport is opened until `max_per_host` is reached, after
+    that the least used transport is shared.
+
+    :param max_per_host: max transports kept for one key.
+    :param idle_timeout: seconds an unused transport stays in the pool.
+    :param check_interval: seconds between two health checks of an idle transport.
+
+    Usage::
+
+        >>> pool = ConnectionPool(max_per_host=2)
+        >>> key = pool.make_key('host1', 22, 'root', password='root')
+        >>> client = pool.acquire(key, connect_func)
+        >>> pool.release(key, client)
+    """
+    def __init__(self, max_per_host=None, idle_timeout=None, check_interval=None):
+        self.max_per_host = max_per_host or Setting.POOL_MAX_PER_HOST
+        self.idle_timeout = idle_timeout if idle_timeout is not None else Setting.POOL_IDLE_TIMEOUT
+        self.check_interval = check_interval if check_interval is not None else Setting.POOL_CHECK_INTERVAL
+        self._entries = {}
+        self._pending = {}
+        self._released = deque()
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def make_key(host, port, username, password=None, pkey=None, **extra):
+        if pkey is not None:
+            auth = 'pkey:' + pkey.get_fingerprint().hex()
+        elif password is not None:
+            auth = 'password:' + hashlib.sha256(password.encode()).hexdigest()
+        else:
+            auth = None
+        return (host, port, username, auth) + tuple(sorted((k, repr(v)) for k, v in extra.items()))
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def _close(clients):
+        for client in clients:
+            client.close()
+
+    def _purge(self, now):
+        """Drop the dead and the expired idle clients, return them to be closed
+        once the lock is released.
+        """
+        evicted = []
+        while self._released:
+            evicted.extend(self._unhold(*self._released.popleft()))
+        for key in list(self._entries):
+            entries = []
+            for entry in self._entries[key]:
+                idle = entry.refs == 0 and now - entry.last_used > self.idle_timeout
+                if idle or not self._is_alive(entry.client):
+                    evicted.append(entry.client)
+                else:
+                    entries.append(entry)
+            if entries:
+                self._entries[key] = entries
+            else:
+                del self._entries[key]
+        return evicted
+
+    def _remove(self, key, entry):
+        entries = self._entries.get(key, [])
+        if entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self._entries[key]
+
+    def _probe(self, key, entry):
+        """Send an ignore message on a client taken out of the pool, outside the lock
+        so a stalled transport blocks only its borrower. A dead client is dropped.
+        """
+        try:
+            entry.client.get_transport().send_ignore()
+        except Exception:
+            with self._cond:
+                self._remove(key, entry)
+                self._cond.notify_all()
+            entry.client.close()
+            return False
+        return True
+
+    def _pick(self, key):
+        """Hold a client of `key` to hand out, or reserve a slot for a new one and return `None`.
+        """
+        while True:
+            entries = self._entries.get(key, [])
+            idle = [e for e in entries if e.refs == 0]
+            if idle:
+                return self._hold(idle[0])
+            if len(entries) + self._pending.get(key, 0) < self.max_per_host:
+                self._pending[key] = self._pending.get(key, 0) + 1
+                return None
+            if entries:
+                return self._hold(min(entries, key=lambda e: e.refs))
+            self._cond.wait()
+
+    def acquire(self, key, factory):
+        """Return a connected client for `key`, `factory` is called to build one
+        when nothing can be reused.
+        """
+        while True:
+            with self._cond:
+                evicted = self._purge(time())
+                entry = self._pick(key)
+                now = time()
+                probe = entry is not None and entry.refs == 1 and now - entry.last_checked > self.check_interval
+                if probe:
+                    entry.last_checked = now
+            self._close(evicted)
+            if entry is None:
+                break
+            if not probe or self._probe(key, entry):
+                return entry.client
+        entry = None
+        try:
+            entry = _PooledClient(factory())
+        finally:
+            with self._cond:
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+                if entry is not None:
+                    self._entries.setdefault(key, []).append(self._hold(entry))
+                self._cond.notify_all()
+        return entry.client
+
+    def _hold(self, entry):
+        entry.refs += 1
+        entry.last_used = time()
+        return entry
+
+    def _unhold(self, key, client):
+        for entry in self._entries.get(key, []):
+            if entry.client is client:
+                entry.refs -= 1
+                entry.last_used = time()
+                return []
+        return [client]
+
+    def release(self, key, client):
+        with self._cond:
+            evicted = self._unhold(key, client)
+            evicted.extend(self._purge(time()))
+            self._cond.notify_all()
+        self._close(evicted)
+
+    def release_later(self, key, client):
+        """`release` for finalizers, which may run while this thread holds the pool lock,
+        the client is given back by the next call to the pool.
+        """
+        self._released.append((key, client))
+
+    def clear(self):
+        with self._cond:
+            evicted = [entry.client for entries in self._entries.values() for entry in entries]
+            self._entries.clear()
+        self._close(evicted)
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(entries) for entries in self._entries.values())
+
+
+__pool = None
+__pool_lock = threading.Lock()
+
+
+def get_pool():
+    global __pool
+    if __pool is None:
+        with __pool_lock:
+            if __pool is None:
+                __pool = ConnectionPool()
+                atexit.register(__pool.clear)
+    return __pool
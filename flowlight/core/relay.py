@@ -0,0 +1,163 @@
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import closing
+
+from flowlight.core.setting import Setting
+from flowlight.core.transfer import Transfer
+from flowlight.exceptions import RemoteWorkerNotRunning, RelaySourceError
+from flowlight.utils.executor import fan_out
+from flowlight.utils.remote import get_session
+
+
+__all__ = ['distribute']
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(Setting.RELAY_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _probe(path, digest):
+    """Whether `path` already holds the file, runs on the workers.
+    """
+    return os.path.isfile(path) and _digest(path) == digest
+
+
+def _commit(path, digest):
+    """Check the `.part` file and move it in place, runs on the workers.
+    """
+    part = path + '.part'
+    if _digest(part) != digest:
+        os.remove(part)
+        raise IOError('Checksum mismatch of {}'.format(part))
+    os.replace(part, path)
+    return os.stat(path).st_size
+
+
+def _read_range(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _pull(host, port, path, digest, size, block_size, window):
+    """Copy `path` from the workers on `host` to this machine, runs on the workers.
+
+    A `.part` file left by an interrupted pull is resumed, `window` reads are in flight at once.
+    """
+    try:
+        session = get_session(host, port)
+    except RemoteWorkerNotRunning as e:
+        raise RelaySourceError(str(e))
+    with open(path + '.part', 'ab') as part:
+        offset = part.tell()
+        if offset > size:
+            part.truncate(0)
+            offset = 0
+        reads = deque()
+        while offset < size or reads:
+            while offset < size and len(reads) < window:
+                length = min(block_size, size - offset)
+                reads.append(session.submit(_read_range, path, offset, length))
+                offset += length
+            try:
+                data = reads.popleft().result()
+            except (RemoteWorkerNotRunning, EOFError, OSError) as e:
+                raise RelaySourceError('{} went away: {}'.format(host, e))
+            if not data:
+                raise IOError('{} on {} is shorter than expected'.format(path, host))
+            part.write(data)
+    return _commit(path, digest)
+
+
+def distribute(machines, localpath, remotepath, seeds=None):
+    """Copy `localpath` to `remotepath` on every machine, relayed by the machines themselves.
+
+    The file goes over SFTP to a few seed machines only, every machine holding it
+    then serves one machine lacking it through the flowlight workers, so the holders
+    double at each round and the total time grows with log(N) rather than N.
+    Machines already holding the file are skipped, a pull resumes from the `.part`
+    file an earlier one left, and every copy is checked against the sha256 of
+    `localpath` before it is moved in place.
+
+    Every machine needs running workers, reachable from the others on `Setting.PORT`.
+
+    :param seeds: machines copied from here, defaults to `Setting.RELAY_SEEDS`.
+    :return: a dict from `id(machine)` to the size copied or the exception of its failure.
+    """
+    machines = list({id(machine): machine for machine in machines}.values())
+    digest = _digest(localpath)
+    size = os.stat(localpath).st_size
+    results = {}
+    holders = deque()
+    waiting = deque()
+
+    with closing(fan_out(lambda machine: machine.run_remote_callable(_probe, remotepath, digest),
+                         machines)) as completed:
+        for machine, future in completed:
+            exc = future.exception()
+            if exc is not None:
+                results[id(machine)] = exc
+            elif future.result():
+                results[id(machine)] = size
+                holders.append(machine)
+    waiting.extend(machine for machine in machines if id(machine) not in results)
+
+    def _seed(machine):
+        Transfer(machine.connection).put(localpath, remotepath + '.part')
+        return machine.run_remote_callable(_commit, remotepath, digest)
+
+    # only machines with an SSH connection can be seeded from here
+    candidates = deque(machine for machine in waiting if machine.connection is not None)
+    while candidates and not holders:
+        batch = [candidates.popleft() for _ in range(min(seeds or Setting.RELAY_SEEDS, len(candidates)))]
+        for machine in batch:
+            waiting.remove(machine)
+        with closing(fan_out(_seed, batch)) as completed:
+            for machine, future in completed:
+                exc = future.exception()
+                results[id(machine)] = exc or future.result()
+                if exc is None:
+                    holders.append(machine)
+
+    attempts = {}
+    running = {}
+    while waiting and holders or running:
+        while waiting and holders:
+            source, target = holders.popleft(), waiting.popleft()
+            try:
+                future = target.submit_remote_callable(
+                    _pull, source.host, Setting.PORT, remotepath, digest, size,
+                    Setting.RELAY_BLOCK_SIZE, Setting.RELAY_WINDOW
+                )
+            except RemoteWorkerNotRunning as e:
+                results[id(target)] = e
+                holders.appendleft(source)
+                continue
+            running[future] = (source, target)
+        if not running:
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            source, target = running.pop(future)
+            exc = future.exception()
+            if exc is None:
+                results[id(target)] = future.result()
+                holders.extend((source, target))
+                continue
+            if not isinstance(exc, RelaySourceError):
+                holders.append(source)
+            attempts[id(target)] = attempts.get(id(target), 0) + 1
+            if attempts[id(target)] < Setting.RELAY_RETRIES:
+                waiting.append(target)
+            else:
+                results[id(target)] = exc
+
+    for machine in waiting:
+        results[id(machine)] = RelaySourceError('No machine left to relay from')
+    return results
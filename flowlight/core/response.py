@@ -1,3 +1,176 @@
+import inspect
+import io
+import os
+from collections import deque
+from io import BytesIO
+from tempfile import TemporaryFile
+
+from flowlight.core.setting import Setting
+
+
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_TRUNCATE = 'truncate'
+
+
+def _read_available(source, size):
+    read1 = getattr(source, 'read1', None)
+    if read1 is not None:
+        return read1(size)
+    # paramiko's `BufferedFile.read` blocks until `size` bytes arrived,
+    # `_read` returns whatever the channel already has.
+    raw_read = getattr(source, '_read', None)
+    if raw_read is not None:
+        return raw_read(size)
+    return source.read(size)
+
+
+class _LineSplitter:
+    def __init__(self, keepends=False):
+        self.keepends = keepends
+        self._pending = b''
+
+    def feed(self, chunk):
+        lines = (self._pending + chunk).split(b'\n')
+        self._pending = lines.pop()
+        if self.keepends:
+            return [line + b'\n' for line in lines]
+        return [line.rstrip(b'\r') for line in lines]
+
+    def flush(self):
+        pending, self._pending = self._pending, b''
+        return [pending] if pending else []
+
+
+class _AsyncChunks:
+    """Chunks read from an asyncio stream of a response, for `async for`.
+    """
+    def __init__(self, response, name, chunk_size):
+        self._response = response
+        self._name = name
+        self._chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        source = self._response._sources[self._name]
+        if not source:
+            raise StopAsyncIteration
+        chunk = await source.read(self._chunk_size)
+        if not chunk:
+            self._response._sources[self._name] = b''
+            raise StopAsyncIteration
+        return chunk
+
+
+class _AsyncLines:
+    """Lines split out of `_AsyncChunks`, for `async for`.
+    """
+    def __init__(self, chunks, keepends=False):
+        self._chunks = chunks
+        self._splitter = _LineSplitter(keepends)
+        self._lines = deque()
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._lines:
+            if self._done:
+                raise StopAsyncIteration
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                self._lines.extend(self._splitter.flush())
+            else:
+                self._lines.extend(self._splitter.feed(chunk))
+        return self._lines.popleft()
+
+
+class _FileView(io.RawIOBase):
+    """Reads the first `size` bytes of a file at its own offset,
+    views of the same file don't move each other.
+    """
+    def __init__(self, file, size):
+        self._file = file
+        self._size = size
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = os.pread(self._file.fileno(), min(len(buffer), max(self._size - self._offset, 0)), self._offset)
+        buffer[:len(data)] = data
+        self._offset += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._offset = max(offset, 0)
+        return self._offset
+
+    def tell(self):
+        return self._offset
+
+
+class _Capture:
+    """A bounded buffer of command output.
+
+    Reads never move a shared position, a response handed to several
+    callers by `ResultCache` can be read by all of them at once.
+
+    :param max_size: bytes kept in memory, `None` means unbounded.
+    :param overflow: `spill` the rest to a temporary file or `truncate` it.
+    """
+    def __init__(self, max_size=None, overflow=OVERFLOW_SPILL):
+        if overflow not in (OVERFLOW_SPILL, OVERFLOW_TRUNCATE):
+            raise Exception('Illegal overflow mode')
+        self.max_size = max_size
+        self.overflow = overflow
+        self.size = 0
+        self.truncated = False
+        self._buffer = BytesIO()
+
+    @property
+    def spilled(self):
+        return not isinstance(self._buffer, BytesIO)
+
+    def write(self, chunk):
+        if self.max_size is not None and self.size + len(chunk) > self.max_size:
+            if self.overflow == OVERFLOW_TRUNCATE:
+                chunk = chunk[:max(self.max_size - self.size, 0)]
+                self.truncated = True
+            elif not self.spilled:
+                spill = TemporaryFile()
+                spill.write(self._buffer.getvalue())
+                self._buffer = spill
+        self._buffer.write(chunk)
+        self.size += len(chunk)
+
+    @property
+    def file(self):
+        """A new file object reading the output from its start.
+        """
+        if not self.spilled:
+            return BytesIO(self._buffer.getvalue())
+        self._buffer.flush()
+        return io.BufferedReader(_FileView(self._buffer, self.size))
+
+    def getvalue(self):
+        if not self.spilled:
+            return self._buffer.getvalue()
+        return self.file.read()
+
+
 class Response:
     """A wrapper of executed commands' result.
 
@@ -5,6 +178,12 @@ class Response:
     :param stdin: standard input.
     :param stdout: standard output.
     :param stderr: standard error.
+    :param stream: don't read the output at once, consume it with
+            `iter_chunks`/`iter_lines` (or `async for` on async commands) instead.
+    :param max_size: bytes of each output kept in memory.
+    :param overflow: `spill` output beyond `max_size` to a temporary file or `truncate` it.
+    :param exit_status: exit status of the command, a callable or a future resolving it.
+    :param closer: called by `close` to abort a command still streaming.
 
     Usage::
 
@@ -15,13 +194,140 @@ class Response:
         >>> r = Response(Machine('127.0.0.1'), bio(b'stdout'), bio(b''))
         >>> print(r)
         stdout
+        >>> r = Response(Machine('127.0.0.1'), bio(b'a\\nb\\n'), None, stream=True)
+        >>> list(r.iter_lines())
+        [b'a', b'b']
 
+    Chunks handed out by iteration are not kept, `stdout`/`stderr` only
+    hold what was left unread.
     """
-    def __init__(self, target, stdout, stderr):
+    def __init__(self, target, stdout, stderr, stream=False, max_size=None, overflow=OVERFLOW_SPILL,
+                 exit_status=None, closer=None):
         self.target = target
-        self.stdout = stdout.read() if stdout else stdout
-        self.stderr = stderr.read() if stderr else stderr
-        self.result = self.stderr if self.stderr else self.stdout
+        self.stream = stream
+        self._exit_status = exit_status
+        self._closer = closer
+        self._sources = {'stdout': stdout, 'stderr': stderr}
+        self._captures = {
+            'stdout': _Capture(max_size, overflow),
+            'stderr': _Capture(max_size, overflow),
+        }
+        if not stream:
+            self._drain('stdout')
+            self._drain('stderr')
+
+    @staticmethod
+    def _is_async(source):
+        return inspect.iscoroutinefunction(getattr(source, 'read', None))
+
+    def _drain(self, name):
+        source = self._sources[name]
+        if not source:
+            return
+        if self._is_async(source):
+            raise Exception('Output of an async command, await `read()` first')
+        capture = self._captures[name]
+        chunk_size = Setting.RESPONSE_CHUNK_SIZE
+        chunk = source.read(chunk_size)
+        while chunk:
+            capture.write(chunk)
+            chunk = source.read(chunk_size)
+        self._sources[name] = b''
+
+    async def read(self):
+        """Read the rest of an async command's output.
+        """
+        for name, source in self._sources.items():
+            if not source:
+                continue
+            capture = self._captures[name]
+            chunk = await source.read(Setting.RESPONSE_CHUNK_SIZE)
+            while chunk:
+                capture.write(chunk)
+                chunk = await source.read(Setting.RESPONSE_CHUNK_SIZE)
+            self._sources[name] = b''
+        return self
+
+    def _value(self, name):
+        if self._sources[name] is None:
+            return None
+        self._drain(name)
+        return self._captures[name].getvalue()
+
+    @property
+    def stdout(self):
+        return self._value('stdout')
+
+    @property
+    def stderr(self):
+        return self._value('stderr')
+
+    @property
+    def result(self):
+        return self.stderr if self.stderr else self.stdout
+
+    @property
+    def exit_status(self):
+        status = self._exit_status
+        if callable(status):
+            self._exit_status = status = status()
+        elif hasattr(status, 'done'):
+            if not status.done():
+                return None
+            self._exit_status = status = status.result()
+        return status
+
+    def close(self):
+        if self._closer is not None:
+            self._closer()
+            self._closer = None
+
+    @property
+    def output_size(self):
+        """Bytes of output captured so far.
+        """
+        return sum(capture.size for capture in self._captures.values())
+
+    @property
+    def truncated(self):
+        return any(capture.truncated for capture in self._captures.values())
+
+    def output_file(self, name='stdout'):
+        """File object of the captured output, which may be spilled to disk,
+        every call returns a new one reading from the start.
+        """
+        self._drain(name)
+        return self._captures[name].file
+
+    def iter_chunks(self, chunk_size=None, name='stdout'):
+        source = self._sources[name]
+        if not source:
+            return
+        chunk_size = chunk_size or Setting.RESPONSE_CHUNK_SIZE
+        chunk = _read_available(source, chunk_size)
+        while chunk:
+            yield chunk
+            chunk = _read_available(source, chunk_size)
+        self._sources[name] = b''
+
+    def iter_lines(self, chunk_size=None, name='stdout', keepends=False):
+        splitter = _LineSplitter(keepends)
+        for chunk in self.iter_chunks(chunk_size, name):
+            yield from splitter.feed(chunk)
+        yield from splitter.flush()
+
+    def aiter_chunks(self, chunk_size=None, name='stdout'):
+        return _AsyncChunks(self, name, chunk_size or Setting.RESPONSE_CHUNK_SIZE)
+
+    def aiter_lines(self, chunk_size=None, name='stdout', keepends=False):
+        return _AsyncLines(self.aiter_chunks(chunk_size, name), keepends)
+
+    def __iter__(self):
+        return self.iter_lines()
+
+    def __aiter__(self):
+        return self.aiter_lines()
 
     def __str__(self):
         return self.result.decode()
+
@@ -1,9 +1,53 @@
 class Setting:
     PORT = 3600
     API_PORT = 3601
+    API_MAX_SESSIONS = 256
+    API_KEEPALIVE_TIMEOUT = 15
     DEFAULT_SSH_PORT = 22
+    DNS_CACHE_TTL = 300
+    CONNECT_DEADLINE = 10
     MAX_EXECUTE_THREADS = 4
+    MAX_TASK_WORKERS = 8
+    WORKER_BACKEND = 'thread'
     WORKER_NUM = 2
+    WORKER_BALANCE = 'kernel'
+    WORKER_STEAL = False
+    WORKER_PIPE_BUFFER = 1024 * 1024
+    WORKER_MAX_NUM = None
+    WORKER_SCALE_INTERVAL = 5
+    WORKER_SCALE_WAIT = 0.5
+    WORKER_IDLE_TIMEOUT = 60
+    WORKER_DRAIN_TIMEOUT = 30
     PID_FILE = '/tmp/flowlight.pid'
     WHITE_HOST_LIST = set()
     BLACK_HOST_LIST = set()
+    POOL_MAX_PER_HOST = 4
+    POOL_IDLE_TIMEOUT = 300
+    POOL_CHECK_INTERVAL = 30
+    RESPONSE_CHUNK_SIZE = 32768
+    ASYNC_BUFFER_LIMIT = 1024 * 1024
+    ASYNC_MAX_SESSIONS = 1024
+    MAX_FANOUT_THREADS = 64
+    RESULT_CACHE_SIZE = 1024
+    METRICS = False
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    TRACING = False
+    TRACE_MAX_SPANS = 100000
+    TRANSFER_MAX_SESSIONS = 4
+    TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+    TRANSFER_BLOCK_SIZE = 32768
+    DELTA_BLOCK_SIZE = 8192
+    DELTA_FRAME_SIZE = 1024 * 1024
+    DELTA_MAX_LITERAL = 0.5
+    RELAY_SEEDS = 2
+    RELAY_BLOCK_SIZE = 1024 * 1024
+    RELAY_WINDOW = 4
+    RELAY_RETRIES = 3
+    RPC_BUFFER_SIZE = 256 * 1024
+    RPC_MAX_BUFFER_SIZE = 4 * 1024 * 1024
+    RPC_COMPRESSION = None
+    RPC_COMPRESSION_THRESHOLD = 4096
+    SSH_COMPRESSION = False
+    CALLABLE_CACHE_SIZE = 128
+    STREAM_WINDOW = 64
+    STREAM_IDLE_TIMEOUT = 60
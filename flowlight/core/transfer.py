@@ -0,0 +1,256 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager, closing
+
+from flowlight.core.setting import Setting
+from flowlight.utils.executor import fan_out
+from flowlight.utils.tracing import span
+
+
+__all__ = ['SFTPSessions', 'Transfer']
+
+
+class SFTPSessions:
+    """SFTP sessions opened on one SSH transport and kept for reuse.
+
+    A session serves one thread at a time, up to `max_sessions` of them are
+    opened as channels of the same transport so parallel transfers don't pay
+    any extra handshake.
+
+    :param transport: callable returning the `paramiko.Transport` to open sessions on.
+    :param max_sessions: max sessions opened at once, defaults to `Setting.TRANSFER_MAX_SESSIONS`.
+    """
+    def __init__(self, transport, max_sessions=None):
+        self._transport = transport
+        self.max_sessions = max_sessions or Setting.TRANSFER_MAX_SESSIONS
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _is_alive(sftp):
+        channel = sftp.get_channel()
+        return channel is not None and not channel.closed
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    sftp = self._idle.pop()
+                    if self._is_alive(sftp):
+                        return sftp
+                    self._opened -= 1
+                if self._opened < self.max_sessions:
+                    self._opened += 1
+                    break
+                self._cond.wait()
+        try:
+            from paramiko import SFTPClient
+            return SFTPClient.from_transport(self._transport())
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, sftp):
+        with self._cond:
+            if self._is_alive(sftp):
+                self._idle.append(sftp)
+            else:
+                self._opened -= 1
+                sftp.close()
+            self._cond.notify()
+
+    @contextmanager
+    def session(self):
+        sftp = self.acquire()
+        try:
+            yield sftp
+        finally:
+            self.release(sftp)
+
+    def close(self):
+        with self._cond:
+            for sftp in self._idle:
+                sftp.close()
+            self._opened -= len(self._idle)
+            self._idle = []
+
+
+class _Progress:
+    def __init__(self, total, callback):
+        self.total = total
+        self.done = 0
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        if self._callback is None:
+            return
+        with self._lock:
+            self.done += size
+            self._callback(self.done, self.total)
+
+
+class Transfer:
+    """Pipelined SFTP transfers over the reused sessions of a `Connection`.
+
+    Files larger than `chunk_size` are split in ranges moved in parallel, each
+    on its own session, every range is pipelined so requests don't wait for the
+    previous acknowledgement. A local connection copies files on disk.
+
+    :param connection: the `Connection` of the remote machine.
+    :param parallel: sessions used by one file or by `put_many`/`get_many`,
+            defaults to `Setting.TRANSFER_MAX_SESSIONS`.
+    :param chunk_size: smallest range of a file moved on its own session,
+            defaults to `Setting.TRANSFER_CHUNK_SIZE`.
+
+    Usage::
+
+        >>> transfer = Transfer(machine.connection)
+        >>> transfer.put('build.tar.gz', '/tmp/build.tar.gz')
+        >>> transfer.put_many([('a.conf', '/etc/a.conf'), ('b.conf', '/etc/b.conf')])
+    """
+    def __init__(self, connection, parallel=None, chunk_size=None):
+        self.connection = connection
+        self.parallel = parallel or Setting.TRANSFER_MAX_SESSIONS
+        self.chunk_size = chunk_size or Setting.TRANSFER_CHUNK_SIZE
+        self.block_size = Setting.TRANSFER_BLOCK_SIZE
+
+    def _ranges(self, size):
+        count = max(1, min(self.parallel, size // self.chunk_size))
+        step = max(1, -(-size // count))
+        return [(offset, min(step, size - offset)) for offset in range(0, size, step)] or [(0, 0)]
+
+    def _run_ranges(self, func, ranges):
+        if len(ranges) == 1:
+            return func(ranges[0])
+        with closing(fan_out(func, ranges, len(ranges))) as completed:
+            for _, future in completed:
+                future.result()
+
+    def put(self, localpath, remotepath, callback=None, confirm=True):
+        """Copy `localpath` to `remotepath`.
+
+        :param callback: called with (bytes transferred, total bytes) as ranges progress.
+        :param confirm: check the size of the remote file once done.
+        """
+        connection = self.connection
+        if not connection.is_connected:
+            connection.build_connect()
+        if connection.is_local:
+            return self._copy(localpath, remotepath, callback)
+        size = os.stat(localpath).st_size
+        with span('put', 'sftp', host=connection.hostname, path=remotepath, size=size):
+            self._put(localpath, remotepath, size, callback, confirm)
+        return size
+
+    def _put(self, localpath, remotepath, size, callback, confirm):
+        progress = _Progress(size, callback)
+        sessions = self.connection.sftp_sessions
+        with sessions.session() as sftp:
+            # create or empty the file, ranges fill it at their offsets
+            sftp.open(remotepath, 'wb').close()
+
+        def _put_range(bounds):
+            offset, length = bounds
+            with span('put range', 'sftp', offset=offset, length=length), \
+                    sessions.session() as sftp, open(localpath, 'rb') as local:
+                with sftp.open(remotepath, 'r+b') as remote:
+                    remote.set_pipelined(True)
+                    local.seek(offset)
+                    remote.seek(offset)
+                    while length > 0:
+                        data = local.read(min(self.block_size, length))
+                        if not data:
+                            break
+                        remote.write(data)
+                        length -= len(data)
+                        progress.add(len(data))
+
+        self._run_ranges(_put_range, self._ranges(size))
+        if confirm:
+            with sessions.session() as sftp:
+                remote_size = sftp.stat(remotepath).st_size
+            if remote_size != size:
+                raise IOError('size mismatch in put! {} != {}'.format(remote_size, size))
+
+    def get(self, remotepath, localpath, callback=None):
+        """Copy `remotepath` to `localpath`.
+
+        :param callback: called with (bytes transferred, total bytes) as ranges progress.
+        """
+        connection = self.connection
+        if not connection.is_connected:
+            connection.build_connect()
+        if connection.is_local:
+            return self._copy(remotepath, localpath, callback)
+        with span('get', 'sftp', host=connection.hostname, path=remotepath):
+            return self._get(remotepath, localpath, callback)
+
+    def _get(self, remotepath, localpath, callback):
+        sessions = self.connection.sftp_sessions
+        with sessions.session() as sftp:
+            size = sftp.stat(remotepath).st_size
+        progress = _Progress(size, callback)
+        with open(localpath, 'wb') as local:
+            local.truncate(size)
+
+        def _get_range(bounds):
+            offset, length = bounds
+            blocks = [(start, min(self.block_size, offset + length - start))
+                      for start in range(offset, offset + length, self.block_size)]
+            if not blocks:
+                return
+            with span('get range', 'sftp', offset=offset, length=length), \
+                    sessions.session() as sftp, open(localpath, 'r+b') as local:
+                with sftp.open(remotepath, 'rb') as remote:
+                    local.seek(offset)
+                    for data in remote.readv(blocks):
+                        local.write(data)
+                        progress.add(len(data))
+
+        self._run_ranges(_get_range, self._ranges(size))
+        if os.stat(localpath).st_size != size:
+            raise IOError('size mismatch in get! {} != {}'.format(os.stat(localpath).st_size, size))
+        return size
+
+    def _copy(self, source, target, callback):
+        shutil.copyfile(source, target)
+        size = os.stat(target).st_size
+        if callback is not None:
+            callback(size, size)
+        return size
+
+    def _many(self, func, pairs, max_workers):
+        """Run `func` on every (source, target) pair, raise the first failure once all are done.
+        """
+        sizes = {}
+        error = None
+        jobs = list(enumerate(pairs))
+        with closing(fan_out(lambda job: func(*job[1]), jobs, max_workers or self.parallel)) as completed:
+            for (index, _), future in completed:
+                exc = future.exception()
+                if exc is not None:
+                    error = error or exc
+                else:
+                    sizes[index] = future.result()
+        if error is not None:
+            raise error
+        return [sizes[index] for index, _ in jobs]
+
+    def put_many(self, pairs, max_workers=None):
+        """Copy every (localpath, remotepath) of `pairs` at once, return their sizes.
+
+        :param max_workers: files moved at once, defaults to `parallel`.
+        """
+        return self._many(self.put, pairs, max_workers)
+
+    def get_many(self, pairs, max_workers=None):
+        """Copy every (remotepath, localpath) of `pairs` at once, return their sizes.
+
+        :param max_workers: files moved at once, defaults to `parallel`.
+        """
+        return self._many(self.get, pairs, max_workers)
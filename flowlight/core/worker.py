@@ -1,67 +1,437 @@
+import hashlib
 import logging
+import multiprocessing as mp
 import selectors 
+import signal
 import socket
-import struct
 import os
+import pickle
+import sys
+import traceback
 
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count, islice
+from multiprocessing.reduction import recv_handle
 from queue import Queue
-from time import sleep
-from threading import Thread
+from threading import Condition, Lock, Semaphore, Thread
+from time import monotonic
 
-from flowlight.constants import EVENT_CLOSE, EVENT_LOG
+from flowlight.core.setting import Setting
+from flowlight.constants import (
+    EVENT_CLOSE, EVENT_LOG, EVENT_CONNECTION, EVENT_BACKLOG, EVENT_IDLE, EVENT_STEAL, EVENT_TASKS, EVENT_DONE,
+    EVENT_STATS, EVENT_DRAIN,
+    MSG_CALL, MSG_RESULT, MSG_ERROR, MSG_UNKNOWN_CALLABLE,
+    MSG_CHUNK, MSG_END, MSG_CREDIT, MSG_CANCEL, MSG_GOAWAY, MSG_HELLO,
+)
 from flowlight.tasks.future import TaskFuture
-from flowlight.utils.remote import RemoteCallable, dumps, loads
+from flowlight.utils.remote import Pickled, dumps, loads
+from flowlight.utils.framing import MESSAGE, CALL, CREDIT, FrameReader, frame, set_nodelay
+from flowlight.utils.compression import compress, decompress, negotiate
+from flowlight.utils import metrics
 
 
-__all__ = ['WorkerProxy']
+__all__ = ['WorkerProxy', 'WorkerLoad']
 
 STOP_SENTINEL = object()
 
 
 class RequestStore:
-    __slots__ = ['data', 'total_size', 'finish_callback']
+    """State of one client connection, the frames read so far
+    and the replies waiting to be written.
 
-    BUF_SIZE = 1024
+    Replies are pushed from worker threads, the selector loop writes
+    them out with `flush` and keeps the socket registered for writing
+    while the kernel buffer is full.
+    """
+    __slots__ = ['sock', 'selector', 'reader', 'finish_callback', 'close_callback',
+                 'closed', 'streams', 'inflight', 'draining', 'codec', '_outbox', '_lock', '_writing']
 
-    def __init__(self, finish_callback):
-        self.data = b''
-        self.total_size = 0
+    def __init__(self, sock, selector, finish_callback, close_callback):
+        self.sock = sock
+        self.selector = selector
+        self.reader = FrameReader()
         self.finish_callback = finish_callback
+        self.close_callback = close_callback
+        self.closed = False
+        # request id -> `StreamCredit` of the results being streamed
+        self.streams = {}
+        # calls read and not answered yet
+        self.inflight = 0
+        self.draining = False
+        # compression negotiated by the client
+        self.codec = None
+        self._outbox = deque()
+        self._lock = Lock()
+        self._writing = False
 
     def __call__(self, key, mask):
-        client_socket = key.fileobj
-        data = client_socket.recv(self.BUF_SIZE)
-        if not self.data:
-            self.total_size = int(struct.unpack('>i', data[:4])[0])
-            data = data[4:]
-        self.data += data
-        if len(self.data) == self.total_size:
-            self.finish_callback(client_socket, self)
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ and not self.closed:
+            try:
+                self.reader.read_from(self.sock)
+            except (EOFError, OSError):
+                self.close()
+            while self.reader.frames:
+                if self.draining:
+                    # the client sends these again on another connection
+                    self.reader.frames.clear()
+                    break
+                self.finish_callback(self)
 
     def get_data(self):
-        return self.data
+        return self.reader.frames.popleft()
+
+    def started(self):
+        with self._lock:
+            self.inflight += 1
+
+    def finished(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def goaway(self):
+        """Tell the client no more calls are read on this connection,
+        the ones sent after the last reply are to be sent elsewhere.
+        """
+        self.draining = True
+        self.push(MESSAGE.pack(0, MSG_GOAWAY))
+        self.flush()
+
+    def push(self, *parts):
+        """Queue a reply frame, thread safe.
+        """
+        with self._lock:
+            if not self.closed:
+                self._outbox.extend(memoryview(buf).cast('B') for buf in frame(*parts) if len(buf))
+
+    def flush(self):
+        with self._lock:
+            outbox = self._outbox
+            try:
+                while outbox:
+                    sent = self.sock.sendmsg(list(islice(outbox, 64)))
+                    while sent and sent >= len(outbox[0]):
+                        sent -= len(outbox.popleft())
+                    if sent:
+                        outbox[0] = outbox[0][sent:]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                outbox.clear()
+            writing = bool(outbox)
+        if self.closed:
+            return
+        if writing != self._writing:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(self.sock, events, self)
+            self._writing = writing
+
+    def close(self):
+        if self.closed:
+            return
+        with self._lock:
+            self.closed = True
+            self._outbox.clear()
+        self.reader.frames.clear()
+        for stream in list(self.streams.values()):
+            stream.cancel()
+        self.selector.unregister(self.sock)
+        self.close_callback(self)
+        self.sock.close()
+
+
+class CachedCallable:
+    """A pickled callable sent by a client, unpickled on its first call.
+    """
+    __slots__ = ['digest', 'data', '_callable']
+
+    def __init__(self, digest, data):
+        self.digest = digest
+        self.data = data
+        self._callable = None
+
+    def load(self):
+        if self._callable is None:
+            self._callable = loads(self.data)
+        return self._callable
+
+
+class CallableCache:
+    """LRU of the callables sent by clients, keyed by the digest of their pickle.
+
+    :param size: callables kept, defaults to `Setting.CALLABLE_CACHE_SIZE`.
+    """
+    def __init__(self, size=None):
+        self.size = size or Setting.CALLABLE_CACHE_SIZE
+        self._entries = OrderedDict()
+
+    def get(self, digest):
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+        return entry
+
+    def put(self, digest, data):
+        entry = self.get(digest)
+        if entry is None:
+            entry = self._entries[digest] = CachedCallable(digest, data)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StreamCredit:
+    """Items a streamed result may still send before the client takes some.
+
+    :param window: items sent ahead of the client.
+    :param timeout: seconds to wait for the client to take an item,
+            the stream is cancelled after that.
+    """
+    def __init__(self, window, timeout=None):
+        self._credits = window
+        self._timeout = timeout
+        self._cond = Condition()
+        self.cancelled = False
+        self.expired = False
+
+    def acquire(self):
+        """Block until an item may be sent, `False` once the stream is cancelled.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._credits > 0 or self.cancelled, self._timeout):
+                # the client stopped reading, don't hold the worker thread for it
+                self.cancelled = self.expired = True
+            if self.cancelled:
+                return False
+            self._credits -= 1
+            return True
+
+    def release(self, count):
+        with self._cond:
+            self._credits += count
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify()
+
+
+def _execute(entry, arguments):
+    args, kwargs = loads(arguments)
+    return entry.load()(*args, **kwargs)
+
+
+# callables unpickled in a pool process
+_process_callables = None
+
+
+def set_wakeup_fd(fd):
+    """`signal.set_wakeup_fd`, a full buffer only means a wakeup is pending already.
+    """
+    if sys.version_info >= (3, 7):
+        return signal.set_wakeup_fd(fd, warn_on_full_buffer=False)
+    return signal.set_wakeup_fd(fd)
+
+
+def _init_process():
+    """Drop the signal handling pool processes inherit from the worker, the SIGTERM
+    a broken pool sends them must not wake up the loop of the worker.
+    """
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _execute_pickled(digest, data, arguments):
+    """Entry point in pool processes, the result goes back still pickled.
+    """
+    global _process_callables
+    if _process_callables is None:
+        _init_process()
+        _process_callables = CallableCache()
+    try:
+        result = _execute(_process_callables.put(digest, data), arguments)
+        if isinstance(result, Iterator):
+            # generators can't leave the pool process, they come back as lists
+            result = list(result)
+        return True, dumps(result)
+    except Exception as e:
+        error = (e, traceback.format_exc())
+        try:
+            return False, dumps(error)
+        except Exception:
+            return False, dumps((Exception(repr(e)), error[1]))
 
 
 class Worker:
-    def __init__(self):
+    """Runs the calls queued by `WorkerProxy`, tasks are (`CachedCallable`, pickled arguments).
+
+    :param backend: `thread` runs callables on a thread pool, good for I/O bound work,
+            `process` runs them on a process pool for CPU bound work.
+    :param max_workers: callables running at once, the rest wait in the task list.
+    :param load_callback: called with (queued, running) whenever they change.
+    """
+    BACKENDS = ('thread', 'process')
+
+    def __init__(self, backend='thread', max_workers=None, load_callback=None):
+        if backend not in self.BACKENDS:
+            raise Exception('Unknown worker backend {}'.format(backend))
         self._task_list = Queue()
         self._running = True
+        self.backend = backend
+        self.max_workers = max_workers or Setting.MAX_EXECUTE_THREADS
+        self._slots = Semaphore(self.max_workers)
+        self._executor = self._new_executor()
+        self._executor_lock = Lock()
+        self._retired = []
+        self.running_count = 0
+        self._load_callback = load_callback
+        self._count_lock = Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._started = self._finished = 0
+        self._wait_time = self._execute_time = 0.0
+
+    def _count(self, running=0, wait=None, execute=None):
+        with self._count_lock:
+            self.running_count += running
+            if wait is not None:
+                self._started += 1
+                self._wait_time += wait
+                metrics.WORKER_WAIT_SECONDS.observe(wait)
+            if execute is not None:
+                self._finished += 1
+                self._execute_time += execute
+                metrics.WORKER_TASK_SECONDS.observe(execute)
+            if self._load_callback is not None:
+                self._load_callback(self.task_count(), self.running_count)
+
+    def stats(self):
+        """Load of the worker and the mean time tasks waited and ran since the last call.
+        """
+        with self._count_lock:
+            stats = {
+                'queued': self.task_count(),
+                'running': self.running_count,
+                'finished': self._finished,
+                'wait': self._wait_time / self._started if self._started else 0.0,
+                'execute': self._execute_time / self._finished if self._finished else 0.0,
+            }
+            self._reset_stats()
+        return stats
+
+    def _new_executor(self):
+        if self.backend == 'process':
+            # `initializer` is new in Python 3.7, older pools reset their signals on the first call
+            if sys.version_info >= (3, 7):
+                return ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_process)
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _replace_broken(self, broken):
+        """Swap in a new process pool for `broken`, once however many of its tasks failed.
+
+        Callbacks of a broken pool run on its management thread, which shutting the
+        pool down would wait for, so `_shutdown_retired` does it on the dispatcher thread.
+        """
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = self._new_executor()
+                self._retired.append(broken)
+            return self._executor
+
+    def _shutdown_retired(self):
+        with self._executor_lock:
+            retired, self._retired = self._retired, []
+        for executor in retired:
+            executor.shutdown(wait=False)
 
     def add_task(self, task):
         future = TaskFuture(task)
         self._task_list.put(future)
+        self._count()
         return future
 
+    def steal(self, limit):
+        """Take out up to `limit` of the tasks waiting the longest, for another worker to run.
+        """
+        stolen = []
+        with self._task_list.mutex:
+            queue = self._task_list.queue
+            while queue and len(stolen) < limit and queue[0] is not STOP_SENTINEL:
+                stolen.append(queue.popleft())
+        if stolen:
+            self._count()
+        return stolen
+
     def run(self):
         pool = self._task_list
         while True:
+            # keep the backlog in the task list until a slot is free
+            self._slots.acquire()
             future = pool.get()
             if future is STOP_SENTINEL:
                 break
-            task = future.get_task()
             future.ready()
-            result = task.callable(*task.args, **task.kwargs)
+            self._count(1, wait=future.started_at - future.created_at)
+            if self.backend == 'process':
+                self._submit_process(future)
+            else:
+                self._executor.submit(self._run_in_thread, future)
+        self._shutdown_retired()
+        self._executor.shutdown(wait=True)
+
+    def _done(self, future):
+        self._count(-1, execute=monotonic() - future.started_at)
+        self._slots.release()
+
+    def _run_in_thread(self, future):
+        try:
+            result = _execute(*future.get_task())
+        except Exception as e:
+            e.remote_traceback = traceback.format_exc()
+            future.set_exception(e)
+        else:
             future.set_result(result)
+        finally:
+            self._done(future)
+
+    def _submit_process(self, future):
+        def _callback(process_future):
+            try:
+                ok, payload = process_future.result()
+            except BrokenProcessPool as e:
+                self._replace_broken(executor)
+                future.set_exception(e)
+            else:
+                if ok:
+                    future.set_result(Pickled(payload))
+                else:
+                    exc, remote_traceback = loads(payload)
+                    exc.remote_traceback = remote_traceback
+                    future.set_exception(exc)
+            finally:
+                self._done(future)
+
+        self._shutdown_retired()
+        entry, arguments = future.get_task()
+        # pool processes keep their own cache, they unpickle a callable only once
+        task = (entry.digest, entry.data, bytes(arguments))
+        executor = self._executor
+        try:
+            process_future = executor.submit(_execute_pickled, *task)
+        except BrokenProcessPool:
+            executor = self._replace_broken(executor)
+            process_future = executor.submit(_execute_pickled, *task)
+        process_future.add_done_callback(_callback)
 
     def stop(self):
         """Discard all items and waiting for stop.
@@ -73,25 +443,94 @@ class Worker:
         return self._task_list._qsize()
 
 
+class WorkerLoad:
+    """Queued tasks, running tasks and connections of every worker,
+    kept in memory shared by the manager and its forked workers.
+
+    Every field has a single writer, connections are counted by the
+    manager when it hands them over and by the worker when they close.
+
+    :param size: number of worker slots.
+    """
+    FIELDS = 4
+
+    def __init__(self, size):
+        self.size = size
+        self._counts = mp.RawArray('l', size * self.FIELDS)
+
+    def update(self, slot, queued, running):
+        base = slot * self.FIELDS
+        self._counts[base] = queued
+        self._counts[base + 1] = running
+
+    def handed(self, slot):
+        self._counts[slot * self.FIELDS + 2] += 1
+
+    def closed(self, slot):
+        self._counts[slot * self.FIELDS + 3] += 1
+
+    def get(self, slot):
+        """(queued, running, connections) of the worker in `slot`.
+        """
+        base = slot * self.FIELDS
+        queued, running, handed, closed = self._counts[base:base + self.FIELDS]
+        return queued, running, handed - closed
+
+    def reset(self, slot):
+        base = slot * self.FIELDS
+        self._counts[base:base + self.FIELDS] = [0] * self.FIELDS
+
+
 class WorkerProxy:
-    def __init__(self, manager, child_conn):
+    def __init__(self, manager, child_conn, slot=0):
         self.conn = child_conn
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        server_socket.bind((manager.host, manager.port))
-        server_socket.listen()
-        self.server_socket = server_socket
+        self.slot = slot
         self._stopped = False
         self.settings = manager.settings
+        metrics.enable(self.settings['METRICS'])
+        # with `manager` balancing the manager accepts connections and hands them over,
+        # queued tasks are moved between workers with `WORKER_STEAL`
+        self._balanced = self.settings['WORKER_BALANCE'] == 'manager'
+        self._load = manager.load
+        self._steal = self.settings['WORKER_STEAL']
+        self._spool = manager.spool
 
         selector = selectors.DefaultSelector()
-        selector.register(self.server_socket.fileno(), selectors.EVENT_READ, self._handle_connection)
+        self.server_socket = None
+        if not self._balanced:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind((manager.host, manager.port))
+            server_socket.listen(socket.SOMAXCONN)
+            server_socket.setblocking(False)
+            self.server_socket = server_socket
+            selector.register(self.server_socket.fileno(), selectors.EVENT_READ, self._handle_connection)
         selector.register(self.conn, selectors.EVENT_READ, self._handle_signal)
         self.selector = selector
 
+        # worker threads wake the selector up when replies are ready, signals write their number
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        selector.register(self._wakeup_recv, selectors.EVENT_READ, self._handle_wakeup)
+        self._ready = deque()
+        # events for the manager, sent by the loop so no worker thread blocks on the pipe
+        self._events = deque()
+        self._create_signals()
+
         self._request_pool = {}
+        self._callables = CallableCache(self.settings['CALLABLE_CACHE_SIZE'])
 
-        self._worker = Worker()
+        # tasks run by other workers on our behalf, and the ids of the ones we run for them
+        self._stolen = {}
+        self._steal_ids = count(1)
+        self._saturated = False
+        self._queued = 0
+        self._draining = False
+        self._shutting_down = False
+
+        self._worker = Worker(self.settings['WORKER_BACKEND'], self.settings['MAX_EXECUTE_THREADS'],
+                              self._update_load)
         self._worker_thread = Thread(target=self._worker.run)
         del manager
 
@@ -101,66 +540,387 @@ class WorkerProxy:
     def run(self):
         self._run_worker()
         self._loop()
-        self.server_socket.close()
+        if self.server_socket is not None:
+            self.server_socket.close()
 
     def stop(self):
         self._stopped = True
 
+    def _create_signals(self):
+        # the manager stops the workers, an interrupt of the whole process group is left to it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # handled by the loop once the wakeup fd is readable, not in the middle of a callback
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        set_wakeup_fd(self._wakeup_send.fileno())
+
     def _loop(self):
         selector = self.selector
         while not self._stopped:
-            events = selector.select()
-            if not events:
-                sleep(1)
-            else:
-                for key, mask in events:
-                    callback = key.data
-                    callback(key, mask)
-
-    def _send_result_callback(self, client_socket):
-        sock = client_socket
-        def _send_action(result):
-            nonlocal sock
-            sock.sendall(dumps(result))
-            sock.close()
-            del sock
+            for key, mask in selector.select():
+                callback = key.data
+                callback(key, mask)
+
+    def _handle_wakeup(self, key, mask):
+        signums = set()
+        try:
+            while True:
+                data = self._wakeup_recv.recv(4096)
+                if not data:
+                    break
+                signums.update(data)
+        except (BlockingIOError, InterruptedError):
+            pass
+        ready = self._ready
+        while ready:
+            ready.popleft().flush()
+        if not self._send_events():
+            self._shutdown()
+        if signal.SIGTERM in signums:
+            self._shutdown()
+        if self._draining:
+            self._check_drained()
+
+    def _drain(self):
+        """Stop taking connections, send the clients away once their calls are
+        answered and exit when nothing is left.
+        """
+        self._draining = True
+        if self.server_socket is not None:
+            self.selector.unregister(self.server_socket)
+            self.server_socket.close()
+            self.server_socket = None
+        self._check_drained()
+
+    def _check_drained(self):
+        for request in list(self._request_pool.values()):
+            if not request.draining and not request.inflight:
+                request.goaway()
+        worker = self._worker
+        if not self._request_pool and not worker.task_count() and not worker.running_count:
+            self._shutdown()
+
+    def _reply(self, client_request, request_id, kind, payload):
+        kind, payload = compress(client_request.codec, kind, payload, self.settings['RPC_COMPRESSION_THRESHOLD'])
+        if Setting.METRICS:
+            metrics.RPC_MESSAGES.inc(direction='out')
+            metrics.RPC_BYTES.inc(MESSAGE.size + len(payload), direction='out')
+        client_request.push(MESSAGE.pack(request_id, kind), payload)
+        self._ready.append(client_request)
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _reply_error(self, client_request, request_id, exc):
+        error = (exc, getattr(exc, 'remote_traceback', None))
+        try:
+            payload = dumps(error)
+        except Exception:
+            payload = dumps((Exception(repr(exc)), error[1]))
+        self._reply(client_request, request_id, MSG_ERROR, payload)
+
+    def _stream(self, client_request, request_id, iterator):
+        """Send the items of `iterator` as they come, runs on the worker thread
+        which blocks while the client has `STREAM_WINDOW` items it didn't take yet,
+        for at most `STREAM_IDLE_TIMEOUT` seconds.
+        """
+        stream = client_request.streams[request_id] = StreamCredit(
+            self.settings['STREAM_WINDOW'], self.settings['STREAM_IDLE_TIMEOUT'])
+        try:
+            if client_request.closed:
+                return
+            for item in iterator:
+                if not stream.acquire():
+                    if stream.expired:
+                        raise Exception('Stream idle for {} seconds, stopped'.format(stream._timeout))
+                    return
+                self._reply(client_request, request_id, MSG_CHUNK, dumps(item))
+        except Exception as e:
+            e.remote_traceback = traceback.format_exc()
+            self._reply_error(client_request, request_id, e)
+        else:
+            self._reply(client_request, request_id, MSG_END, b'')
+        finally:
+            client_request.streams.pop(request_id, None)
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def _send_result_callback(self, client_request, request_id):
+        def _send_action(future):
+            try:
+                _send(future)
+            finally:
+                client_request.finished()
+                if self._draining:
+                    self._wakeup()
+
+        def _send(future):
+            if client_request.closed:
+                return
+            if future.exception is None:
+                result = future.data
+                if isinstance(result, Iterator):
+                    self._stream(client_request, request_id, result)
+                    return
+                try:
+                    payload = result.data if isinstance(result, Pickled) else dumps(result)
+                    self._reply(client_request, request_id, MSG_RESULT, payload)
+                    return
+                except Exception as e:
+                    e.remote_traceback = traceback.format_exc()
+                    future.exception = e
+            self._reply_error(client_request, request_id, future.exception)
         return _send_action
 
-    def _request_finish_callback(self, client_socket, client_request):
-        task = loads(client_request.get_data())
-        if not isinstance(task, RemoteCallable):
-            raise Exception('Need a `RemoteCallable` instance')
-        future = self._worker.add_task(task)
-        future.add_done_callback(self._send_result_callback(client_socket))
-        self.selector.unregister(client_socket)
-        self._request_pool.pop(client_socket.fileno(), None)
+    def _request_finish_callback(self, client_request):
+        data = client_request.get_data()
+        request_id, kind = MESSAGE.unpack_from(data)
+        if Setting.METRICS:
+            metrics.RPC_MESSAGES.inc(direction='in')
+            metrics.RPC_BYTES.inc(len(data), direction='in')
+        try:
+            kind, view = decompress(client_request.codec, kind, memoryview(data)[MESSAGE.size:])
+        except Exception as e:
+            self._log(logging.ERROR, 'bad message from client: {!r}'.format(e))
+            client_request.close()
+            return
+        if kind == MSG_HELLO:
+            codec = negotiate(bytes(view).decode().split(','))
+            # sent uncompressed, the client learns the codec from it
+            self._reply(client_request, 0, MSG_HELLO, codec.name.encode() if codec else b'')
+            client_request.codec = codec
+            return
+        if kind in (MSG_CREDIT, MSG_CANCEL):
+            stream = client_request.streams.get(request_id)
+            if stream is not None:
+                if kind == MSG_CREDIT:
+                    stream.release(CREDIT.unpack_from(view)[0])
+                else:
+                    stream.cancel()
+            return
+        if kind != MSG_CALL:
+            self._log(logging.ERROR, 'unknown message kind {}'.format(kind))
+            self._reply(client_request, request_id, MSG_ERROR, dumps((Exception('Unknown message kind'), None)))
+            return
+        digest, size = CALL.unpack_from(view)
+        offset = CALL.size
+        if size:
+            data = bytes(view[offset:offset + size])
+            if hashlib.sha256(data).digest() != digest:
+                # never cache a callable under a digest it doesn't have, later calls would run it
+                self._log(logging.ERROR, 'callable does not match its digest')
+                self._reply(client_request, request_id, MSG_ERROR,
+                            dumps((Exception('Callable does not match its digest'), None)))
+                return
+            # cached here so the calls following this one find it, unpickled by the worker
+            entry = self._callables.put(digest, data)
+            offset += size
+        else:
+            entry = self._callables.get(digest)
+            if entry is None:
+                self._reply(client_request, request_id, MSG_UNKNOWN_CALLABLE, b'')
+                return
+        client_request.started()
+        future = self._worker.add_task((entry, view[offset:]))
+        future.add_done_callback(self._send_result_callback(client_request, request_id))
+
+    def _request_close_callback(self, client_request):
+        self._request_pool.pop(client_request.sock.fileno(), None)
+        self._load.closed(self.slot)
+        if self._draining:
+            self._check_drained()
+
+    def _send_event(self, event, msg):
+        # worker threads report too, the loop sends it
+        self._events.append((event, msg))
+        self._wakeup()
+
+    def _send_events(self):
+        events = self._events
+        try:
+            while events:
+                self.conn.send(events.popleft())
+        except OSError:
+            # the manager is gone
+            return False
+        return True
 
     def _log(self, level, msg):
-        self.conn.send((EVENT_LOG, (level, msg)))
+        self._send_event(EVENT_LOG, (level, msg))
+
+    def _update_load(self, queued, running):
+        """Publish the worker's load, and with `WORKER_STEAL` tell the manager when
+        it gets a backlog or frees up so tasks can be moved between workers.
+        """
+        self._load.update(self.slot, queued, running)
+        if Setting.METRICS:
+            metrics.WORKER_QUEUED.set(queued, slot=self.slot)
+            metrics.WORKER_RUNNING.set(running, slot=self.slot)
+        if not self._steal:
+            return
+        was_saturated = self._saturated
+        self._saturated = queued > 0 or running >= self._worker.max_workers
+        if queued and not self._queued:
+            self._send_event(EVENT_BACKLOG, self.slot)
+        elif was_saturated and not self._saturated:
+            self._send_event(EVENT_IDLE, self.slot)
+        self._queued = queued
+
+    def _spool_path(self, owner, task_id, kind):
+        return os.path.join(self._spool, '{}-{}.{}'.format(owner, task_id, kind))
+
+    def _steal_tasks(self, thief, limit):
+        """Hand over tasks to `thief`, the manager only relays their ids while
+        the callable and arguments wait in the spool.
+        """
+        tasks = []
+        for future in self._worker.steal(limit):
+            future.ready()
+            task_id = next(self._steal_ids)
+            self._stolen[task_id] = future
+            entry, arguments = future.get_task()
+            with open(self._spool_path(self.slot, task_id, 'task'), 'wb') as f:
+                pickle.dump((entry.digest, entry.data, bytes(arguments)), f, pickle.HIGHEST_PROTOCOL)
+            tasks.append(task_id)
+        self._send_event(EVENT_TASKS, (self.slot, thief, tasks))
+
+    def _run_stolen(self, owner, tasks):
+        for task_id in tasks:
+            path = self._spool_path(owner, task_id, 'task')
+            with open(path, 'rb') as f:
+                digest, data, arguments = pickle.load(f)
+            os.remove(path)
+            future = self._worker.add_task((self._callables.put(digest, data), memoryview(arguments)))
+            future.add_done_callback(self._stolen_done_callback(owner, task_id))
+
+    def _stolen_done_callback(self, owner, task_id):
+        def _done_action(future):
+            ok, payload = True, None
+            if future.exception is None:
+                result = future.data
+                try:
+                    if isinstance(result, Pickled):
+                        payload = result.data
+                    else:
+                        # a stream can't be relayed, send what the generator yields at once
+                        payload = dumps(list(result) if isinstance(result, Iterator) else result)
+                except Exception as e:
+                    e.remote_traceback = traceback.format_exc()
+                    future.exception = e
+            if future.exception is not None:
+                exc = future.exception
+                ok, error = False, (exc, getattr(exc, 'remote_traceback', None))
+                try:
+                    payload = dumps(error)
+                except Exception:
+                    payload = dumps((Exception(repr(exc)), error[1]))
+            with open(self._spool_path(owner, task_id, 'done'), 'wb') as f:
+                f.write(payload)
+            self._send_event(EVENT_DONE, (owner, task_id, ok))
+        return _done_action
+
+    def _stolen_done(self, task_id, ok):
+        future = self._stolen.pop(task_id, None)
+        if future is None:
+            return
+        path = self._spool_path(self.slot, task_id, 'done')
+        if ok is None:
+            # the worker running it exited, what it left in the spool is dropped
+            for path in (self._spool_path(self.slot, task_id, 'task'), path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            future.set_exception(Exception('The worker running the task exited'))
+            return
+        with open(path, 'rb') as f:
+            payload = f.read()
+        os.remove(path)
+        if ok:
+            future.set_result(Pickled(payload))
+        else:
+            exc, remote_traceback = loads(payload)
+            exc.remote_traceback = remote_traceback
+            future.set_exception(exc)
 
     def _handle_connection(self, key, mask):
-        client_socket, addr = self.server_socket.accept()
-        client_host, client_port = client_socket.getpeername()
+        # take the whole backlog, a burst of connections costs one wakeup
+        while True:
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._log(logging.ERROR, 'accept failed: {}'.format(e))
+                return
+            self._accept(client_socket, addr)
+
+    def _accept(self, client_socket, addr):
+        client_host, client_port = addr[:2]
+        if not self._balanced:
+            # handed over by the manager otherwise, which counted it
+            self._load.handed(self.slot)
         if client_host in self.settings['BLACK_HOST_LIST'] or (
             client_host not in self.settings['WHITE_HOST_LIST'] and self.settings['WHITE_HOST_LIST']
         ):
             self._log(logging.WARN, 'drop connetion from <{}:{}>'.format(client_host, client_port))
             client_socket.close()
+            self._load.closed(self.slot)
         else:
             self._log(logging.DEBUG, 'accept connetion from <{}:{}>'.format(client_host, client_port))
             client_socket.setblocking(False)
-            request = RequestStore(self._request_finish_callback)
+            set_nodelay(client_socket)
+            request = RequestStore(client_socket, self.selector,
+                                   self._request_finish_callback, self._request_close_callback)
             self._request_pool[client_socket.fileno()] = request
             self.selector.register(client_socket, selectors.EVENT_READ, request)
             del request
 
     def _handle_signal(self, key, mask):
         conn = key.fileobj
-        event, msg = conn.recv()
-        if event == EVENT_CLOSE:
+        try:
+            while conn.poll():
+                event, msg = conn.recv()
+                if event == EVENT_CLOSE:
+                    break
+                elif event == EVENT_CONNECTION:
+                    # the socket itself follows the message
+                    client_socket = socket.socket(fileno=recv_handle(conn))
+                    self._accept(client_socket, msg)
+                elif event == EVENT_STEAL:
+                    self._steal_tasks(*msg)
+                elif event == EVENT_TASKS:
+                    self._run_stolen(*msg)
+                elif event == EVENT_DONE:
+                    self._stolen_done(*msg)
+                elif event == EVENT_STATS:
+                    self._send_event(EVENT_STATS, (self.slot, self._worker.stats()))
+                elif event == EVENT_DRAIN:
+                    self._drain()
+            else:
+                return
+        except EOFError:
+            # the manager is gone
+            pass
+        self._shutdown()
+
+    def _shutdown(self):
+        # closing the requests below drains the last one again
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        self._send_events()
+        if self.server_socket is not None:
             self.selector.unregister(self.server_socket)
-            self.selector.unregister(self.conn)
-            self._worker.stop()
-            self._worker_thread.join()
-            self.stop()
-            os._exit(0)
+        self.selector.unregister(self.conn)
+        for request in list(self._request_pool.values()):
+            request.close()
+        self._worker.stop()
+        self._worker_thread.join()
+        self.stop()
+        os._exit(0)
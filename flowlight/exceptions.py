@@ -3,3 +3,15 @@
 
 class RemoteWorkerNotRunning(Exception):
     pass
+
+
+class RemoteCallableError(Exception):
+    """Traceback of a callable which raised on a remote worker.
+    """
+    pass
+
+
+class RelaySourceError(Exception):
+    """The machine a file was relayed from went away.
+    """
+    pass
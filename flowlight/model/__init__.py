@@ -1,3 +1,13 @@
-from .node import Node
-from .machine import Machine
-from .group import Group, Cluster
+from flowlight.utils.lazy import install_lazy
+
+
+_LAZY = {
+    'Node': '.node',
+    'Machine': '.machine',
+    'Group': '.group',
+    'Cluster': '.group',
+}
+
+__all__ = list(_LAZY)
+
+install_lazy(globals(), _LAZY)
@@ -1,9 +1,16 @@
 import asyncio
+from contextlib import closing
+from time import monotonic
 
-from flowlight.core.command import Command
+from flowlight.core.setting import Setting
 from flowlight.model.node import Node
 from flowlight.model.machine import Machine
-from flowlight.utils.executor import get_executor
+from flowlight.core.bootstrap import resolve_many
+from flowlight.core.relay import distribute
+from flowlight.utils.executor import fan_out
+from flowlight.utils.metrics import GROUP_RUN_SECONDS, HOST_RUN_SECONDS, HOST_ERRORS
+from flowlight.utils.remote import map_remote
+from flowlight.utils.tracing import span
 
 
 class Group(Node):
@@ -16,14 +23,43 @@ class Group(Node):
         for node in nodes:
             self.add(node)
 
-    def enable_connection(self, **kwargs):
+    def enable_connection(self, connect=False, max_workers=None, deadline=None, return_failures=False, **kwargs):
+        """Set up the connections of every machine, host names are resolved at once first.
+
+        Every machine is tried, then the first failure is raised.
+
+        :param connect: open the SSH transports too, `max_workers` at once.
+        :param max_workers: defaults to `Setting.MAX_FANOUT_THREADS`.
+        :param deadline: seconds each host has to connect, handshake and authenticate,
+                defaults to `Setting.CONNECT_DEADLINE`.
+        :param return_failures: return a dict from each machine which failed to
+                the exception instead of raising.
+        """
+        machines = list({id(machine): machine for machine in self.machines()}.values())
+        resolve_many((machine.host for machine in machines), max_workers)
+        if connect:
+            kwargs.setdefault('deadline', deadline or Setting.CONNECT_DEADLINE)
+        failures = {}
+        error = None
+        with closing(fan_out(lambda machine: machine.enable_connection(connect=connect, **kwargs),
+                             machines, max_workers)) as completed:
+            for machine, future in completed:
+                if future.exception() is not None:
+                    failures[machine] = future.exception()
+                    error = error or future.exception()
+        if return_failures:
+            return failures
+        if error is not None:
+            raise error
+
+    def close_connection(self):
         for node in self.nodes():
-            node.enable_connection(**kwargs)
+            node.close_connection()
 
     def add(self, node):
         if not isinstance(node, Node):
             host = name = node
-            node = Machine(host, name)
+            node = Machine(host, name=name)
             self._nodes_map[name] = node
         else:
             self._nodes_map[node.name] = node
@@ -32,20 +68,134 @@ class Group(Node):
     def nodes(self):
         return self._nodes
 
+    def _fan_out(self, cmd, max_workers, **kwargs):
+        def _run(machine):
+            started = monotonic()
+            try:
+                return machine.run(cmd, **kwargs)
+            except Exception:
+                HOST_ERRORS.inc(host=str(machine))
+                raise
+            finally:
+                HOST_RUN_SECONDS.observe(monotonic() - started, host=str(machine))
+        return self._map(_run, max_workers)
+
+    def _map(self, func, max_workers):
+        machines = {id(machine): machine for machine in self.machines()}
+        return closing(fan_out(func, machines.values(), max_workers))
+
+    def _gather(self, fanned_out, fail_fast=False):
+        results = {}
+        error = None
+        with fanned_out as completed:
+            for machine, future in completed:
+                exc = future.exception()
+                if exc is not None:
+                    if fail_fast:
+                        raise exc
+                    error = error or exc
+                results[id(machine)] = exc or future.result()
+        if error is not None:
+            raise error
+        return self._collect(results)
+
+    def run(self, cmd, max_workers=None, fail_fast=False, **kwargs):
+        """Run `cmd` on every machine at once, the responses are arranged like the nested groups.
+
+        :param max_workers: max hosts running at once, defaults to `Setting.MAX_FANOUT_THREADS`.
+        :param fail_fast: raise on the first failure without starting the remaining hosts,
+                otherwise the first failure is raised when every host is done.
+        """
+        started = monotonic()
+        try:
+            with span('group.run', 'group', group=self.name, cmd=cmd):
+                return self._gather(self._fan_out(cmd, max_workers, **kwargs), fail_fast)
+        finally:
+            GROUP_RUN_SECONDS.observe(monotonic() - started)
+
+    def put(self, localpath, remotepath, max_workers=None, fail_fast=False, **kwargs):
+        """Copy `localpath` to every machine at once, see `Machine.put`.
+
+        :param max_workers: max hosts copied at once, defaults to `Setting.MAX_FANOUT_THREADS`.
+        """
+        return self._gather(self._map(lambda machine: machine.put(localpath, remotepath, **kwargs),
+                                      max_workers), fail_fast)
+
     def get(self, name):
         return self._nodes_map.get(name, None)
 
-    def run(self, cmd):
-        responses = get_executor().map(lambda node: node.run(cmd), self)
-        return list(responses)
+    def download(self, remotepath, localpath, max_workers=None, fail_fast=False, **kwargs):
+        """Copy `remotepath` from every machine at once, see `Machine.get`.
+
+        :param localpath: must hold `{host}`, replaced by each machine's host so
+                their files don't overwrite each other.
+        :param max_workers: max hosts copied at once, defaults to `Setting.MAX_FANOUT_THREADS`.
+        """
+        if '{host}' not in localpath:
+            raise Exception('localpath needs {{host}} to keep the files of every host: {}'.format(localpath))
+        return self._gather(self._map(
+            lambda machine: machine.get(remotepath, localpath.format(host=machine.host), **kwargs),
+            max_workers), fail_fast)
 
-    def run_async(self, cmd, **kwargs):
-        command = Command(cmd, **kwargs)
-        tasks = []
+    def distribute(self, localpath, remotepath, seeds=None):
+        """Copy `localpath` to every machine, relayed from machine to machine, see `distribute`.
+
+        The first failure is raised when every machine is done.
+        """
+        results = distribute(self.machines(), localpath, remotepath, seeds)
+        error = next((result for result in results.values() if isinstance(result, Exception)), None)
+        if error is not None:
+            raise error
+        return self._collect(results)
+
+    def run_iter(self, cmd, max_workers=None, return_exceptions=False, **kwargs):
+        """Yield each machine's `Response` as soon as it is ready.
+
+        Stop iterating to skip the hosts not started yet.
+
+        :param return_exceptions: yield the exception of a failed host instead of raising it.
+        """
+        with self._fan_out(cmd, max_workers, **kwargs) as completed:
+            for machine, future in completed:
+                exc = future.exception()
+                if exc is not None and not return_exceptions:
+                    raise exc
+                yield exc or future.result()
+
+    def machines(self):
+        """Iterate over the `Machine` leaves of nested groups.
+        """
         for node in self.nodes():
-            tasks.append(node.run_async(command.cmd))
-        response = yield from asyncio.gather(*tasks)
-        return response
+            if isinstance(node, Group):
+                yield from node.machines()
+            else:
+                yield node
+
+    def _collect(self, results):
+        """Arrange per-machine `results` (keyed by `id`) like the nested groups.
+        """
+        return [node._collect(results) if isinstance(node, Group) else results[id(node)]
+                for node in self.nodes()]
+
+    async def run_async(self, cmd, limit=None, **kwargs):
+        """Run `cmd` on every machine on one event loop.
+
+        :param limit: max sessions running at once, defaults to `Setting.ASYNC_MAX_SESSIONS`.
+        """
+        semaphore = asyncio.Semaphore(limit or Setting.ASYNC_MAX_SESSIONS)
+
+        async def _run(machine):
+            async with semaphore:
+                return await machine.run_async(cmd, **kwargs)
+
+        machines = {id(machine): machine for machine in self.machines()}
+        responses = await asyncio.gather(*map(_run, machines.values()))
+        return self._collect(dict(zip(machines, responses)))
+
+    def map_remote(self, func, iterable, chunksize=1, inflight=None):
+        """Map `func` over `iterable` on the flowlight workers of every machine, see `map_remote`.
+        """
+        return map_remote(self.machines(), func, iterable, chunksize, inflight)
 
     def __iter__(self):
         return iter(self.nodes())
@@ -3,6 +3,9 @@ from flowlight.core.setting import Setting
 from flowlight.model.node import Node
 from flowlight.core.command import Command
 from flowlight.core.connection import Connection
+from flowlight.core.transfer import Transfer
+from flowlight.utils.cache import get_cache
+from flowlight.utils.delta import put_delta
 from flowlight.utils.remote import RemoteWorkerMixin
 
 
@@ -34,14 +37,39 @@ class Machine(Node, RemoteWorkerMixin):
         if connect is True:
             self.enable_connection(connect=True, **kwargs)
 
+    def _cache_key(self, cmd, kwargs):
+        command = Command(cmd, **kwargs)
+        if command.stream:
+            raise Exception('Streamed output can not be cached')
+        env = tuple(sorted(command.env.items())) if command.env else None
+        # every option shaping the response, a truncated one never answers a plain run
+        return (self.host, self.port, cmd, env, command.bufsize, command.timeout,
+                command.max_size, command.overflow)
+
     @_need_connection
-    def run(self, cmd, **kwargs):
+    def run(self, cmd, ttl=None, **kwargs):
+        """Run `cmd` on the machine.
+
+        :param ttl: keep the response for `ttl` seconds, the same command with the
+                same options run meanwhile gets it without running again, see `ResultCache`.
+        """
+        if ttl:
+            return get_cache().run(self._cache_key(cmd, kwargs), ttl, lambda: self.run(cmd, **kwargs))
         command = Command(cmd, **kwargs)
         response = self.connection.exec_command(command)
         return response
 
     @_need_connection
-    async def run_async(self, cmd, **kwargs):
+    async def run_async(self, cmd, ttl=None, **kwargs):
+        """Run `cmd` on the machine from the event loop, see `run`.
+
+        `timeout` aborts the command after that many seconds without output,
+        unlike `run` there is none by default.
+        """
+        kwargs.setdefault('timeout', None)
+        if ttl:
+            return await get_cache().run_async(self._cache_key(cmd, kwargs), ttl,
+                                               lambda: self.run_async(cmd, **kwargs))
         command = Command(cmd, **kwargs)
         response = await self.connection.exec_async_command(command)
         return response
@@ -50,6 +78,10 @@ class Machine(Node, RemoteWorkerMixin):
         if not self.connection:
             self.connection = Connection(machine=self, host=self.host, port=self.port, **kwargs)
 
+    def close_connection(self):
+        if self.connection:
+            self.connection.close()
+
     @_need_connection
     @contextmanager
     def jump_to(self, host, port=Setting.DEFAULT_SSH_PORT, username='root', password=None, **connect_args):
@@ -62,13 +94,32 @@ class Machine(Node, RemoteWorkerMixin):
         remote_machine.connection.close()
         del remote_machine
 
-    def put(self, *args, **kwargs):
-        with self.connection.sftp as sftp:
-            sftp.put(*args, **kwargs)
+    @_need_connection
+    def put(self, localpath, remotepath, callback=None, confirm=True, parallel=None, delta=False):
+        """Copy `localpath` to the machine, see `Transfer.put`.
+
+        :param delta: send only the blocks the remote copy lacks, see `put_delta`.
+        :return: the size of the file, the bytes sent with `delta` (it used to return nothing).
+        """
+        if delta:
+            return put_delta(self, localpath, remotepath)
+        return Transfer(self.connection, parallel).put(localpath, remotepath, callback, confirm)
 
-    def get(self, *args, **kwargs):
-        with self.connection.sftp as sftp:
-            sftp.get(*args, **kwargs)
+    @_need_connection
+    def get(self, remotepath, localpath, callback=None, parallel=None):
+        """Copy `remotepath` from the machine, see `Transfer.get`.
+
+        :return: the size of the file (it used to return nothing).
+        """
+        return Transfer(self.connection, parallel).get(remotepath, localpath, callback)
+
+    @_need_connection
+    def put_many(self, pairs, max_workers=None):
+        return Transfer(self.connection).put_many(pairs, max_workers)
+
+    @_need_connection
+    def get_many(self, pairs, max_workers=None):
+        return Transfer(self.connection).get_many(pairs, max_workers)
 
     def getaddr(self):
         return self.host, self.port
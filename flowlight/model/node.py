@@ -1,5 +1,5 @@
-from functools import partial
 from flowlight.tasks.task import _Task
+from flowlight.tasks.scheduler import Scheduler
 
 class Node:
     """Abstract representation of `Machine` and `Group`.
@@ -24,12 +24,18 @@ class Node:
     def enable_connection(self):
         raise NotImplementedError
 
+    def close_connection(self):
+        raise NotImplementedError
+
     def run_task(node, task, *args, **kwargs):
         if not isinstance(task, _Task):
             raise Exception('Need a task')
         return task.__call__(node, *args, **kwargs)
 
-    def run_tasks(self, tasks, *args, **kwargs):
-        if not isinstance(tasks, list):
-            tasks = [tasks]
-        return list(map(partial(self.run_task, *args, **kwargs), tasks))
+    def run_tasks(self, tasks, *args, max_workers=None, **kwargs):
+        """Run `tasks` and their dependencies, independent ones in parallel,
+        tasks without any `depends_on` run one by one in list order.
+
+        :param max_workers: tasks running at once.
+        """
+        return Scheduler(tasks, max_workers).run(self, *args, **kwargs)
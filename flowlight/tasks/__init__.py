@@ -2,6 +2,7 @@ from flowlight.tasks.meta import TaskMeta
 from flowlight.tasks.task import _Task
 from flowlight.tasks.future import TaskFuture
 from flowlight.tasks.state import TaskState
+from flowlight.tasks.scheduler import Scheduler
 
 
 def task(func=None, *args, **kwargs):
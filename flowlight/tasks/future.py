@@ -1,4 +1,5 @@
 import threading
+from time import monotonic
 
 from flowlight.tasks.state import TaskState
 
@@ -8,25 +9,47 @@ class TaskFuture:
         self._task = task
         self.state = TaskState.init()
         self.data = None
+        self.exception = None
         self.event = threading.Event()
         self._callbacks = []
+        self._lock = threading.Lock()
+        self.created_at = monotonic()
+        self.started_at = None
 
     def ready(self):
+        self.started_at = monotonic()
         self.state.start()
 
+    def _finish(self, data, exception):
+        with self._lock:
+            self.state.finish()
+            self.data = data
+            self.exception = exception
+            self.event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
     def set_result(self, result):
-        self.state.finish()
-        self.data = result
-        for callback in self._callbacks:
-            callback(result)
-        self.event.set()
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
 
     def add_done_callback(self, callback):
-        self._callbacks.append(callback)
+        """Call `callback` with this future once it is done, at once if it already is.
+        """
+        with self._lock:
+            if not self.event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
 
     def get(self, wait=False):
         if not self.event.is_set() and wait is True:
             self.event.wait()
+        if self.exception is not None:
+            raise self.exception
         return self.data
 
     def get_task(self):
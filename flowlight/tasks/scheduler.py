@@ -0,0 +1,115 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from flowlight.core.setting import Setting
+from flowlight.tasks.task import _Task
+from flowlight.utils.tracing import span, propagate
+
+
+__all__ = ['Scheduler']
+
+
+class Scheduler:
+    """Run tasks on a node in the order of their dependencies.
+
+    A task starts as soon as all its `depends_on` tasks are done, so independent
+    branches run in parallel, a task whose dependency failed is not run.
+    Tasks none of which declares `depends_on` run one by one in the order
+    they were given, each whatever the previous one returned.
+
+    :param tasks: the tasks to run, their dependencies are run too.
+    :param max_workers: tasks running at once, defaults to `Setting.MAX_TASK_WORKERS`.
+
+    Usage::
+
+        >>> build = task(lambda meta, node: node.run('make'))
+        >>> lint = task(lambda meta, node: node.run('make lint'))
+        >>> deploy = task(lambda meta, node: node.run('make deploy'), depends_on=[build, lint])
+        >>> Scheduler([deploy]).run(cluster)
+        [(<responses>, True)]
+    """
+    def __init__(self, tasks, max_workers=None):
+        if isinstance(tasks, _Task):
+            tasks = [tasks]
+        self.tasks = list(tasks)
+        self.max_workers = max_workers or Setting.MAX_TASK_WORKERS
+        collected = self._collect(self.tasks)
+        self._after = {task: set(task.depends_on) for task in collected}
+        if not any(self._after.values()):
+            # a plain list of tasks keeps running in list order
+            for previous, task in zip(collected, collected[1:]):
+                self._after[task].add(previous)
+        self.order = self._sort(collected, self._after)
+
+    @staticmethod
+    def _collect(tasks):
+        collected = []
+        seen = set()
+        stack = list(reversed(tasks))
+        while stack:
+            task = stack.pop()
+            if not isinstance(task, _Task):
+                raise Exception('Need a task')
+            if task in seen:
+                continue
+            seen.add(task)
+            collected.append(task)
+            stack.extend(reversed(task.depends_on))
+        return collected
+
+    @staticmethod
+    def _sort(tasks, after):
+        remaining = {task: len(after[task]) for task in tasks}
+        dependents = {task: [] for task in tasks}
+        for task in tasks:
+            for dependency in after[task]:
+                dependents[dependency].append(task)
+        ready = deque(task for task in tasks if not remaining[task])
+        order = []
+        while ready:
+            task = ready.popleft()
+            order.append(task)
+            for dependent in dependents[task]:
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    ready.append(dependent)
+        if len(order) != len(tasks):
+            cycle = [task for task in tasks if remaining[task]]
+            raise Exception('Cyclic dependency between tasks {}'.format(cycle))
+        return order
+
+    def run(self, node, *args, **kwargs):
+        """Run the tasks on `node`, return their (result, status) in the order they were given.
+        """
+        results = {}
+        remaining = {task: len(self._after[task]) for task in self.order}
+        dependents = {task: [] for task in self.order}
+        for task in self.order:
+            for dependency in self._after[task]:
+                dependents[dependency].append(task)
+        ready = deque(task for task in self.order if not remaining[task])
+        running = {}
+
+        def _finish(task, result):
+            results[task] = result
+            for dependent in dependents[task]:
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        with span('scheduler', 'task', node=str(node)), \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    task = ready.popleft()
+                    failed = [dependency for dependency in task.depends_on if not results[dependency][1]]
+                    if failed:
+                        _finish(task, (Exception('Dependency {} failed'.format(failed[0])), False))
+                        continue
+                    running[executor.submit(propagate(task._run), node, args, kwargs)] = task
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _finish(running.pop(future), future.result())
+        return [results[task] for task in self.tasks]
@@ -1,5 +1,6 @@
 from flowlight.utils.signal import Signal
 from flowlight.utils.trigger import Trigger
+from flowlight.utils.tracing import span
 from flowlight.tasks.meta import TaskMeta
 
 import threading
@@ -11,8 +12,10 @@ class _Task:
     :param func: task function called by `Node` lately.
     :param run_after: run the task when `run_after` is finish stage.
     :param run_only: only run the task when `run_only` condition is True.
+    :param depends_on: tasks to finish before this one when run by `Node.run_tasks`,
+            `run_after` is one of them.
     """
-    def __init__(self, func, run_after=None, run_only=None):
+    def __init__(self, func, run_after=None, run_only=None, depends_on=None):
         self.func = func
         self.trigger = Trigger()
 
@@ -24,20 +27,34 @@ class _Task:
         self.run_only = run_only
         self.run_after = run_after
 
+        if isinstance(depends_on, _Task):
+            depends_on = [depends_on]
+        self.depends_on = list(depends_on or [])
         if run_after is not None and isinstance(run_after, _Task):
             run_after.trigger.add(Signal.func_signal(lambda: self.event.set()))
+            if run_after not in self.depends_on:
+                self.depends_on.append(run_after)
 
     def __call__(self, node, *args, **kwargs):
-        self.meta = TaskMeta(self, run_after=self.run_after)
+        return self._run(node, args, kwargs, wait=True)
+
+    def _run(self, node, args, kwargs, wait=False):
+        """Run the task, `wait` blocks until `run_after` finished, the scheduler
+        doesn't need it as it starts a task once its dependencies are done.
+        """
+        self.meta = TaskMeta(self, run_after=self.run_after, depends_on=self.depends_on)
         if self.run_only is False or (callable(self.run_only) and self.run_only() is False):
             return Exception('Run condition check is failed.'), False
         if self.meta.run_after is not None and isinstance(self.meta.run_after, _Task):
-            self.event.wait()
+            if wait:
+                self.event.wait()
+            # the scheduler consumes the finish of `run_after` too, a direct run later waits for the next one
             self.event.clear()
         try:
-            self.on_start.send(self.meta)
-            result = self.func(self.meta, node, *args, **kwargs)
-            self.on_complete.send(self.meta)
+            with span(self.func.__name__, 'task', node=str(node)):
+                self.on_start.send(self.meta)
+                result = self.func(self.meta, node, *args, **kwargs)
+                self.on_complete.send(self.meta)
             return result, True
         except Exception as e:
             self.on_error.send(e)
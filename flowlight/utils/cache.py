@@ -0,0 +1,115 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import monotonic
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['ResultCache', 'get_cache']
+
+
+class ResultCache:
+    """Results kept for a TTL and shared by identical runs.
+
+    The least recently used results are dropped past `max_size`, a run asked
+    while an identical one is in flight waits for it instead of running again.
+    Failures are handed to the waiting runs but never cached.
+
+    :param max_size: results kept, defaults to `Setting.RESULT_CACHE_SIZE`.
+
+    Usage::
+
+        >>> cache = ResultCache()
+        >>> cache.run(('host1', 'uptime', None), 5, lambda: machine.run('uptime'))
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size or Setting.RESULT_CACHE_SIZE
+        self._results = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _begin(self, key):
+        """Return (result, None, False) on a hit, else (None, future of the run,
+        whether this call is the one to run it).
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                expires, result = entry
+                if expires > monotonic():
+                    self._results.move_to_end(key)
+                    return result, None, False
+                del self._results[key]
+            future = self._inflight.get(key)
+            if future is not None:
+                return None, future, False
+            future = self._inflight[key] = Future()
+            return None, future, True
+
+    def _finish(self, key, future, ttl, result=None, exception=None):
+        with self._lock:
+            del self._inflight[key]
+            if exception is None:
+                self._results[key] = (monotonic() + ttl, result)
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_size:
+                    self._results.popitem(last=False)
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+    def run(self, key, ttl, func):
+        """Return the cached result of `key` or call `func` to get it and keep it `ttl` seconds.
+        """
+        result, future, owner = self._begin(key)
+        if future is None:
+            return result
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(key, future, ttl, exception=e)
+            raise
+        self._finish(key, future, ttl, result)
+        return result
+
+    async def run_async(self, key, ttl, func):
+        """Like `run` where `func` returns an awaitable.
+        """
+        result, future, owner = self._begin(key)
+        if future is None:
+            return result
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func()
+        except BaseException as e:
+            self._finish(key, future, ttl, exception=e)
+            raise
+        self._finish(key, future, ttl, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+
+__cache = None
+__cache_lock = threading.Lock()
+
+
+def get_cache():
+    global __cache
+    if __cache is None:
+        with __cache_lock:
+            if __cache is None:
+                __cache = ResultCache()
+    return __cache
@@ -0,0 +1,74 @@
+import zlib
+from collections import OrderedDict
+
+from flowlight.constants import MSG_COMPRESSED
+
+
+__all__ = ['Codec', 'available', 'get_codec', 'negotiate', 'compress', 'decompress']
+
+
+class Codec:
+    __slots__ = ['name', 'compress', 'decompress']
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+_codecs = OrderedDict()
+
+try:
+    import zstandard
+    _codecs['zstd'] = Codec('zstd', lambda data: zstandard.ZstdCompressor().compress(data),
+                            lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    _codecs['lz4'] = Codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+_codecs['zlib'] = Codec('zlib', zlib.compress, zlib.decompress)
+
+
+def available():
+    """Names of the codecs usable here, the faster ones first.
+    """
+    return list(_codecs)
+
+
+def get_codec(name):
+    return _codecs.get(name)
+
+
+def negotiate(offered):
+    """The first of the `offered` codec names usable here, `None` if there is none.
+    """
+    for name in offered:
+        if name in _codecs:
+            return _codecs[name]
+    return None
+
+
+def compress(codec, kind, body, threshold):
+    """Compress `body` of a message of `kind` when it's worth it, return (kind, body).
+    """
+    if codec is None or len(body) < threshold:
+        return kind, body
+    compressed = codec.compress(body)
+    if len(compressed) >= len(body):
+        return kind, body
+    return kind | MSG_COMPRESSED, compressed
+
+
+def decompress(codec, kind, body):
+    """Return (kind, body) of a message as read, decompressed if it was compressed.
+    """
+    if not kind & MSG_COMPRESSED:
+        return kind, body
+    if codec is None:
+        raise EOFError('Compressed message before compression was negotiated')
+    return kind & ~MSG_COMPRESSED, codec.decompress(body)
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import shutil
+import uuid
+from collections import deque
+from contextlib import closing
+from itertools import accumulate
+
+from flowlight.core.setting import Setting
+from flowlight.core.transfer import Transfer
+
+
+__all__ = ['signature', 'delta', 'patch', 'put_delta']
+
+
+def _weak(block):
+    """rsync's rolling checksum of `block` as its two 16 bits halves.
+    """
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+
+if hasattr(hashlib, 'blake2b'):
+    def _strong(block):
+        return hashlib.blake2b(block, digest_size=16).digest()
+else:
+    # before Python 3.6, only workers on a Python as old find the blocks sent by it,
+    # the others see every block changed and the file is sent whole
+    def _strong(block):
+        return hashlib.sha256(block).digest()[:16]
+
+
+def signature(path, block_size):
+    """(weak, strong) checksums of every whole block of `path`, `None` when it doesn't exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    sums = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            if len(block) < block_size:
+                break
+            a, b = _weak(block)
+            sums.append((a | b << 16, _strong(block)))
+    return sums
+
+
+def delta(path, sums, block_size, read_size=None):
+    """Yield the instructions rebuilding `path` out of the blocks described by `sums`:
+    the index of a block to copy from the old file or bytes to write.
+
+    The file is read `read_size` bytes at a time, defaults to `Setting.DELTA_FRAME_SIZE`,
+    so no literal is longer than that and a block. Matching blocks are skipped a whole
+    block at once, the rolling checksum only slides byte by byte over the regions which changed.
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(sums):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    read_size = max(read_size or Setting.DELTA_FRAME_SIZE, block_size)
+    data = b''
+    i = literal = 0
+    a = b = None
+    eof = False
+    with open(path, 'rb') as f:
+        while True:
+            if i + block_size >= len(data) and not eof:
+                # keep the current block, what came before it is sent already
+                if literal < i:
+                    yield data[literal:i]
+                chunk = f.read(read_size)
+                eof = not chunk
+                data = data[i:] + chunk
+                i = literal = 0
+                continue
+            if i + block_size > len(data):
+                break
+            if a is None:
+                a, b = _weak(data[i:i + block_size])
+            candidates = blocks.get(a | b << 16)
+            if candidates:
+                index = candidates.get(_strong(data[i:i + block_size]))
+                if index is not None:
+                    if literal < i:
+                        yield data[literal:i]
+                    yield index
+                    i = literal = i + block_size
+                    a = None
+                    continue
+            if i + block_size == len(data):
+                break
+            # slide until the weak checksum of a block shows up, over a slice at a time
+            # as zipping the bytes goes faster than indexing them
+            stop = min(len(data) - block_size, i + 65536)
+            for i, out, new in zip(range(i + 1, stop + 1), data[i:stop], data[i + block_size:stop + block_size]):
+                a = (a - out + new) & 0xffff
+                b = (b - block_size * out + a) & 0xffff
+                if (a | b << 16) in blocks:
+                    break
+    if literal < len(data):
+        yield data[literal:]
+
+
+def _write_ops(path, part, offset, ops, block_size):
+    """Write `ops` to `part` from `offset`, the blocks are copied from `path`.
+    Return where they end.
+    """
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o600)
+    with open(path, 'rb') as old, os.fdopen(fd, 'wb') as new:
+        new.seek(offset)
+        for op in ops:
+            if isinstance(op, int):
+                old.seek(op * block_size)
+                op = old.read(block_size)
+            new.write(op)
+        return new.tell()
+
+
+def _commit(path, part, size, digest):
+    """Check `part` against the sha256 `digest` and move it in place of `path`.
+    """
+    os.truncate(part, size)
+    if _file_digest(part) != digest:
+        os.remove(part)
+        raise IOError('Checksum mismatch of {}'.format(part))
+    shutil.copymode(path, part)
+    os.replace(part, path)
+    return size
+
+
+def _discard(part):
+    try:
+        os.remove(part)
+    except FileNotFoundError:
+        pass
+
+
+def patch(path, ops, block_size, digest):
+    """Rebuild `path` from `ops`, check it against the sha256 `digest` and move it in place.
+    """
+    part = path + '.part'
+    return _commit(path, part, _write_ops(path, part, 0, ops, block_size), digest)
+
+
+def _file_digest(path):
+    check = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            check.update(block)
+    return check.hexdigest()
+
+
+def put_delta(machine, localpath, remotepath, block_size=None):
+    """Copy `localpath` to `machine` sending only the blocks the remote copy lacks.
+
+    The checksums of the remote copy are computed by the flowlight workers on
+    `machine`, which also rebuild the file, a missing remote copy is sent whole.
+    Instructions go in calls of about `Setting.DELTA_FRAME_SIZE` bytes,
+    `Setting.TRANSFER_MAX_SESSIONS` of them at once. Once more than
+    `Setting.DELTA_MAX_LITERAL` of the file read so far is new data, the file is sent whole.
+
+    :param block_size: size of the compared blocks, defaults to `Setting.DELTA_BLOCK_SIZE`.
+    :return: bytes of file data sent.
+    """
+    block_size = block_size or Setting.DELTA_BLOCK_SIZE
+    sums = machine.run_remote_callable(signature, remotepath, block_size)
+    if sums is None:
+        return Transfer(machine.connection).put(localpath, remotepath)
+    frame_size = Setting.DELTA_FRAME_SIZE
+    part = '{}.{}.part'.format(remotepath, uuid.uuid4().hex[:8])
+    pending = deque()
+    ops = []
+    sent = size = start = frame = 0
+    whole = False
+    try:
+        with closing(delta(localpath, sums, block_size, frame_size)) as instructions:
+            for op in instructions:
+                ops.append(op)
+                if isinstance(op, int):
+                    size += block_size
+                    frame += 8
+                else:
+                    size += len(op)
+                    sent += len(op)
+                    frame += len(op)
+                if frame < frame_size:
+                    continue
+                pending.append(machine.submit_remote_callable(_write_ops, remotepath, part, start, ops, block_size))
+                ops, start, frame = [], size, 0
+                if len(pending) >= Setting.TRANSFER_MAX_SESSIONS:
+                    pending.popleft().result()
+                if sent > Setting.DELTA_MAX_LITERAL * size:
+                    # mostly new data, sliding over it costs more than sending it
+                    whole = True
+                    break
+        if not whole:
+            pending.append(machine.submit_remote_callable(_write_ops, remotepath, part, start, ops, block_size))
+        while pending:
+            pending.popleft().result()
+        if not whole:
+            machine.run_remote_callable(_commit, remotepath, part, size, _file_digest(localpath))
+            return sent
+    except BaseException:
+        machine.run_remote_callable(_discard, part)
+        raise
+    machine.run_remote_callable(_discard, part)
+    return Transfer(machine.connection).put(localpath, remotepath)
@@ -1,9 +1,29 @@
-__executor = None
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from flowlight.core.setting import Setting
+from flowlight.utils.tracing import propagate
 
-def get_executor(nodes=4):
-    global __executor
-    if __executor is None:
-        from concurrent.futures import ThreadPoolExecutor
-        __executor = ThreadPoolExecutor(max_workers=min(nodes, 4))
-    return __executor
+
+def fan_out(func, items, max_workers=None):
+    """Call `func` on every item on a thread pool owned by this call,
+    yield `(item, future)` pairs as soon as each call is done.
+
+    Calls not started yet are cancelled when the generator is closed,
+    nested fan-outs get their own threads so they never wait on each other.
+
+    :param max_workers: max concurrent calls, defaults to `Setting.MAX_FANOUT_THREADS`.
+    """
+    items = list(items)
+    if not items:
+        return
+    max_workers = min(len(items), max_workers or Setting.MAX_FANOUT_THREADS)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    func = propagate(func)
+    futures = {executor.submit(func, item): item for item in items}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,138 @@
+import socket
+import struct
+from collections import deque
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['HEADER', 'MESSAGE', 'CALL', 'CREDIT', 'FrameReader', 'frame', 'send_frame', 'recv_frame', 'set_nodelay']
+
+HEADER = struct.Struct('>Q')
+# (request id, message kind) leading the payload of every RPC frame
+MESSAGE = struct.Struct('>QB')
+# (callable digest, size of the pickled callable) leading a call, followed by the callable
+# when its size isn't 0, then by the pickled arguments
+CALL = struct.Struct('>32sI')
+# items of a streamed result the client took since its last credit
+CREDIT = struct.Struct('>I')
+
+# payloads below this size are sent in one piece with their header
+_COALESCE_SIZE = 64 * 1024
+
+
+def frame(*parts):
+    """Buffers of one frame made of `parts`, ready for `socket.sendmsg`.
+    """
+    return [HEADER.pack(sum(len(part) for part in parts))] + list(parts)
+
+
+def send_frame(sock, *parts):
+    buffers = frame(*parts)
+    if sum(len(buf) for buf in buffers) < _COALESCE_SIZE:
+        sock.sendall(b''.join(buffers))
+    else:
+        for buf in buffers:
+            sock.sendall(buf)
+
+
+def recv_frame(sock, reader=None):
+    """Block until one whole frame is read from `sock`.
+    """
+    reader = reader or FrameReader()
+    frames = reader.frames
+    while not frames:
+        reader.read_from(sock)
+    return frames.popleft()
+
+
+def set_nodelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+class FrameReader:
+    """Incremental reader of length prefixed frames.
+
+    Small frames are parsed out of a receive buffer which grows up to
+    `Setting.RPC_MAX_BUFFER_SIZE` while it keeps getting filled, a frame
+    larger than that is received straight into a `bytearray` preallocated
+    from its header.
+
+    Usage::
+
+        >>> reader = FrameReader()
+        >>> reader.read_from(sock)  # non-blocking sockets stop at `BlockingIOError`
+        >>> for frame in reader.frames: ...
+    """
+    def __init__(self):
+        self.frames = deque()
+        self._buffer = bytearray(Setting.RPC_BUFFER_SIZE)
+        self._start = self._end = 0
+        self._body = None
+        self._body_view = None
+
+    def read_from(self, sock):
+        """Receive what `sock` has and parse it, raise `EOFError` when the peer closed.
+        """
+        try:
+            while True:
+                if self._body_view is not None:
+                    size = sock.recv_into(self._body_view)
+                    if not size:
+                        raise EOFError('Connection closed in the middle of a frame')
+                    self._body_view = self._body_view[size:]
+                    if not len(self._body_view):
+                        self.frames.append(self._body)
+                        self._body = self._body_view = None
+                        if self.frames and sock.gettimeout() != 0:
+                            return
+                    continue
+                self._make_room()
+                with memoryview(self._buffer) as view:
+                    free = len(view) - self._end
+                    size = sock.recv_into(view[self._end:])
+                if not size:
+                    if self._start != self._end:
+                        raise EOFError('Connection closed in the middle of a frame')
+                    raise EOFError('Connection closed')
+                self._end += size
+                if size == free and len(self._buffer) < Setting.RPC_MAX_BUFFER_SIZE:
+                    self._grow()
+                self._parse()
+                if self.frames and sock.gettimeout() != 0:
+                    # blocking socket, return what we have instead of waiting for more
+                    return
+        except (BlockingIOError, InterruptedError):
+            return
+
+    def _make_room(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def _grow(self):
+        self._buffer.extend(bytes(len(self._buffer)))
+
+    def _parse(self):
+        buffer = self._buffer
+        while self._end - self._start >= HEADER.size:
+            size, = HEADER.unpack_from(buffer, self._start)
+            begin = self._start + HEADER.size
+            available = self._end - begin
+            if available >= size:
+                self.frames.append(buffer[begin:begin + size])
+                self._start = begin + size
+            elif HEADER.size + size > len(buffer):
+                # too large for the buffer, receive the rest in place
+                body = bytearray(size)
+                body[:available] = buffer[begin:self._end]
+                self._body, self._body_view = body, memoryview(body)[available:]
+                self._start = self._end = 0
+                return
+            else:
+                return
@@ -0,0 +1,39 @@
+import importlib
+import sys
+
+
+__all__ = ['install_lazy']
+
+
+def install_lazy(namespace, lazy):
+    """Import the attributes of a package on first use, so the CLI doesn't
+    import paramiko and cloudpickle for commands which never need them.
+
+    :param namespace: `globals()` of the package.
+    :param lazy: a dict from each name to the module defining it, or to a
+            (module, attribute) pair, modules may be relative to the package.
+
+    Usage::
+
+        >>> install_lazy(globals(), {'Machine': '.machine', 'task': ('flowlight.tasks', 'task')})
+    """
+    package = namespace['__name__']
+
+    def __getattr__(name):
+        try:
+            target = lazy[name]
+        except KeyError:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(package, name))
+        module, attr = target if isinstance(target, tuple) else (target, name)
+        value = namespace[name] = getattr(importlib.import_module(module, package), attr)
+        return value
+
+    def __dir__():
+        return sorted(set(namespace) | set(lazy))
+
+    namespace['__getattr__'] = __getattr__
+    namespace['__dir__'] = __dir__
+    if sys.version_info < (3, 7):
+        # modules can't define `__getattr__` before Python 3.7, everything is loaded at once
+        for name in lazy:
+            __getattr__(name)
@@ -0,0 +1,201 @@
+import threading
+from bisect import bisect_left
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry', 'enable', 'render']
+
+
+def enable(flag=True):
+    """Turn metrics on or off for this process, they are off by default
+    and record nothing then.
+    """
+    Setting.METRICS = bool(flag)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = key + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _render(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            lines.extend(self._render())
+        return lines
+
+
+class Counter(_Metric):
+    """A value which only goes up.
+
+    Usage::
+
+        >>> calls = registry.counter('flowlight_calls_total', 'Calls made')
+        >>> calls.inc(host='host1')
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not Setting.METRICS:
+            return
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(_labels(labels), 0)
+
+    def _render(self):
+        return ['{}{} {}'.format(self.name, _format_labels(key), _format_value(value))
+                for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value which goes up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not Setting.METRICS:
+            return
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observed values counted in buckets, seconds by default.
+
+    :param buckets: upper bounds of the buckets, defaults to `Setting.METRICS_BUCKETS`.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=None):
+        _Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets or Setting.METRICS_BUCKETS)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        if not Setting.METRICS:
+            return
+        key = _labels(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def get(self, **labels):
+        """(count, sum) of the values observed with `labels`.
+        """
+        entry = self._values.get(_labels(labels))
+        return (entry[1], entry[2]) if entry else (0, 0.0)
+
+    def _render(self):
+        lines = []
+        for key, (counts, count, total) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(key, [('le', _format_value(bound))]), cumulative))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(key), count))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), repr(total)))
+        return lines
+
+
+class Registry:
+    """Metrics of this process by name, rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise Exception('Metric {} is a {}'.format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=None):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def render():
+    """Metrics of this process in the Prometheus text format, call it on a worker
+    with `run_remote_callable` to read the metrics of that worker.
+    """
+    return registry.render()
+
+
+# SSH connections and commands
+DNS_SECONDS = registry.histogram('flowlight_dns_seconds', 'Host name resolutions not found in the cache')
+SSH_CONNECT_SECONDS = registry.histogram('flowlight_ssh_connect_seconds', 'SSH connect, handshake and auth')
+CHANNEL_OPEN_SECONDS = registry.histogram('flowlight_channel_open_seconds', 'Opening a channel and starting a command')
+COMMAND_SECONDS = registry.histogram('flowlight_command_seconds', 'Commands from start until their output is read')
+OUTPUT_BYTES = registry.counter('flowlight_output_bytes_total', 'Command output read')
+# groups
+GROUP_RUN_SECONDS = registry.histogram('flowlight_group_run_seconds', 'Group.run until every host is done')
+HOST_RUN_SECONDS = registry.histogram('flowlight_host_run_seconds', 'Commands on each host of a Group.run')
+HOST_ERRORS = registry.counter('flowlight_host_errors_total', 'Hosts of a Group.run which failed')
+# remote calls, client side
+REMOTE_CALLS = registry.counter('flowlight_remote_calls_total', 'Calls sent to flowlight workers')
+REMOTE_CALL_SECONDS = registry.histogram('flowlight_remote_call_seconds', 'Calls to workers until they are answered')
+# workers
+WORKER_QUEUED = registry.gauge('flowlight_worker_queued', 'Tasks waiting in a worker')
+WORKER_RUNNING = registry.gauge('flowlight_worker_running', 'Tasks running in a worker')
+WORKER_WAIT_SECONDS = registry.histogram('flowlight_worker_wait_seconds', 'Tasks waiting before they run')
+WORKER_TASK_SECONDS = registry.histogram('flowlight_worker_task_seconds', 'Tasks running')
+RPC_MESSAGES = registry.counter('flowlight_rpc_messages_total', 'RPC messages of workers by direction')
+RPC_BYTES = registry.counter('flowlight_rpc_bytes_total', 'RPC message bytes of workers by direction')
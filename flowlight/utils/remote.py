@@ -1,13 +1,29 @@
+import hashlib
+import os
 import pickle
-import cloudpickle
 import socket
-import struct
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from itertools import count, islice
+from time import monotonic
 
+from flowlight.constants import (
+    MSG_CALL, MSG_RESULT, MSG_ERROR, MSG_UNKNOWN_CALLABLE, MSG_CHUNK, MSG_END, MSG_CREDIT, MSG_CANCEL,
+    MSG_GOAWAY, MSG_HELLO,
+)
 from flowlight.core.setting import Setting
-from flowlight.exceptions import RemoteWorkerNotRunning
+from flowlight.exceptions import RemoteWorkerNotRunning, RemoteCallableError
+from flowlight.utils.compression import get_codec, compress, decompress
+from flowlight.utils.metrics import REMOTE_CALLS, REMOTE_CALL_SECONDS
+from flowlight.utils.tracing import start as start_span
+from flowlight.utils.framing import MESSAGE, CALL, CREDIT, FrameReader, send_frame, recv_frame, set_nodelay
 
 
 def dumps(obj):
+    # imported on first use, it's slow to import and most processes never pickle a callable
+    import cloudpickle
     return cloudpickle.dumps(obj)
 
 
@@ -15,34 +31,492 @@ def loads(data):
     return pickle.loads(data)
 
 
-class RemoteCallable:
-    def __init__(self, callable_obj, *args, **kwargs):
-        self.callable = callable_obj
-        self.args = args
-        self.kwargs = kwargs
+def _remote_error(body):
+    exc, remote_traceback = loads(body)
+    exc.__cause__ = RemoteCallableError(remote_traceback)
+    return exc
 
 
-class RemoteWorkerMixin:
-    def run_remote_callable(self, callable_obj, *args, **kwargs):
-        if not callable(callable_obj):
-            raise Exception('Need a callable object')
-        data = dumps(RemoteCallable(callable_obj, *args, **kwargs))
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+class Pickled:
+    """An object already pickled by `dumps`.
+    """
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+
+class PickledCallable:
+    """A callable pickled once and known by the digest of its pickle.
+
+    Workers cache the callables they got, so only the digest and the
+    arguments are sent by the following calls. Pass one to `submit` instead
+    of the callable itself to skip pickling it again on every call.
+
+    Usage::
+
+        >>> square = PickledCallable(lambda x: x * x)
+        >>> futures = [m.submit_remote_callable(square, i) for i in range(1000)]
+    """
+    __slots__ = ['data', 'digest']
+
+    def __init__(self, callable_obj):
+        self.data = dumps(callable_obj)
+        self.digest = hashlib.sha256(self.data).digest()
+
+
+class _Stream:
+    """Items of a streamed result the session received and the iterator didn't take yet.
+    """
+    def __init__(self, session, request_id):
+        self._session = session
+        self._request_id = request_id
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._done = False
+        self._exception = None
+        self._taken = 0
+
+    def _feed(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def _finish(self, exception=None):
+        with self._cond:
+            self._done = True
+            self._exception = exception
+            self._cond.notify()
+
+    def next(self):
+        with self._cond:
+            while not self._items and not self._done:
+                self._cond.wait()
+            if not self._items:
+                if self._exception is not None:
+                    raise self._exception
+                raise StopIteration
+            item = self._items.popleft()
+            self._taken += 1
+            taken = 0
+            if self._taken >= max(Setting.STREAM_WINDOW // 2, 1) and not self._done:
+                taken, self._taken = self._taken, 0
+        if taken:
+            self._session._send_control(self._request_id, MSG_CREDIT, CREDIT.pack(taken))
+        return item
+
+    def close(self):
+        with self._cond:
+            if self._done:
+                return
+            self._items.clear()
+        self._session._cancel(self._request_id)
+        self._finish()
+
+
+class RemoteIterator:
+    """Items of a generator running on a worker, handed out as they arrive.
+
+    The worker stops producing while `Setting.STREAM_WINDOW` items wait here,
+    every item taken lets it send one more. An iterator dropped before its
+    end, like after a `break`, stops the generator as `close` does.
+
+    Usage::
+
+        >>> for record in m.run_remote_callable(scan, '/data'):
+        ...     print(record)
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        # the session only holds the stream, so the iterator goes away with its last user
+        self._finalizer = weakref.finalize(self, stream.close)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._stream.next()
+
+    def close(self):
+        """Stop the generator on the worker, items not taken yet are dropped.
+        """
+        self._finalizer()
+
+
+class RemoteSession:
+    """A long-lived connection to the workers of one host.
+
+    Every call gets a request id, many calls can be in flight on the
+    socket and their replies may come back in any order.
+
+    A callable is sent along with its first call only, the next calls
+    send its digest, the worker asks for the callable again if it has
+    dropped it from its cache in the meantime.
+
+    A worker shutting down sends the session away, calls it didn't answer
+    are sent again on a new session.
+
+    Messages larger than `Setting.RPC_COMPRESSION_THRESHOLD` are compressed
+    with the first codec of `Setting.RPC_COMPRESSION` the worker accepts.
+
+    :param host: the worker's host.
+    :param port: the worker's port.
+    :param slot: see `get_session`.
+    """
+    def __init__(self, host, port, slot=0):
+        self.host = host
+        self.port = port
+        self.slot = slot
         try:
-            client.connect((self.host, Setting.PORT))
+            self.sock = socket.create_connection((host, port))
         except ConnectionRefusedError:
+            raise RemoteWorkerNotRunning('Workers on {} not running'.format(host))
+        set_nodelay(self.sock)
+        self.closed = False
+        self._codec = None
+        offered = [name for name in Setting.RPC_COMPRESSION or () if get_codec(name) is not None]
+        if offered:
+            try:
+                send_frame(self.sock, MESSAGE.pack(0, MSG_HELLO), ','.join(offered).encode())
+            except OSError:
+                self.sock.close()
+                raise RemoteWorkerNotRunning('Workers on {} not running'.format(host))
+        self._ids = count(1)
+        self._pending = {}
+        self._streams = {}
+        # digests of the callables the worker got on this connection
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def submit(self, callable_obj, *args, **kwargs):
+        """Call `callable_obj`, a callable or a `PickledCallable`, on the worker.
+        """
+        if not isinstance(callable_obj, PickledCallable):
+            callable_obj = PickledCallable(callable_obj)
+        arguments = dumps((args, kwargs))
+        future = Future()
+        self._submit(future, callable_obj, arguments)
+        return future
+
+    def _submit(self, future, callable_obj, arguments):
+        with self._lock:
+            if self.closed:
+                raise RemoteWorkerNotRunning('Session to {} is closed'.format(self.host))
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, callable_obj, arguments)
+        try:
+            self._send_call(request_id, callable_obj, arguments)
+        except OSError as e:
+            self._fail(e)
             raise RemoteWorkerNotRunning('Workers on {} not running'.format(self.host))
-        client.sendall(struct.pack('>i', len(data)) + data)
-        result = b''
-        while True:
-            stream_data = client.recv(1024)
-            if not stream_data:
-                break
-            result += stream_data
-        if not result:
-            print('Server has closed the connetion')
-            result = ''
-        else:
-            result = loads(result)
-        client.close()
-        return result
+
+    def _send_call(self, request_id, callable_obj, arguments, force=False):
+        digest = callable_obj.digest
+        known = self._known
+        with self._send_lock:
+            # decided under the send lock, so a call never overtakes the one carrying its callable
+            if digest in known and not force:
+                known.move_to_end(digest)
+                self._send_message(request_id, MSG_CALL, CALL.pack(digest, 0), arguments)
+                return
+            known[digest] = True
+            while len(known) > Setting.CALLABLE_CACHE_SIZE:
+                known.popitem(last=False)
+            self._send_message(request_id, MSG_CALL,
+                               CALL.pack(digest, len(callable_obj.data)), callable_obj.data, arguments)
+
+    def _send_message(self, request_id, kind, *parts):
+        # under the send lock
+        threshold = Setting.RPC_COMPRESSION_THRESHOLD
+        if self._codec is not None and sum(len(part) for part in parts) >= threshold:
+            kind, body = compress(self._codec, kind, b''.join(parts), threshold)
+            parts = (body,)
+        send_frame(self.sock, MESSAGE.pack(request_id, kind), *parts)
+
+    def _send_control(self, request_id, kind, payload=b''):
+        try:
+            with self._send_lock:
+                send_frame(self.sock, MESSAGE.pack(request_id, kind), payload)
+        except OSError:
+            # the reader thread fails the pending calls
+            pass
+
+    def _cancel(self, request_id):
+        with self._lock:
+            self._pending.pop(request_id, None)
+            self._streams.pop(request_id, None)
+        self._send_control(request_id, MSG_CANCEL)
+
+    def _read_loop(self):
+        reader = FrameReader()
+        try:
+            while True:
+                data = recv_frame(self.sock, reader)
+                request_id, kind = MESSAGE.unpack_from(data)
+                kind, body = decompress(self._codec, kind, memoryview(data)[MESSAGE.size:])
+                if kind == MSG_HELLO:
+                    self._codec = get_codec(bytes(body).decode())
+                    continue
+                if kind == MSG_GOAWAY:
+                    self._goaway()
+                    return
+                with self._lock:
+                    if kind == MSG_UNKNOWN_CALLABLE:
+                        call, stream = self._pending.get(request_id), None
+                    else:
+                        # a stream leaves the pending calls with its first item
+                        call = self._pending.pop(request_id, None)
+                        if kind != MSG_CHUNK:
+                            stream = self._streams.pop(request_id, None)
+                        else:
+                            stream = self._streams.get(request_id)
+                            if stream is None and call is not None:
+                                stream = self._streams[request_id] = _Stream(self, request_id)
+                if kind == MSG_UNKNOWN_CALLABLE:
+                    if call is not None:
+                        self._send_call(request_id, *call[1:], force=True)
+                    continue
+                if stream is None and call is not None and kind == MSG_END:
+                    # nothing was yielded
+                    stream = _Stream(self, request_id)
+                if stream is not None:
+                    if kind == MSG_CHUNK:
+                        stream._feed(loads(body))
+                    elif kind == MSG_END:
+                        stream._finish()
+                    elif kind == MSG_ERROR:
+                        stream._finish(_remote_error(body))
+                    if call is not None:
+                        call[0].set_result(RemoteIterator(stream))
+                    continue
+                if call is None:
+                    continue
+                if kind == MSG_RESULT:
+                    call[0].set_result(loads(body))
+                elif kind == MSG_ERROR:
+                    call[0].set_exception(_remote_error(body))
+        except (EOFError, OSError) as e:
+            self._fail(e)
+
+    def _goaway(self):
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        _discard_session(self)
+        # the worker answered everything it read before saying goodbye, the rest never ran
+        for future, callable_obj, arguments in pending.values():
+            try:
+                get_session(self.host, self.port, self.slot)._submit(future, callable_obj, arguments)
+            except RemoteWorkerNotRunning as e:
+                future.set_exception(e)
+        self.close()
+
+    def _fail(self, exc):
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+            streams, self._streams = self._streams, {}
+        _discard_session(self)
+        error = RemoteWorkerNotRunning('Connection to workers on {} was closed: {!r}'.format(self.host, exc))
+        for future, _, _ in pending.values():
+            future.set_exception(error)
+        for stream in streams.values():
+            stream._finish(error)
+        self.sock.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._fail(EOFError('Session closed'))
+
+
+__sessions = {}
+__sessions_lock = threading.Lock()
+# one lock per key, connecting to a host never blocks the sessions of the others
+__connect_locks = {}
+
+
+def get_session(host, port=None, slot=0):
+    """Return the shared `RemoteSession` to `host`, connect it first if needed.
+
+    :param slot: sessions with different slots use their own connections,
+            which the kernel spreads over the forked workers.
+    """
+    key = (host, port or Setting.PORT, slot, os.getpid())
+    with __sessions_lock:
+        session = __sessions.get(key)
+        if session is not None and not session.closed:
+            return session
+        connect_lock = __connect_locks.setdefault(key, threading.Lock())
+    with connect_lock:
+        with __sessions_lock:
+            session = __sessions.get(key)
+        if session is None or session.closed:
+            session = RemoteSession(host, key[1], slot)
+            with __sessions_lock:
+                __sessions[key] = session
+        return session
+
+
+def _discard_session(session):
+    with __sessions_lock:
+        for key, value in list(__sessions.items()):
+            if value is session:
+                del __sessions[key]
+
+
+class _ChunkMapper:
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, chunk):
+        return [self.func(item) for item in chunk]
+
+
+def _chunks(iterable, chunksize):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunksize))
+
+
+class _PendingChunk:
+    __slots__ = ['chunk', 'started', 'machines']
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.started = monotonic()
+        self.machines = []
+
+
+def map_remote(machines, func, iterable, chunksize=1, inflight=None):
+    """Map `func` over `iterable` on the workers of `machines`, results keep the input order.
+
+    `func` is pickled once, the iterable is cut into chunks which are pulled
+    by each machine as soon as it has a free slot, so slow machines get less work.
+    Chunks of a machine whose workers went away are sent to the others, and once
+    the iterable is exhausted, idle machines run a copy of a chunk which takes
+    twice as long as the average one, the first copy to finish wins.
+
+    :param chunksize: items sent in one call.
+    :param inflight: calls in flight per machine, defaults to `WORKER_NUM * MAX_EXECUTE_THREADS`.
+    """
+    mapper = PickledCallable(_ChunkMapper(func))
+    inflight = inflight or Setting.WORKER_NUM * Setting.MAX_EXECUTE_THREADS
+    alive = list({id(machine): machine for machine in machines}.values())
+    running = {id(machine): 0 for machine in alive}
+    source = enumerate(_chunks(iterable, chunksize))
+    retry = deque()
+    results = {}
+    futures = {}
+    pending = {}
+    spent = 0.0
+    exhausted = False
+    produced = 0
+
+    def _straggler(machine):
+        if not results:
+            return None
+        deadline = monotonic() - 2 * spent / len(results)
+        for index, item in pending.items():
+            if index in results or item.machines != [item.machines[0]]:
+                continue
+            if item.machines[0] is not machine and item.started < deadline:
+                return index
+        return None
+
+    def _next_chunk(machine):
+        nonlocal exhausted, produced
+        if retry:
+            return retry.popleft()
+        if not exhausted:
+            item = next(source, None)
+            if item is not None:
+                produced += 1
+                return item
+            exhausted = True
+        index = _straggler(machine)
+        if index is not None:
+            return index, pending[index].chunk
+        return None
+
+    while not (exhausted and len(results) == produced):
+        for machine in list(alive):
+            while running[id(machine)] < inflight:
+                item = _next_chunk(machine)
+                if item is None:
+                    break
+                index, chunk = item
+                try:
+                    session = get_session(machine.host, slot=running[id(machine)] % Setting.WORKER_NUM)
+                    future = session.submit(mapper, chunk)
+                except RemoteWorkerNotRunning:
+                    alive.remove(machine)
+                    if index not in pending:
+                        retry.appendleft(item)
+                    break
+                futures[future] = (machine, index)
+                running[id(machine)] += 1
+                pending.setdefault(index, _PendingChunk(chunk)).machines.append(machine)
+        if exhausted and len(results) == produced:
+            break
+        if not futures:
+            raise RemoteWorkerNotRunning('No worker left to map on')
+        # wake up now and then to look for stragglers once the iterable is exhausted
+        timeout = spent / len(results) if exhausted and results else None
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            machine, index = futures.pop(future)
+            running[id(machine)] -= 1
+            item = pending[index]
+            item.machines.remove(machine)
+            exc = future.exception()
+            if exc is None:
+                if index not in results:
+                    results[index] = future.result()
+                    spent += monotonic() - item.started
+            elif isinstance(exc, RemoteWorkerNotRunning):
+                if machine in alive:
+                    alive.remove(machine)
+                if index not in results and not item.machines:
+                    retry.append((index, item.chunk))
+            elif index not in results:
+                raise exc
+            if not item.machines:
+                del pending[index]
+    # copies still running are left behind, their results are dropped
+    return [item for index in range(produced) for item in results[index]]
+
+
+class RemoteWorkerMixin:
+    def submit_remote_callable(self, callable_obj, *args, **kwargs):
+        """Send a call to the workers on this machine and return a `concurrent.futures.Future`.
+        """
+        if not (callable(callable_obj) or isinstance(callable_obj, PickledCallable)):
+            raise Exception('Need a callable object')
+        session = get_session(self.host)
+        try:
+            future = session.submit(callable_obj, *args, **kwargs)
+        except RemoteWorkerNotRunning:
+            if not session.closed:
+                raise
+            # the workers were restarted since the last call, reconnect once
+            future = get_session(self.host).submit(callable_obj, *args, **kwargs)
+        if Setting.METRICS:
+            host, started = self.host, monotonic()
+            REMOTE_CALLS.inc(host=host)
+            future.add_done_callback(lambda _: REMOTE_CALL_SECONDS.observe(monotonic() - started, host=host))
+        if Setting.TRACING:
+            call = start_span('remote call', 'rpc', host=self.host,
+                              callable=getattr(callable_obj, '__name__', type(callable_obj).__name__))
+            future.add_done_callback(lambda f: call.finish(None if f.cancelled() else f.exception()))
+        return future
+
+    def run_remote_callable(self, callable_obj, *args, **kwargs):
+        return self.submit_remote_callable(callable_obj, *args, **kwargs).result()
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+from itertools import count
+from time import perf_counter, time
+
+from flowlight.core.setting import Setting
+
+
+__all__ = ['Span', 'Tracer', 'tracer', 'enable', 'span', 'start', 'propagate', 'export']
+
+
+def enable(flag=True):
+    """Turn tracing on or off for this process, it is off by default
+    and records nothing then.
+    """
+    Setting.TRACING = bool(flag)
+
+
+# wall clock microseconds at `perf_counter() == 0`, so traces of several processes line up
+_EPOCH = time() * 1e6 - perf_counter() * 1e6
+_ids = count(1)
+
+
+class _ThreadVar:
+    """What tracing uses of `ContextVar`, kept per thread.
+    """
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # before Python 3.7 the current span follows threads but not asyncio tasks
+    ContextVar = _ThreadVar
+_current = ContextVar('flowlight_span', default=None)
+
+
+def _now():
+    return _EPOCH + perf_counter() * 1e6
+
+
+class Span:
+    """A timed stage, child of the span current when it started.
+
+    :param name: what is done, like `run` or `connect`.
+    :param category: the subsystem, like `task`, `ssh` or `sftp`.
+    :param attrs: details shown along with the span, like the host.
+    """
+    __slots__ = ['name', 'category', 'attrs', 'span_id', 'parent_id', 'thread_id', 'parent_thread_id',
+                 'start', 'end', 'error']
+
+    def __init__(self, name, category, parent=None, **attrs):
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.thread_id = threading.get_ident()
+        self.parent_thread_id = parent.thread_id if parent is not None else None
+        self.start = _now()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        """Microseconds from start to finish, `None` while running.
+        """
+        return None if self.end is None else self.end - self.start
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'category': self.category,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'attrs': self.attrs,
+            'error': self.error,
+        }
+
+    def __repr__(self):
+        return '<Span name={} id={}>'.format(self.name, self.span_id)
+
+
+class _NoSpan:
+    """Stands for spans while tracing is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def finish(self, error=None):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Scope:
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.tracer.finish(self.span, exc)
+        return False
+
+
+class Tracer:
+    """Spans of this process, exported in the Chrome trace event format.
+
+    The current span follows the code through `with` blocks, asyncio tasks (from
+    Python 3.7) and the threads started by `fan_out` and the `Scheduler`, so every
+    span knows its parent even when it runs on another thread.
+
+    :param max_spans: spans kept, the oldest are dropped past it, defaults to `Setting.TRACE_MAX_SPANS`.
+    """
+    def __init__(self, max_spans=None):
+        self.max_spans = max_spans
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def start(self, name, category='flowlight', **attrs):
+        """Start a span which is not made current, `finish` ends it,
+        for stages ending in a callback like remote calls.
+        """
+        return Span(name, category, _current.get(), **attrs)
+
+    def span(self, name, category='flowlight', **attrs):
+        """A span made current in a `with` block, an exception leaving the
+        block is recorded as its error.
+        """
+        return _Scope(self, self.start(name, category, **attrs))
+
+    def finish(self, span, error=None):
+        span.end = _now()
+        if error is not None:
+            span.error = '{}: {}'.format(type(error).__name__, error)
+        max_spans = self.max_spans or Setting.TRACE_MAX_SPANS
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) > max_spans:
+                del self._spans[:len(self._spans) - max_spans]
+
+    def spans(self):
+        """Finished spans, in the order they finished.
+        """
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans = []
+
+    def events(self):
+        """The finished spans as Chrome trace events, a span started on another thread
+        than its parent is linked to it by a flow arrow.
+        """
+        pid = os.getpid()
+        events = []
+        for span in self.spans():
+            args = dict(span.attrs, span_id=span.span_id, parent_id=span.parent_id)
+            if span.error is not None:
+                args['error'] = span.error
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'ts': span.start,
+                           'dur': span.duration, 'pid': pid, 'tid': span.thread_id, 'args': args})
+            if span.parent_id is not None and span.parent_thread_id != span.thread_id:
+                flow = {'name': span.name, 'cat': span.category, 'id': span.span_id, 'ts': span.start, 'pid': pid}
+                events.append(dict(flow, ph='s', tid=span.parent_thread_id))
+                events.append(dict(flow, ph='f', bp='e', tid=span.thread_id))
+        return events
+
+    def export(self, path):
+        """Write the finished spans to `path`, open it in chrome://tracing or Perfetto.
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+tracer = Tracer()
+
+
+def span(name, category='flowlight', **attrs):
+    """`Tracer.span` of the process tracer, does nothing while tracing is off.
+
+    Usage::
+
+        >>> enable()
+        >>> with span('deploy', 'task', version='1.2'):
+        ...     cluster.run('make deploy')
+        >>> export('deploy.json')
+    """
+    if not Setting.TRACING:
+        return _NO_SPAN
+    return tracer.span(name, category, **attrs)
+
+
+def start(name, category='flowlight', **attrs):
+    """`Tracer.start` of the process tracer, call `finish(error)` on the result.
+    """
+    if not Setting.TRACING:
+        return _NO_SPAN
+    return _Finisher(tracer.start(name, category, **attrs))
+
+
+class _Finisher:
+    __slots__ = ['span']
+
+    def __init__(self, span):
+        self.span = span
+
+    def finish(self, error=None):
+        tracer.finish(self.span, error)
+
+
+def propagate(func):
+    """`func` running in the context of the caller, so spans it opens on
+    another thread get the current span as parent.
+    """
+    if not Setting.TRACING:
+        return func
+    parent = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def export(path):
+    """Write the spans of this process to `path` as a Chrome trace.
+    """
+    return tracer.export(path)
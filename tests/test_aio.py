@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+
+from flowlight.core.aio import CommandSession
+from flowlight.model.machine import Machine
+
+
+class CommandSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_fed_by_hand(self):
+        async def run():
+            session = CommandSession()
+            session.feed('stdout', b'out')
+            session.feed('stderr', b'err')
+            session.feed_eof()
+            session.set_exit_status(0)
+            return await session.communicate()
+        self.assertEqual(self.loop.run_until_complete(run()), [b'out', b'err', 0])
+
+    def test_idle_timeout(self):
+        async def run():
+            session = CommandSession(timeout=0.05)
+            session.feed('stdout', b'partial')
+            return await session.communicate()
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete, run())
+
+    def test_cancel(self):
+        async def run():
+            session = CommandSession()
+            session.cancel()
+            return await session.stdout.read()
+        self.assertRaises(asyncio.CancelledError, self.loop.run_until_complete, run())
+
+
+class RunAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.machine = Machine('127.0.0.1')
+        self.machine.enable_connection()
+
+    def tearDown(self):
+        self.machine.close_connection()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_no_default_timeout(self):
+        response = self.loop.run_until_complete(self.machine.run_async('sleep 0.2; echo done'))
+        self.assertEqual(response.stdout, b'done\n')
+        self.assertEqual(response.exit_status, 0)
+
+    def test_timeout(self):
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete,
+                          self.machine.run_async('sleep 5', timeout=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
 
 def main():
-    return True
+    sys.path.insert(0, os.path.dirname(HERE))
+    suite = unittest.defaultTestLoader.discover(HERE)
+    return unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(not main())
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+from io import BytesIO
+
+from flowlight.core.response import Response
+from flowlight.model.machine import Machine
+from flowlight.utils.cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = ResultCache()
+        calls = []
+        run = lambda: calls.append(1) or len(calls)
+        self.assertEqual(cache.run('key', 0.1, run), 1)
+        self.assertEqual(cache.run('key', 0.1, run), 1)
+        time.sleep(0.15)
+        self.assertEqual(cache.run('key', 0.1, run), 2)
+
+    def test_max_size(self):
+        cache = ResultCache(max_size=2)
+        for key in 'abc':
+            cache.run(key, 10, lambda: key)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.run('a', 10, lambda: 'again'), 'again')
+
+    def test_coalescing(self):
+        cache = ResultCache()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.run('key', 10, slow)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ['done'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_failure_not_cached(self):
+        cache = ResultCache()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, cache.run, 'key', 10, fail)
+        self.assertEqual(cache.run('key', 10, lambda: 'ok'), 'ok')
+
+
+class CacheKeyTest(unittest.TestCase):
+    def test_options(self):
+        machine = Machine('127.0.0.1')
+        key = machine._cache_key('uptime', {})
+        self.assertEqual(key, machine._cache_key('uptime', {'timeout': 5}))
+        self.assertNotEqual(key, machine._cache_key('uptime', {'max_size': 10, 'overflow': 'truncate'}))
+        self.assertNotEqual(key, machine._cache_key('uptime', {'env': {'LANG': 'C'}}))
+        self.assertRaises(Exception, machine._cache_key, 'uptime', {'stream': True})
+
+
+class SharedResponseTest(unittest.TestCase):
+    def test_concurrent_reads(self):
+        data = bytes(range(256)) * 4096
+        response = Response(None, BytesIO(data), None, max_size=1024)
+        errors = []
+
+        def read():
+            for _ in range(20):
+                if response.stdout != data or response.output_file().read() != data:
+                    errors.append(1)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
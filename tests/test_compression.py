@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from benchmarks.harness import Workers
+from flowlight import Machine
+from flowlight.constants import MSG_CALL, MSG_COMPRESSED
+from flowlight.core.setting import Setting
+from flowlight.utils.compression import available, get_codec, negotiate, compress, decompress
+from flowlight.utils.remote import get_session
+
+
+class NegotiateTest(unittest.TestCase):
+    def test_first_usable(self):
+        self.assertEqual(negotiate(['brotli', 'zlib']).name, 'zlib')
+        self.assertEqual(negotiate(available()).name, available()[0])
+
+    def test_none_usable(self):
+        self.assertIsNone(negotiate(['brotli']))
+        self.assertIsNone(negotiate([]))
+
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = get_codec('zlib')
+
+    def test_round_trip(self):
+        body = b'flowlight ' * 1000
+        kind, compressed = compress(self.codec, MSG_CALL, body, 100)
+        self.assertEqual(kind, MSG_CALL | MSG_COMPRESSED)
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(decompress(self.codec, kind, compressed), (MSG_CALL, body))
+
+    def test_below_threshold(self):
+        body = b'flowlight ' * 10
+        self.assertEqual(compress(self.codec, MSG_CALL, body, 1000), (MSG_CALL, body))
+        self.assertEqual(compress(None, MSG_CALL, body * 100, 1000), (MSG_CALL, body * 100))
+
+    def test_incompressible(self):
+        body = os.urandom(10000)
+        self.assertEqual(compress(self.codec, MSG_CALL, body, 100), (MSG_CALL, body))
+
+    def test_not_negotiated(self):
+        kind, compressed = compress(self.codec, MSG_CALL, b'a' * 1000, 100)
+        self.assertRaises(EOFError, decompress, None, kind, compressed)
+
+
+class SessionCompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.workers = Workers().start()
+        self.settings = Setting.PORT, Setting.RPC_COMPRESSION
+        Setting.PORT, Setting.RPC_COMPRESSION = self.workers.port, ['brotli', 'zlib']
+
+    def tearDown(self):
+        Setting.PORT, Setting.RPC_COMPRESSION = self.settings
+        self.workers.stop()
+
+    def test_negotiated(self):
+        payload = b'flowlight ' * 100000
+        self.assertEqual(Machine('127.0.0.1').run_remote_callable(bytes, payload), payload)
+        self.assertEqual(get_session('127.0.0.1')._codec.name, 'zlib')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from flowlight.utils.delta import signature, delta, patch, _file_digest
+
+
+class DeltaTest(unittest.TestCase):
+    block_size = 1024
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.random = random.Random(7)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def round_trip(self, old, new, read_size=None):
+        old_path, new_path = self.write('old', old), self.write('new', new)
+        sums = signature(old_path, self.block_size)
+        ops = list(delta(new_path, sums, self.block_size, read_size))
+        patch(old_path, ops, self.block_size, _file_digest(new_path))
+        with open(old_path, 'rb') as f:
+            self.assertEqual(f.read(), new)
+        return ops
+
+    def random_bytes(self, size):
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def test_unchanged(self):
+        data = self.random_bytes(10 * self.block_size)
+        ops = self.round_trip(data, data)
+        self.assertEqual(ops, list(range(10)))
+
+    def test_edits(self):
+        data = self.random_bytes(20 * self.block_size + 100)
+        new = data[:3000] + b'inserted' + data[3000:9000] + data[12000:] + b'appended'
+        ops = self.round_trip(data, new, read_size=4 * self.block_size)
+        literal = sum(len(op) for op in ops if not isinstance(op, int))
+        self.assertLess(literal, 4 * self.block_size)
+
+    def test_moved_blocks(self):
+        blocks = [self.random_bytes(self.block_size) for _ in range(8)]
+        ops = self.round_trip(b''.join(blocks), b''.join(reversed(blocks)))
+        self.assertEqual(ops, list(reversed(range(8))))
+
+    def test_unrelated(self):
+        self.round_trip(self.random_bytes(5000), self.random_bytes(7000), read_size=self.block_size)
+
+    def test_small_and_empty(self):
+        self.round_trip(self.random_bytes(100), b'')
+        self.round_trip(b'', self.random_bytes(100))
+
+    def test_missing(self):
+        self.assertIsNone(signature(os.path.join(self.dir, 'missing'), self.block_size))
+
+    def test_checksum_mismatch(self):
+        old_path, new_path = self.write('old', b'old'), self.write('new', b'new')
+        self.assertRaises(IOError, patch, old_path, [b'other'], self.block_size, _file_digest(new_path))
+        with open(old_path, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertFalse(os.path.exists(old_path + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
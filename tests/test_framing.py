@@ -0,0 +1,74 @@
+import os
+import socket
+import threading
+import unittest
+
+from flowlight.utils.framing import HEADER, FrameReader, frame, send_frame, recv_frame
+
+
+class ChunkedSocket:
+    """A non-blocking socket handing out `data` `chunk_size` bytes at a time.
+    """
+    def __init__(self, data, chunk_size):
+        self._chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    def gettimeout(self):
+        return 0
+
+    def recv_into(self, view):
+        if not self._chunks:
+            raise BlockingIOError
+        chunk = self._chunks.pop(0)
+        if len(chunk) > len(view):
+            self._chunks.insert(0, chunk[len(view):])
+            chunk = chunk[:len(view)]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def encode(*payloads):
+    return b''.join(b''.join(frame(payload)) for payload in payloads)
+
+
+class FrameReaderTest(unittest.TestCase):
+    def read_all(self, data, chunk_size):
+        reader = FrameReader()
+        sock = ChunkedSocket(data, chunk_size)
+        while sock._chunks:
+            reader.read_from(sock)
+        return [bytes(f) for f in reader.frames]
+
+    def test_split_headers(self):
+        payloads = [b'a', b'', b'hello' * 10, b'x' * 1000]
+        data = encode(*payloads)
+        for chunk_size in (1, 3, HEADER.size - 1, HEADER.size + 1, 7, len(data)):
+            self.assertEqual(self.read_all(data, chunk_size), payloads, chunk_size)
+
+    def test_large_frames(self):
+        large = os.urandom(3 * 1024 * 1024)
+        payloads = [b'small', large, b'after', large[:300000]]
+        self.assertEqual(self.read_all(encode(*payloads), 65536), payloads)
+
+    def test_closed_mid_frame(self):
+        left, right = socket.socketpair()
+        with left, right:
+            right.sendall(encode(b'whole') + HEADER.pack(10) + b'half')
+            right.close()
+            reader = FrameReader()
+            self.assertEqual(bytes(recv_frame(left, reader)), b'whole')
+            self.assertRaises(EOFError, recv_frame, left, reader)
+
+    def test_socket_round_trip(self):
+        left, right = socket.socketpair()
+        payloads = [os.urandom(size) for size in (0, 10, 70000, 5 * 1024 * 1024)]
+        sender = threading.Thread(target=lambda: [send_frame(right, payload) for payload in payloads])
+        sender.start()
+        with left, right:
+            reader = FrameReader()
+            received = [bytes(recv_frame(left, reader)) for _ in payloads]
+            sender.join()
+        self.assertEqual(received, payloads)
+
+
+if __name__ == '__main__':
+    unittest.main()
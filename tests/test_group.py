@@ -0,0 +1,41 @@
+import socket
+import time
+import unittest
+
+from flowlight.model.group import Group
+from flowlight.model.machine import Machine
+
+
+class EnableConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.group = Group(['no-such-host.invalid', '127.0.0.1'])
+
+    def tearDown(self):
+        self.group.close_connection()
+
+    def test_raise(self):
+        self.assertRaises(Exception, self.group.enable_connection)
+
+    def test_return_failures(self):
+        failures = self.group.enable_connection(return_failures=True)
+        self.assertEqual([machine.host for machine in failures], ['no-such-host.invalid'])
+        self.assertIsNotNone(self.group.get('127.0.0.1').connection)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_silent_host(self):
+        # accepts connections and never sends the SSH banner
+        server = socket.socket()
+        server.bind(('127.0.0.2', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        group = Group([])
+        group.add(Machine('127.0.0.2', port=server.getsockname()[1]))
+        started = time.monotonic()
+        failures = group.enable_connection(connect=True, deadline=0.5, return_failures=True)
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(len(failures), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
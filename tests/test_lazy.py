@@ -0,0 +1,26 @@
+import unittest
+
+from flowlight.utils.lazy import install_lazy
+
+
+class InstallLazyTest(unittest.TestCase):
+    def setUp(self):
+        self.namespace = {'__name__': 'flowlight.core'}
+        install_lazy(self.namespace, {'Command': '.command', 'join': ('os.path', 'join')})
+
+    def test_load(self):
+        from flowlight.core.command import Command
+        from os.path import join
+        self.assertIs(self.namespace['__getattr__']('Command'), Command)
+        self.assertIs(self.namespace['__getattr__']('join'), join)
+        self.assertIs(self.namespace['Command'], Command)
+
+    def test_unknown(self):
+        self.assertRaises(AttributeError, self.namespace['__getattr__'], 'Unknown')
+
+    def test_dir(self):
+        self.assertLessEqual({'Command', 'join'}, set(self.namespace['__dir__']()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from flowlight.core.setting import Setting
+from flowlight.utils.metrics import Registry, enable
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.enabled = Setting.METRICS
+        enable()
+        self.registry = Registry()
+
+    def tearDown(self):
+        enable(self.enabled)
+
+    def test_counter(self):
+        calls = self.registry.counter('calls_total', 'Calls made')
+        calls.inc(host='host1')
+        calls.inc(2, host='host1')
+        calls.inc(host='a"b\\c')
+        self.assertEqual(calls.get(host='host1'), 3)
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP calls_total Calls made',
+            '# TYPE calls_total counter',
+            'calls_total{host="host1"} 3',
+            'calls_total{host="a\\"b\\\\c"} 1',
+        ])
+
+    def test_gauge(self):
+        queued = self.registry.gauge('queued')
+        queued.set(5)
+        queued.dec(2)
+        self.assertIn('queued 3', self.registry.render().splitlines())
+
+    def test_histogram(self):
+        seconds = self.registry.histogram('seconds', 'Time taken', buckets=[0.5, 0.1])
+        for value in (0.05, 0.1, 0.3, 2):
+            seconds.observe(value, host='host1')
+        self.assertEqual(seconds.get(host='host1'), (4, 2.45))
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'seconds_bucket{host="host1",le="0.1"} 2',
+            'seconds_bucket{host="host1",le="0.5"} 3',
+            'seconds_bucket{host="host1",le="+Inf"} 4',
+            'seconds_count{host="host1"} 4',
+            'seconds_sum{host="host1"} 2.45',
+        ])
+
+    def test_sorted_by_name(self):
+        self.registry.counter('b_total').inc()
+        self.registry.counter('a_total').inc()
+        lines = [line for line in self.registry.render().splitlines() if line.startswith('# TYPE')]
+        self.assertEqual(lines, ['# TYPE a_total counter', '# TYPE b_total counter'])
+
+    def test_kind_conflict(self):
+        self.registry.counter('value')
+        self.assertIs(self.registry.counter('value'), self.registry.counter('value'))
+        self.assertRaises(Exception, self.registry.gauge, 'value')
+
+    def test_disabled(self):
+        enable(False)
+        calls = self.registry.counter('calls_total')
+        calls.inc()
+        self.assertEqual(calls.get(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
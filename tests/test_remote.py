@@ -0,0 +1,65 @@
+import itertools
+import unittest
+
+from benchmarks.harness import Workers
+from flowlight import Machine
+from flowlight.core.setting import Setting
+from flowlight.core.worker import StreamCredit
+from flowlight.utils.remote import PickledCallable
+
+
+class StreamCreditTest(unittest.TestCase):
+    def test_idle_timeout(self):
+        credit = StreamCredit(1, timeout=0.05)
+        self.assertTrue(credit.acquire())
+        self.assertFalse(credit.acquire())
+        self.assertTrue(credit.expired)
+
+    def test_release(self):
+        credit = StreamCredit(1, timeout=0.05)
+        credit.acquire()
+        credit.release(1)
+        self.assertTrue(credit.acquire())
+        self.assertFalse(credit.expired)
+
+
+class RemoteStreamTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workers = Workers().start()
+        cls.port, Setting.PORT = Setting.PORT, cls.workers.port
+
+    @classmethod
+    def tearDownClass(cls):
+        Setting.PORT = cls.port
+        cls.workers.stop()
+
+    def test_abandoned_streams(self):
+        machine = Machine('127.0.0.1')
+        # more than every worker thread, each one waits for credit until its iterator is dropped
+        for _ in range(Setting.WORKER_NUM * Setting.MAX_EXECUTE_THREADS * 2):
+            for item in machine.run_remote_callable(itertools.count):
+                if item == 3:
+                    break
+        future = machine.submit_remote_callable(sum, [1, 2, 3])
+        self.assertEqual(future.result(timeout=10), 6)
+
+    def test_digest_mismatch(self):
+        machine = Machine('127.0.0.1')
+        forged = PickledCallable(sum)
+        forged.digest = PickledCallable(max).digest
+        with self.assertRaisesRegex(Exception, 'digest'):
+            machine.run_remote_callable(forged, [1, 2, 3])
+        # the forged pickle wasn't cached under the digest of `max`
+        self.assertEqual(machine.run_remote_callable(PickledCallable(max), [1, 2, 3]), 3)
+
+    def test_close(self):
+        machine = Machine('127.0.0.1')
+        items = machine.run_remote_callable(itertools.count)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(list(items), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
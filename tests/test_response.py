@@ -0,0 +1,52 @@
+import unittest
+from io import BytesIO
+
+from flowlight.core.response import Response
+
+
+class ResponseTest(unittest.TestCase):
+    data = b'line\n' * 1000
+
+    def test_unbounded(self):
+        response = Response(None, BytesIO(self.data), BytesIO(b''))
+        self.assertEqual(response.stdout, self.data)
+        self.assertEqual(response.output_size, len(self.data))
+        self.assertFalse(response.truncated)
+
+    def test_spill(self):
+        response = Response(None, BytesIO(self.data), None, max_size=100)
+        self.assertTrue(response._captures['stdout'].spilled)
+        self.assertEqual(response.stdout, self.data)
+        self.assertEqual(response.output_file().read(), self.data)
+        self.assertFalse(response.truncated)
+
+    def test_kept_in_memory(self):
+        response = Response(None, BytesIO(self.data), None, max_size=len(self.data))
+        self.assertFalse(response._captures['stdout'].spilled)
+        self.assertEqual(response.stdout, self.data)
+
+    def test_truncate(self):
+        response = Response(None, BytesIO(self.data), BytesIO(b'error'), max_size=100, overflow='truncate')
+        self.assertEqual(response.stdout, self.data[:100])
+        self.assertEqual(response.stderr, b'error')
+        self.assertTrue(response.truncated)
+        self.assertEqual(response.output_size, 105)
+
+    def test_illegal_overflow(self):
+        self.assertRaises(Exception, Response, None, BytesIO(b''), None, overflow='drop')
+
+    def test_output_file_seek(self):
+        response = Response(None, BytesIO(self.data), None, max_size=100)
+        first, second = response.output_file(), response.output_file()
+        first.seek(-5, 2)
+        self.assertEqual(first.read(), b'line\n')
+        self.assertEqual(second.read(5), b'line\n')
+
+    def test_stream(self):
+        response = Response(None, BytesIO(b'a\nb\r\nc'), None, stream=True)
+        self.assertEqual(list(response.iter_lines()), [b'a', b'b', b'c'])
+        self.assertEqual(response.stdout, b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
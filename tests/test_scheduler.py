@@ -0,0 +1,60 @@
+import time
+import unittest
+
+from flowlight.model.node import Node
+from flowlight.tasks import task
+from flowlight.tasks.scheduler import Scheduler
+
+
+def record(log, name, delay=0, fail=False):
+    def func(meta, node):
+        log.append((name, 'start'))
+        time.sleep(delay)
+        log.append((name, 'end'))
+        if fail:
+            raise Exception(name)
+        return name
+    func.__name__ = name
+    return func
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.node = Node('node')
+        self.log = []
+
+    def test_cycle(self):
+        first = task(record(self.log, 'first'))
+        second = task(record(self.log, 'second'), depends_on=[first])
+        first.depends_on.append(second)
+        self.assertRaises(Exception, Scheduler, [second])
+
+    def test_dependency_order(self):
+        build = task(record(self.log, 'build', 0.05))
+        lint = task(record(self.log, 'lint', 0.05))
+        deploy = task(record(self.log, 'deploy'), depends_on=[build, lint])
+        self.assertEqual(Scheduler([deploy]).run(self.node), [('deploy', True)])
+        self.assertEqual(self.log[-2:], [('deploy', 'start'), ('deploy', 'end')])
+        # independent tasks overlap
+        self.assertEqual({name for name, _ in self.log[:2]}, {'build', 'lint'})
+
+    def test_failure_propagation(self):
+        build = task(record(self.log, 'build', fail=True))
+        test = task(record(self.log, 'test'), depends_on=[build])
+        deploy = task(record(self.log, 'deploy'), depends_on=[test])
+        other = task(record(self.log, 'other'))
+        results = Scheduler([deploy, other, build]).run(self.node)
+        self.assertEqual([status for _, status in results], [False, True, False])
+        self.assertNotIn(('test', 'start'), self.log)
+        self.assertNotIn(('deploy', 'start'), self.log)
+
+    def test_list_order(self):
+        names = ['first', 'second', 'third']
+        tasks = [task(record(self.log, name, 0.01, fail=name == 'second')) for name in names]
+        results = self.node.run_tasks(tasks, max_workers=4)
+        self.assertEqual([status for _, status in results], [True, False, True])
+        self.assertEqual(self.log, [(name, step) for name in names for step in ('start', 'end')])
+
+
+if __name__ == '__main__':
+    unittest.main()